@@ -14,7 +14,8 @@ import json
 from sqlmodel import select
 
 from .models import ManagedService, Panel, PanelConfig, User
-from .xui_client import XUIClient
+from .panel_clients import get_panel_client
+from .provisioning import delete_panel_config
 from .tasks import build_configs_task
 
 api = FastAPI()
@@ -275,8 +276,8 @@ async def delete_inactive_services_batch(
                                 ).first()
                                 
                                 if panel:
-                                    client = XUIClient(panel.url, panel.username, panel.password)
-                                    client.delete_inbound(config.panel_inbound_id)
+                                    client = get_panel_client(panel)
+                                    delete_panel_config(client, config)
                                 else:
                                     logger.warning(f"Panel not found for config {config.id}")
                             except Exception as e:
@@ -345,8 +346,8 @@ async def delete_inactive_services(
                 for p_config in service.configs:
                     try:
                         panel = p_config.panel
-                        client = XUIClient(panel.url, panel.username, panel.password)
-                        client.delete_inbound(p_config.panel_inbound_id)
+                        client = get_panel_client(panel)
+                        delete_panel_config(client, p_config)
                     except Exception as e:
                         logger.error(f"خطای غیربحرانی: حذف کانفیگ {p_config.panel_inbound_id} از پنل {panel.url} با مشکل مواجه شد: {e}")
                     session.delete(p_config)
@@ -425,10 +426,71 @@ async def get_workers_status(current_user: User = Depends(get_current_user)):
     """Get Redis workers status"""
     try:
         from .redis_worker import worker_manager
+        status = worker_manager.get_workers_status()
         return {
-            "workers_running": worker_manager.running,
-            "active_workers": len(worker_manager.workers),
+            "workers_running": bool(status["processes"]),
+            "active_workers": sum(
+                pool["running"] for process in status["processes"] for pool in process["workers"].values()
+            ),
+            "processes": status["processes"],
+            "concurrency_overrides": status["overrides"],
             "timestamp": datetime.now().isoformat()
         }
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error getting workers status: {e}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Error getting workers status: {e}")
+
+@api.get("/redis/scheduler/status")
+async def get_scheduler_status(current_user: User = Depends(get_current_user)):
+    """زمان اجرای بعدی و آخرین اجرای تسک‌های دوره‌ای و پروسه leader زمان‌بند"""
+    try:
+        from .redis_worker import worker_manager
+        return worker_manager.get_scheduler_status()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error getting scheduler status: {e}")
+
+@api.put("/redis/workers/{task_name}/concurrency")
+async def resize_workers(task_name: str, concurrency: int, current_user: User = Depends(get_current_user)):
+    """تغییر تعداد worker های یک نوع تسک در همه پروسه‌های worker (بدون ری‌استارت)"""
+    if concurrency < 0:
+        raise HTTPException(status_code=400, detail="concurrency must be >= 0")
+    try:
+        from .redis_worker import worker_manager
+        worker_manager.resize_workers(task_name, concurrency)
+        return {"success": True, "task_name": task_name, "concurrency": concurrency}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error resizing workers: {e}")
+
+@api.get("/redis/dead/{task_name}")
+async def get_dead_tasks(task_name: str, limit: int = 100, current_user: User = Depends(get_current_user)):
+    """تسک‌هایی که تلاش‌های مجددشان تمام شده (dead-letter queue)"""
+    try:
+        from .redis_queue import redis_queue
+        tasks = redis_queue.get_dead_tasks(task_name, limit)
+        return {
+            "task_name": task_name,
+            "count": redis_queue.redis_client.zcard(f"dead:{task_name}"),
+            "tasks": tasks,
+            "timestamp": datetime.now().isoformat()
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error getting dead tasks: {e}")
+
+@api.post("/redis/dead/{task_name}/replay")
+async def replay_dead_tasks(task_name: str, task_id: str = None, current_user: User = Depends(get_current_user)):
+    """بازگرداندن تسک‌های dead-letter queue به صف (همه یا فقط task_id)"""
+    try:
+        from .redis_queue import redis_queue
+        replayed = redis_queue.replay_dead_tasks(task_name, [task_id] if task_id else None)
+        return {"success": True, "replayed": replayed}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error replaying dead tasks: {e}")
+
+@api.delete("/redis/dead/{task_name}")
+async def purge_dead_tasks(task_name: str, task_id: str = None, current_user: User = Depends(get_current_user)):
+    """حذف تسک‌های dead-letter queue (همه یا فقط task_id)"""
+    try:
+        from .redis_queue import redis_queue
+        purged = redis_queue.purge_dead_tasks(task_name, [task_id] if task_id else None)
+        return {"success": True, "purged": purged}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error purging dead tasks: {e}")
@@ -0,0 +1,45 @@
+# xui_multi/async_db.py
+
+import os
+import asyncio
+import weakref
+import logging
+
+import reflex as rx
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
+
+logger = logging.getLogger(__name__)
+
+# Async driver URL; by default the app's db_url with the asyncpg driver
+XUI_ASYNC_DB_URL = os.getenv("XUI_ASYNC_DB_URL")
+XUI_ASYNC_DB_POOL_SIZE = int(os.getenv("XUI_ASYNC_DB_POOL_SIZE", "20"))
+
+# اتصال‌های asyncpg به event loop خود وابسته‌اند، پس برای هر loop یک engine جدا نگه داشته می‌شود
+_engines: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncEngine]" = weakref.WeakKeyDictionary()
+
+def async_db_url() -> str:
+    if XUI_ASYNC_DB_URL:
+        return XUI_ASYNC_DB_URL
+    url = rx.config.get_config().db_url
+    for prefix in ("postgresql+psycopg2://", "postgresql://"):
+        if url.startswith(prefix):
+            return "postgresql+asyncpg://" + url[len(prefix):]
+    return url
+
+def get_async_engine() -> AsyncEngine:
+    loop = asyncio.get_running_loop()
+    engine = _engines.get(loop)
+    if engine is None:
+        engine = create_async_engine(async_db_url(), pool_size=XUI_ASYNC_DB_POOL_SIZE, pool_pre_ping=True)
+        _engines[loop] = engine
+    return engine
+
+def async_session() -> AsyncSession:
+    """session async روی engine همین event loop (برای runtime async worker ها)"""
+    return AsyncSession(get_async_engine(), expire_on_commit=False)
+
+async def dispose_async_engine():
+    """بستن اتصال‌های engine این event loop (هنگام توقف runtime)"""
+    engine = _engines.pop(asyncio.get_running_loop(), None)
+    if engine is not None:
+        await engine.dispose()
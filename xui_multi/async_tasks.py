@@ -0,0 +1,184 @@
+# xui_multi/async_tasks.py
+"""
+نسخه async تسک‌های I/O محور برای runtime async worker ها (POOL_ASYNC در redis_queue):
+همه درخواست‌های پنل با AsyncXUIClient و همه کارهای دیتابیس با AsyncSession انجام می‌شوند،
+پس صدها تسک روی یک event loop همزمان اجرا می‌شوند. رفتار هر تسک مثل نسخه sync آن در tasks.py است.
+"""
+
+import asyncio
+import logging
+from datetime import datetime
+from typing import List, Optional
+
+from sqlalchemy import delete, select
+
+from .async_db import async_session
+from .models import ManagedService, Panel, PanelConfig
+from .panel_clients import fan_out, get_async_panel_client
+from .provisioning import (
+    service_spec, provision_service_async, new_panel_config, update_panel_config_async, disable_panel_configs_async,
+)
+from .redis_queue import RetryableTaskError
+from .tasks import TRANSIENT_ERRORS, write_subscription_file
+
+logger = logging.getLogger(__name__)
+
+async def disable_configs_async(panels, configs) -> int:
+    """نسخه async از disable_configs: کانفیگ‌ها به تفکیک پنل و به صورت همزمان غیرفعال می‌شوند"""
+    by_panel = {}
+    for config in configs:
+        by_panel.setdefault(config.panel_id, []).append(config)
+    targets = [panel for panel in panels if panel.id in by_panel]
+    if not targets:
+        return 0
+
+    async def disable_on_panel(client, panel):
+        return await disable_panel_configs_async(client, by_panel[panel.id])
+
+    result = await fan_out(targets, disable_on_panel)
+    for panel in targets:
+        if panel.id in result["errors"]:
+            logger.error(f"Error disabling configs on panel {panel.url}: {result['errors'][panel.id]}")
+    return sum(result["results"].values())
+
+async def _service_by_uuid(session, service_uuid: str) -> Optional[ManagedService]:
+    return (await session.execute(select(ManagedService).where(ManagedService.uuid == service_uuid))).scalars().first()
+
+async def build_configs_task_async(service_uuid: str):
+    """تسک ساخت کانفیگ‌ها برای سرویس (async)"""
+    logger.info(f"[{datetime.now()}] Starting build_configs_task_async for service: {service_uuid}")
+
+    async with async_session() as session:
+        service = await _service_by_uuid(session, service_uuid)
+        if not service:
+            logger.error(f"Service with UUID {service_uuid} not found")
+            return
+
+        # Panels that already have this service's config (from an earlier attempt) are skipped
+        existing_panel_ids = set((await session.execute(
+            select(PanelConfig.panel_id).where(PanelConfig.managed_service_id == service.id)
+        )).scalars().all())
+        panels = [panel for panel in (await session.execute(select(Panel))).scalars().all() if panel.id not in existing_panel_ids]
+        spec = service_spec(service)
+        # Release the DB connection while the panels are contacted
+        await session.commit()
+
+        async def create_on_panel(client, panel):
+            return await provision_service_async(client, panel, spec)
+
+        created = await fan_out(panels, create_on_panel)
+        for panel in panels:
+            if panel.id in created["errors"]:
+                logger.error(f"Error processing panel {panel.url}: {created['errors'][panel.id]}")
+                continue
+            result = created["results"][panel.id]
+            if not result.get("link") or not result.get("inbound_id"):
+                logger.error(f"[{datetime.now()}] ERROR: Invalid result from panel {panel.url}: {result}")
+                continue
+            session.add(new_panel_config(service.id, panel.id, result))
+        await session.commit()
+
+        # Create subscription file
+        links = (await session.execute(
+            select(PanelConfig.config_link).where(PanelConfig.managed_service_id == service.id)
+        )).scalars().all()
+        subscription_content = "\n".join(link for link in links if link)
+        if subscription_content.strip():
+            await asyncio.to_thread(write_subscription_file, service_uuid, subscription_content)
+            service.subscription_link = subscription_content
+            await session.commit()
+        else:
+            logger.warning(f"[{datetime.now()}] No valid config_links found for service {service.name}")
+
+    # Panels that were down or timed out are retried later; the next attempt only builds those
+    transient = [panel.url for panel in panels if isinstance(created["errors"].get(panel.id), TRANSIENT_ERRORS)]
+    if transient:
+        raise RetryableTaskError(f"Could not reach panels {transient} for service {service_uuid}")
+
+async def update_service_task_async(service_uuid: str, retry_config_ids: Optional[List[int]] = None, **updates):
+    """تسک به‌روزرسانی سرویس (async)؛ کانفیگ‌های همه پنل‌ها همزمان به‌روز می‌شوند"""
+    logger.info(f"[{datetime.now()}] Starting update_service_task_async for service: {service_uuid}")
+
+    async with async_session() as session:
+        service = await _service_by_uuid(session, service_uuid)
+        if not service:
+            logger.error(f"Service with UUID {service_uuid} not found")
+            return
+
+        original_end_date = service.end_date
+        original_data_limit = service.data_limit_gb
+        for field, value in updates.items():
+            if hasattr(service, field):
+                if field == "end_date" and isinstance(value, str):
+                    value = datetime.fromisoformat(value)
+                setattr(service, field, value)
+        configs_need_update = service.end_date != original_end_date or service.data_limit_gb != original_data_limit
+
+        failed_config_ids = []
+        if configs_need_update or retry_config_ids:
+            query = select(PanelConfig).where(PanelConfig.managed_service_id == service.id)
+            if not configs_need_update:
+                query = query.where(PanelConfig.id.in_(retry_config_ids))
+            configs = (await session.execute(query)).scalars().all()
+            panels = {panel.id: panel for panel in (await session.execute(
+                select(Panel).where(Panel.id.in_({config.panel_id for config in configs}))
+            )).scalars().all()}
+            expiry_days = (service.end_date - service.start_date).days
+
+        # Save the service before contacting the panels so no transaction stays open meanwhile
+        await session.commit()
+
+        if configs_need_update or retry_config_ids:
+            async def update_config(config):
+                panel = panels.get(config.panel_id)
+                if panel is None:
+                    logger.warning(f"Panel not found for config {config.id}")
+                    return
+                try:
+                    await update_panel_config_async(get_async_panel_client(panel), config, expiry_days, service.data_limit_gb)
+                except Exception as e:
+                    logger.error(f"Error updating config {config.panel_inbound_id} for service {service.name}: {e}")
+                    if isinstance(e, TRANSIENT_ERRORS):
+                        failed_config_ids.append(config.id)
+
+            await asyncio.gather(*(update_config(config) for config in configs))
+
+    if failed_config_ids:
+        raise RetryableTaskError(
+            f"Could not update {len(failed_config_ids)} configs of service {service_uuid}",
+            # The field updates are already saved; the retry only pushes the current values to the failed configs
+            # so it can never revert an update of the same service that ran in between
+            retry_data={"service_uuid": service_uuid, "retry_config_ids": failed_config_ids},
+            replace_data=True,
+        )
+    logger.info(f"[{datetime.now()}] Service {service_uuid} updated successfully")
+
+async def delete_service_task_async(service_uuid: str):
+    """تسک حذف سرویس (async)"""
+    async with async_session() as session:
+        service = await _service_by_uuid(session, service_uuid)
+        if not service:
+            logger.error(f"Service with UUID {service_uuid} not found")
+            return
+        await session.execute(delete(PanelConfig).where(PanelConfig.managed_service_id == service.id))
+        await session.delete(service)
+        await session.commit()
+    logger.info(f"[{datetime.now()}] Service {service_uuid} deleted successfully")
+
+async def check_expired_services_async():
+    """بررسی و غیرفعال کردن سرویس‌های منقضی شده بر اساس زمان (async)"""
+    async with async_session() as session:
+        expired = (await session.execute(
+            select(ManagedService).where(ManagedService.status == "active", ManagedService.end_date < datetime.now())
+        )).scalars().all()
+        if not expired:
+            return
+        for service in expired:
+            service.status = "expired"
+        await session.commit()
+
+        configs = (await session.execute(
+            select(PanelConfig).where(PanelConfig.managed_service_id.in_([service.id for service in expired]))
+        )).scalars().all()
+        panels = (await session.execute(select(Panel))).scalars().all()
+    return {"expired": len(expired), "disabled": await disable_configs_async(panels, configs)}
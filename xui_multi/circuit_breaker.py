@@ -0,0 +1,191 @@
+# xui_multi/circuit_breaker.py
+
+import os
+import time
+import logging
+import httpx
+from typing import Dict, Optional, Callable
+
+logger = logging.getLogger(__name__)
+
+# Consecutive failures after which a panel's circuit opens
+XUI_BREAKER_FAILURE_THRESHOLD = int(os.getenv("XUI_BREAKER_FAILURE_THRESHOLD", "3"))
+# First open period (seconds); doubles after every failed half-open probe
+XUI_BREAKER_BASE_BACKOFF = float(os.getenv("XUI_BREAKER_BASE_BACKOFF", "30"))
+XUI_BREAKER_MAX_BACKOFF = float(os.getenv("XUI_BREAKER_MAX_BACKOFF", "900"))
+# How long a single half-open probe may take before another process may probe again
+XUI_BREAKER_PROBE_TIMEOUT = int(os.getenv("XUI_BREAKER_PROBE_TIMEOUT", "60"))
+# How long (seconds) a process trusts a healthy circuit before reading Redis again
+XUI_BREAKER_CHECK_INTERVAL = float(os.getenv("XUI_BREAKER_CHECK_INTERVAL", "5"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# مقدار Panel.status برای هر وضعیت circuit
+PANEL_STATUS = {
+    CLOSED: "آنلاین",
+    OPEN: "آفلاین",
+    HALF_OPEN: "در حال بررسی",
+}
+
+# Counts a failure and opens the circuit atomically. Only the CLOSED->OPEN transition and a failed
+# half-open probe escalate the backoff; failures of requests still in flight while OPEN do not.
+# KEYS: breaker hash, probe lock; ARGV: threshold, base backoff, max backoff, now
+# Returns: previous state, backoff of a newly opened circuit ("" if it did not open), failures
+RECORD_FAILURE_SCRIPT = """
+local failures = redis.call('HINCRBY', KEYS[1], 'failures', 1)
+local state = redis.call('HGET', KEYS[1], 'state') or 'closed'
+if state == 'open' or (state ~= 'half_open' and failures < tonumber(ARGV[1])) then
+    return {state, '', failures}
+end
+local opens = redis.call('HINCRBY', KEYS[1], 'opens', 1)
+local backoff = math.min(tonumber(ARGV[3]), tonumber(ARGV[2]) * 2 ^ (opens - 1))
+redis.call('HSET', KEYS[1], 'state', 'open', 'open_until', tostring(tonumber(ARGV[4]) + backoff))
+redis.call('DEL', KEYS[2])
+return {state, tostring(backoff), failures}
+"""
+
+_record_failure_script = None
+
+class PanelUnavailableError(Exception):
+    """پنل در وضعیت open است و درخواست بدون ارسال به پنل رد می‌شود"""
+
+class PanelCircuitBreaker:
+    """
+    Circuit breaker یک پنل که وضعیت آن در Redis نگه داشته می‌شود تا پروسه‌های وب و worker آن را به اشتراک بگذارند.
+    بعد از N خطای پشت سر هم باز می‌شود، بعد از پایان زمان انتظار فقط یک درخواست آزمایشی (half-open) عبور می‌کند
+    و با شکست هر آزمایش زمان انتظار دو برابر می‌شود.
+    """
+
+    def __init__(self, panel_id: int, on_state_change: Optional[Callable[[int, str], None]] = None):
+        self.panel_id = panel_id
+        self.on_state_change = on_state_change
+        # تا این زمان circuit سالم فرض می‌شود و برای هر درخواست Redis خوانده/نوشته نمی‌شود
+        self._healthy_until = 0.0
+        # آخرین وضعیتی که این پروسه گزارش داده CLOSED است (برای ثبت «آنلاین» در اولین پاسخ سالم)
+        self._reported_closed = False
+
+    @property
+    def _key(self) -> str:
+        return f"panel_breaker:{self.panel_id}"
+
+    @property
+    def _probe_key(self) -> str:
+        return f"panel_breaker_probe:{self.panel_id}"
+
+    @staticmethod
+    def _redis():
+        from .redis_queue import redis_queue
+        return redis_queue.redis_client
+
+    def state(self) -> Dict[str, str]:
+        try:
+            return self._redis().hgetall(self._key)
+        except Exception as e:
+            logger.error(f"Could not read circuit state of panel {self.panel_id}: {e}")
+            return {}
+
+    def is_trusted(self) -> bool:
+        """circuit به تازگی سالم دیده شده و تا XUI_BREAKER_CHECK_INTERVAL بدون Redis قبول می‌شود"""
+        return time.time() < self._healthy_until
+
+    def before_request(self):
+        """قبل از هر درخواست به پنل صدا زده می‌شود؛ در صورت باز بودن circuit خطای PanelUnavailableError می‌دهد"""
+        now = time.time()
+        if now < self._healthy_until:
+            return
+        state = self.state()
+        if not state:
+            self._healthy_until = now + XUI_BREAKER_CHECK_INTERVAL
+            return
+        current = state.get("state", CLOSED)
+        if current == CLOSED:
+            return
+        open_until = float(state.get("open_until", 0))
+        if time.time() < open_until:
+            raise PanelUnavailableError(f"Panel {self.panel_id} is unavailable (circuit open for {int(open_until - time.time())}s more)")
+        # Time is up: only one process gets to send the probe
+        try:
+            acquired = self._redis().set(self._probe_key, "1", nx=True, ex=XUI_BREAKER_PROBE_TIMEOUT)
+        except Exception as e:
+            logger.error(f"Could not acquire probe lock of panel {self.panel_id}: {e}")
+            return
+        if not acquired:
+            raise PanelUnavailableError(f"Panel {self.panel_id} is unavailable (health probe in progress)")
+        if current != HALF_OPEN:
+            self._set_state(HALF_OPEN)
+
+    def record_success(self):
+        if time.time() >= self._healthy_until:
+            try:
+                redis = self._redis()
+                previous = redis.hget(self._key, "state")
+                redis.delete(self._key, self._probe_key)
+            except Exception as e:
+                logger.error(f"Could not reset circuit of panel {self.panel_id}: {e}")
+                return
+            self._healthy_until = time.time() + XUI_BREAKER_CHECK_INTERVAL
+            if previous and previous != CLOSED:
+                # circuit ممکن است در پروسه دیگری باز شده باشد
+                self._reported_closed = False
+        if not self._reported_closed:
+            self._notify(CLOSED)
+
+    def record_failure(self):
+        global _record_failure_script
+        self._healthy_until = 0.0
+        try:
+            if _record_failure_script is None:
+                _record_failure_script = self._redis().register_script(RECORD_FAILURE_SCRIPT)
+            previous, backoff, failures = _record_failure_script(
+                keys=[self._key, self._probe_key],
+                args=[XUI_BREAKER_FAILURE_THRESHOLD, XUI_BREAKER_BASE_BACKOFF, XUI_BREAKER_MAX_BACKOFF, time.time()],
+            )
+        except Exception as e:
+            logger.error(f"Could not record failure of panel {self.panel_id}: {e}")
+            return
+        if backoff:
+            if previous == HALF_OPEN:
+                logger.error(f"Health probe of panel {self.panel_id} failed; next probe in {int(float(backoff))}s")
+            else:
+                logger.error(f"Circuit of panel {self.panel_id} opened after {failures} failures; next probe in {int(float(backoff))}s")
+            self._notify(OPEN)
+
+    def _set_state(self, state: str):
+        try:
+            self._redis().hset(self._key, "state", state)
+        except Exception as e:
+            logger.error(f"Could not update circuit state of panel {self.panel_id}: {e}")
+        self._notify(state)
+
+    def _notify(self, state: str):
+        self._reported_closed = state == CLOSED
+        if self.on_state_change:
+            try:
+                self.on_state_change(self.panel_id, state)
+            except Exception as e:
+                logger.error(f"Error storing status of panel {self.panel_id}: {e}")
+
+    def reset(self):
+        """پاک کردن وضعیت circuit (مثلاً بعد از ویرایش اطلاعات پنل)"""
+        self._healthy_until = 0.0
+        try:
+            self._redis().delete(self._key, self._probe_key)
+        except Exception as e:
+            logger.error(f"Could not reset circuit of panel {self.panel_id}: {e}")
+
+_breakers: Dict[int, PanelCircuitBreaker] = {}
+
+def get_circuit_breaker(panel_id: int, on_state_change: Optional[Callable[[int, str], None]] = None) -> PanelCircuitBreaker:
+    """breaker مشترک پنل در این پروسه؛ on_state_change داده شده جایگزین callback قبلی می‌شود"""
+    breaker = _breakers.get(panel_id)
+    if breaker is None:
+        breaker = _breakers.setdefault(panel_id, PanelCircuitBreaker(panel_id, on_state_change))
+    if on_state_change is not None:
+        breaker.on_state_change = on_state_change
+    return breaker
+
+def is_panel_failure(response: httpx.Response) -> bool:
+    """پاسخ‌هایی که نشانه خرابی پنل هستند (نه خطای منطقی درخواست)"""
+    return response.status_code >= 500
@@ -0,0 +1,75 @@
+# xui_multi/inbound_cache.py
+
+import datetime
+import logging
+from typing import Dict, Any, List, Optional, Iterable
+
+from sqlalchemy import delete, func
+from sqlalchemy.dialects.postgresql import insert
+
+from .models import PanelInboundCache
+
+logger = logging.getLogger(__name__)
+
+def _cache_row(panel_id: int, inbound: Dict[str, Any], fetched_at: datetime.datetime) -> Dict[str, Any]:
+    return {
+        "panel_id": panel_id,
+        "inbound_id": inbound.get("id"),
+        "remark": inbound.get("remark"),
+        "up": inbound.get("up", 0) or 0,
+        "down": inbound.get("down", 0) or 0,
+        "total": inbound.get("total", 0) or 0,
+        "expiry_time": inbound.get("expiryTime", 0) or 0,
+        "enable": inbound.get("enable", True),
+        "protocol": inbound.get("protocol"),
+        "port": inbound.get("port"),
+        "settings": inbound.get("settings"),
+        "created_at": fetched_at,
+        "fetched_at": fetched_at,
+    }
+
+def store_panel_inbounds(session, panel_id: int, inbounds: List[Dict[str, Any]], fetched_at: Optional[datetime.datetime] = None) -> int:
+    """
+    snapshot لیست inbound های یک پنل را با یک INSERT ... ON CONFLICT در PanelInboundCache ذخیره می‌کند
+    و ردیف inbound هایی که دیگر روی پنل وجود ندارند را حذف می‌کند. commit با صدا زننده است.
+    """
+    fetched_at = fetched_at or datetime.datetime.now()
+    rows = [_cache_row(panel_id, inbound, fetched_at) for inbound in inbounds if inbound.get("id") is not None]
+    if rows:
+        statement = insert(PanelInboundCache).values(rows)
+        excluded = statement.excluded
+        statement = statement.on_conflict_do_update(
+            constraint="uq_panelinboundcache_panel_inbound",
+            set_={
+                "remark": excluded.remark,
+                "up": excluded.up,
+                "down": excluded.down,
+                "total": excluded.total,
+                "expiry_time": excluded.expiry_time,
+                "enable": excluded.enable,
+                "protocol": excluded.protocol,
+                "port": excluded.port,
+                "settings": excluded.settings,
+                "fetched_at": excluded.fetched_at,
+            },
+        )
+        session.execute(statement)
+    # Inbounds missing from this snapshot were deleted on the panel
+    session.execute(
+        delete(PanelInboundCache).where(
+            PanelInboundCache.panel_id == panel_id,
+            PanelInboundCache.fetched_at < fetched_at,
+        )
+    )
+    return len(rows)
+
+def cached_traffic_totals(session, panel_ids: Optional[Iterable[int]] = None) -> Dict[int, Dict[str, int]]:
+    """مجموع ترافیک هر پنل از روی PanelInboundCache (بدون درخواست به پنل‌ها)"""
+    query = session.query(
+        PanelInboundCache.panel_id,
+        func.coalesce(func.sum(PanelInboundCache.up), 0),
+        func.coalesce(func.sum(PanelInboundCache.down), 0),
+    ).group_by(PanelInboundCache.panel_id)
+    if panel_ids is not None:
+        query = query.filter(PanelInboundCache.panel_id.in_(list(panel_ids)))
+    return {panel_id: {"up": int(up), "down": int(down)} for panel_id, up, down in query.all()}
@@ -3,7 +3,7 @@
 from typing import List, Optional
 import datetime
 from sqlmodel import SQLModel, Field, Relationship
-from sqlalchemy import BigInteger
+from sqlalchemy import BigInteger, Column, ForeignKey, Integer, UniqueConstraint
 
 class User(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
@@ -20,6 +20,8 @@ class ManagedService(SQLModel, table=True):
     end_date: datetime.datetime
     data_limit_gb: float
     data_used_gb: float = 0.0
+    # مصرف دقیق (بایت) که از مجموع delta شمارنده‌های پنل‌ها جمع می‌شود؛ data_used_gb از روی آن محاسبه می‌شود
+    data_used_bytes: int = Field(default=0, sa_column=Column(BigInteger, nullable=False, default=0, server_default="0"))
     status: str = "active"
     protocol: str = "vless"  # Added protocol field
     subscription_link: str = ""
@@ -40,7 +42,8 @@ class Panel(SQLModel, table=True):
     backups: List["Backup"] = Relationship(back_populates="panel")
     online_users: int = 0
     total_traffic_gb: float = 0.0
-    inbound_cache: List["PanelInboundCache"] = Relationship(back_populates="panel")
+    # ردیف‌های کش با حذف پنل حذف می‌شوند (در دیتابیس هم ON DELETE CASCADE)
+    inbound_cache: List["PanelInboundCache"] = Relationship(back_populates="panel", cascade_delete=True)
 
 class PanelConfig(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
@@ -48,6 +51,11 @@ class PanelConfig(SQLModel, table=True):
     panel_id: Optional[int] = Field(default=None, foreign_key="panel.id")
     panel_inbound_id: int
     config_link: str
+    # فقط برای سرویس‌هایی که به صورت کلاینت در inbound اشتراکی ساخته شده‌اند
+    client_id: Optional[str] = Field(default=None)  # uuid (vless) یا email (shadowsocks) در x-ui
+    client_email: Optional[str] = Field(default=None)
+    # مصرف تجمعی (بایت) این کانفیگ از مجموع delta شمارنده‌های پنل
+    used_bytes: int = Field(default=0, sa_column=Column(BigInteger, nullable=False, default=0, server_default="0"))
     managed_service: Optional[ManagedService] = Relationship(back_populates="configs")
     panel: Optional[Panel] = Relationship(back_populates="configs")
 
@@ -60,19 +68,30 @@ class Backup(SQLModel, table=True):
     panel: "Panel" = Relationship(back_populates="backups")
 
 class PanelInboundCache(SQLModel, table=True):
+    # هر inbound هر پنل فقط یک ردیف دارد (کلید upsert در همگام‌سازی مصرف)
+    __table_args__ = (UniqueConstraint("panel_id", "inbound_id", name="uq_panelinboundcache_panel_inbound"),)
+
     id: Optional[int] = Field(default=None, primary_key=True)
-    panel_id: int = Field(foreign_key="panel.id")
+    panel_id: int = Field(foreign_key="panel.id", index=True, ondelete="CASCADE")
     inbound_id: int
     remark: Optional[str] = None
-    up: int = Field(default=0, sa_column=BigInteger())  # Upload traffic in bytes
-    down: int = Field(default=0, sa_column=BigInteger())  # Download traffic in bytes
-    total: int = Field(default=0, sa_column=BigInteger())  # Total limit in bytes
-    expiry_time: int = Field(default=0, sa_column=BigInteger())  # Expiry time in milliseconds
+    up: int = Field(default=0, sa_column=Column(BigInteger, nullable=False, default=0))  # Upload traffic in bytes
+    down: int = Field(default=0, sa_column=Column(BigInteger, nullable=False, default=0))  # Download traffic in bytes
+    total: int = Field(default=0, sa_column=Column(BigInteger, nullable=False, default=0))  # Total limit in bytes
+    expiry_time: int = Field(default=0, sa_column=Column(BigInteger, nullable=False, default=0))  # Expiry time in milliseconds
     enable: bool = Field(default=True)
     protocol: Optional[str] = None
     port: Optional[int] = None
     settings: Optional[str] = None  # JSON settings
     created_at: datetime.datetime = Field(default_factory=datetime.datetime.now)
+    fetched_at: datetime.datetime = Field(default_factory=datetime.datetime.now)  # زمان آخرین دریافت از پنل
     
     # Relationship
-    panel: Panel = Relationship(back_populates="inbound_cache")
\ No newline at end of file
+    panel: Panel = Relationship(back_populates="inbound_cache")
+
+class UsageCounter(SQLModel, table=True):
+    """آخرین مقدار شمارنده‌های up/down هر کانفیگ روی پنل، برای محاسبه مصرف به صورت delta"""
+    config_id: int = Field(sa_column=Column(Integer, ForeignKey("panelconfig.id", ondelete="CASCADE"), primary_key=True))
+    last_up: int = Field(default=0, sa_column=Column(BigInteger, nullable=False, default=0))
+    last_down: int = Field(default=0, sa_column=Column(BigInteger, nullable=False, default=0))
+    updated_at: datetime.datetime = Field(default_factory=datetime.datetime.now)
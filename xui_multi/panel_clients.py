@@ -0,0 +1,191 @@
+# xui_multi/panel_clients.py
+
+import os
+import asyncio
+import threading
+import weakref
+import logging
+from typing import Dict, Optional, List, Any, Callable, Awaitable
+
+import reflex as rx
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from .models import Panel
+from .circuit_breaker import PANEL_STATUS, get_circuit_breaker
+from .xui_client import XUIClient, AsyncXUIClient, aclose_async_http_clients
+
+logger = logging.getLogger(__name__)
+
+# Fan-out settings: how many panels are contacted at once and how long each may take
+XUI_FANOUT_CONCURRENCY = int(os.getenv("XUI_FANOUT_CONCURRENCY", "16"))
+XUI_FANOUT_TIMEOUT = float(os.getenv("XUI_FANOUT_TIMEOUT", "30"))
+
+_engine = None
+
+def _get_engine():
+    global _engine
+    if _engine is None:
+        _engine = create_engine(rx.config.get_config().db_url)
+    return _engine
+
+class PanelClientRegistry:
+    """رجیستری سراسری کلاینت‌های پنل: برای هر پنل یک کلاینت لاگین شده با کوکی نشست مشترک"""
+
+    def __init__(self):
+        self._clients: Dict[int, XUIClient] = {}
+        self._async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[int, AsyncXUIClient]]" = weakref.WeakKeyDictionary()
+        self._cookies: Dict[int, str] = {}
+        self._lock = threading.Lock()
+
+    def get(self, panel: Panel) -> XUIClient:
+        """کلاینت پنل را برمی‌گرداند؛ در صورت تغییر آدرس یا اطلاعات ورود کلاینت جدید ساخته می‌شود"""
+        with self._lock:
+            client = self._clients.get(panel.id)
+            if client is None or not self._matches(client, panel):
+                client = XUIClient(
+                    panel.url, panel.username, panel.password,
+                    session_cookie=self._cookies.get(panel.id) or panel.cookie,
+                    on_login=lambda cookie, panel_id=panel.id: self._store_cookie(panel_id, cookie),
+                    breaker=get_circuit_breaker(panel.id, self._store_status),
+                )
+                self._clients[panel.id] = client
+            return client
+
+    def get_async(self, panel: Panel) -> AsyncXUIClient:
+        """نسخه async کلاینت پنل؛ برای هر event loop جداگانه نگه داشته می‌شود و کوکی نشست را با نسخه sync به اشتراک می‌گذارد"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            loop_clients = self._async_clients.setdefault(loop, {})
+            client = loop_clients.get(panel.id)
+            if client is None or not self._matches(client, panel):
+                client = AsyncXUIClient(
+                    panel.url, panel.username, panel.password,
+                    session_cookie=self._cookies.get(panel.id) or panel.cookie,
+                    on_login=lambda cookie, panel_id=panel.id: self._store_cookie(panel_id, cookie),
+                    breaker=get_circuit_breaker(panel.id, self._store_status),
+                )
+                loop_clients[panel.id] = client
+            return client
+
+    def invalidate(self, panel_id: Optional[int] = None):
+        """حذف کلاینت کش شده یک پنل (یا همه پنل‌ها)"""
+        with self._lock:
+            if panel_id is None:
+                self._clients.clear()
+                self._cookies.clear()
+                self._async_clients.clear()
+            else:
+                self._clients.pop(panel_id, None)
+                self._cookies.pop(panel_id, None)
+                for loop_clients in self._async_clients.values():
+                    loop_clients.pop(panel_id, None)
+                # اطلاعات پنل تغییر کرده؛ خطاهای قبلی دیگر معتبر نیستند
+                get_circuit_breaker(panel_id).reset()
+
+    def forget_loop(self, loop: asyncio.AbstractEventLoop):
+        with self._lock:
+            self._async_clients.pop(loop, None)
+
+    @staticmethod
+    def _matches(client, panel: Panel) -> bool:
+        return (
+            client.base_url == panel.url.rstrip('/')
+            and client.username == panel.username
+            and client.password == panel.password
+        )
+
+    def _store_cookie(self, panel_id: int, cookie: str):
+        """ذخیره کوکی نشست در Panel.cookie تا پروسه‌های دیگر هم بدون لاگین از آن استفاده کنند"""
+        self._cookies[panel_id] = cookie
+        with Session(_get_engine()) as session:
+            session.query(Panel).filter(Panel.id == panel_id).update({"cookie": cookie})
+            session.commit()
+
+    @staticmethod
+    def _store_status(panel_id: int, state: str):
+        """ثبت وضعیت circuit breaker پنل در Panel.status"""
+        with Session(_get_engine()) as session:
+            session.query(Panel).filter(Panel.id == panel_id).update({"status": PANEL_STATUS[state]})
+            session.commit()
+
+# Global panel client registry
+panel_clients = PanelClientRegistry()
+
+def get_panel_client(panel: Panel) -> XUIClient:
+    """Return the shared, logged-in XUIClient for a panel"""
+    return panel_clients.get(panel)
+
+def get_async_panel_client(panel: Panel) -> AsyncXUIClient:
+    """Return the AsyncXUIClient for a panel bound to the running event loop"""
+    return panel_clients.get_async(panel)
+
+async def fan_out(
+    panels: List[Panel],
+    operation: Callable[[AsyncXUIClient, Panel], Awaitable[Any]],
+    concurrency: int = XUI_FANOUT_CONCURRENCY,
+    timeout: float = XUI_FANOUT_TIMEOUT,
+) -> Dict[str, Dict[int, Any]]:
+    """
+    یک عملیات را به صورت همزمان روی همه پنل‌ها اجرا می‌کند.
+    خروجی: {"results": {panel_id: نتیجه}, "errors": {panel_id: exception}}
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    results: Dict[int, Any] = {}
+    errors: Dict[int, Exception] = {}
+
+    async def run(panel: Panel):
+        async with semaphore:
+            try:
+                client = panel_clients.get_async(panel)
+                results[panel.id] = await asyncio.wait_for(operation(client, panel), timeout)
+            except asyncio.TimeoutError:
+                errors[panel.id] = TimeoutError(f"Panel {panel.url} timed out after {timeout}s")
+            except Exception as e:
+                errors[panel.id] = e
+
+    await asyncio.gather(*(run(panel) for panel in panels))
+    return {"results": results, "errors": errors}
+
+# حلقه event ماندگار fan-out های sync: کلاینت‌های async و اتصال‌های keep-alive آن بین فراخوانی‌ها حفظ می‌شوند
+_fan_out_loop: Optional[asyncio.AbstractEventLoop] = None
+_fan_out_pid: Optional[int] = None
+_fan_out_lock = threading.Lock()
+
+def _get_fan_out_loop() -> asyncio.AbstractEventLoop:
+    global _fan_out_loop, _fan_out_pid
+    with _fan_out_lock:
+        # A forked worker process does not inherit the loop's thread, so it starts its own
+        if _fan_out_loop is None or _fan_out_pid != os.getpid() or _fan_out_loop.is_closed():
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="panel-fan-out", daemon=True).start()
+            _fan_out_loop, _fan_out_pid = loop, os.getpid()
+        return _fan_out_loop
+
+def run_fan_out(
+    panels: List[Panel],
+    operation: Callable[[AsyncXUIClient, Panel], Awaitable[Any]],
+    concurrency: int = XUI_FANOUT_CONCURRENCY,
+    timeout: float = XUI_FANOUT_TIMEOUT,
+) -> Dict[str, Dict[int, Any]]:
+    """نسخه sync از fan_out برای تسک‌های worker و جاب‌های زمان‌بندی شده (روی حلقه event ماندگار این پروسه اجرا می‌شود)"""
+    future = asyncio.run_coroutine_threadsafe(fan_out(panels, operation, concurrency, timeout), _get_fan_out_loop())
+    return future.result()
+
+def close_fan_out_loop():
+    """بستن کلاینت‌های async و توقف حلقه event ماندگار fan-out (هنگام توقف worker ها)"""
+    global _fan_out_loop
+    with _fan_out_lock:
+        loop, _fan_out_loop = _fan_out_loop, None
+    if loop is None or loop.is_closed() or _fan_out_pid != os.getpid():
+        return
+
+    async def close():
+        panel_clients.forget_loop(asyncio.get_running_loop())
+        await aclose_async_http_clients()
+
+    try:
+        asyncio.run_coroutine_threadsafe(close(), loop).result(timeout=10)
+    except Exception as e:
+        logger.error(f"Error closing fan-out clients: {e}")
+    loop.call_soon_threadsafe(loop.stop)
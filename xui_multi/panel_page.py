@@ -4,12 +4,12 @@ import reflex as rx
 from sqlmodel import select
 from typing import List, Optional, Dict, Any
 from datetime import datetime
-import requests
 import os
 
 from .models import Panel, Backup
 from .auth_state import AuthState
-from .xui_client import XUIClient
+from .panel_clients import get_panel_client, panel_clients, fan_out
+from .inbound_cache import cached_traffic_totals
 
 BACKUP_DIR = os.path.join("static", "backups")
 
@@ -19,7 +19,7 @@ class PanelsState(AuthState):
     show_dialog: bool = False
     panel_to_edit: Optional[Panel] = None
 
-    def load_panels_with_stats(self):
+    async def load_panels_with_stats(self):
         """بارگذاری پنل‌ها با آمار با استفاده از کش"""
         self.check_auth()
         
@@ -36,18 +36,28 @@ class PanelsState(AuthState):
         # اگر کش موجود نباشد، از دیتابیس بارگذاری کن
         with rx.session() as session:
             db_panels = session.exec(select(Panel)).all()
+            # ترافیک از PanelInboundCache خوانده می‌شود؛ فقط پنل‌هایی که هنوز کش ندارند از خود پنل
+            cached_traffic = cached_traffic_totals(session)
+
+            async def panel_stats(client, panel):
+                traffic = cached_traffic.get(panel.id)
+                if traffic is None:
+                    traffic = await client.get_all_inbounds_traffic()
+                return await client.get_online_clients_count(), traffic
+
+            # آمار همه پنل‌ها به صورت همزمان گرفته می‌شود
+            stats = await fan_out(db_panels, panel_stats)
             panels_with_stats = []
             for panel in db_panels:
-                try:
-                    client = XUIClient(panel.url, panel.username, panel.password)
-                    panel.online_users = client.get_online_clients_count()
-                    traffic_data = client.get_all_inbounds_traffic()
-                    total_bytes = traffic_data.get("up", 0) + traffic_data.get("down", 0)
-                    panel.total_traffic_gb = round(total_bytes / (1024**3), 2)
-                except Exception as e:
-                    print(f"Error fetching stats for panel {panel.url}: {e}")
+                if panel.id in stats["errors"]:
+                    print(f"Error fetching stats for panel {panel.url}: {stats['errors'][panel.id]}")
                     panel.online_users = -1
                     panel.total_traffic_gb = -1.0
+                else:
+                    online_count, traffic_data = stats["results"][panel.id]
+                    panel.online_users = online_count
+                    total_bytes = traffic_data.get("up", 0) + traffic_data.get("down", 0)
+                    panel.total_traffic_gb = round(total_bytes / (1024**3), 2)
                 panels_with_stats.append(panel)
             
             # ذخیره در کش برای 30 ثانیه
@@ -67,7 +77,7 @@ class PanelsState(AuthState):
         self.panel_to_edit = panel
         self.show_dialog = True
 
-    def save_panel(self, form_data: dict):
+    async def save_panel(self, form_data: dict):
         self.check_auth()
         with rx.session() as session:
             panel_to_update = None
@@ -80,12 +90,15 @@ class PanelsState(AuthState):
                     panel_to_update.username = form_data["username"]
                     if form_data.get("password"):
                         panel_to_update.password = form_data["password"]
+                    # نشست قبلی ممکن است برای آدرس یا اطلاعات ورود قبلی باشد
+                    panel_to_update.cookie = None
             else:
                 panel_to_update = Panel(**form_data)
 
             session.add(panel_to_update)
             session.commit()
             session.refresh(panel_to_update)
+            panel_clients.invalidate(panel_to_update.id)
 
         # حذف کش پنل‌ها
         from .cache_manager import invalidate_panel_cache
@@ -93,22 +106,23 @@ class PanelsState(AuthState):
         
         # --- FIX: بستن مودال قبل از نمایش پیغام ---
         self.show_dialog = False
-        self.load_panels_with_stats()
+        await self.load_panels_with_stats()
         return rx.window_alert("پنل با موفقیت ذخیره شد.")
 
-    def delete_panel(self, panel_id: int):
+    async def delete_panel(self, panel_id: int):
         self.check_auth()
         with rx.session() as session:
             panel = session.get(Panel, panel_id)
             if panel:
                 session.delete(panel)
                 session.commit()
+                panel_clients.invalidate(panel_id)
                 
                 # حذف کش پنل‌ها
                 from .cache_manager import invalidate_panel_cache
                 invalidate_panel_cache()
                 
-                self.load_panels_with_stats()
+                await self.load_panels_with_stats()
                 return rx.window_alert("پنل با موفقیت حذف شد.")
         return rx.window_alert("خطا در حذف پنل.")
 
@@ -162,17 +176,13 @@ class PanelBackupsState(AuthState):
             with rx.session() as session:
                 panel_in_session = session.get(Panel, self.panel.id)
                 if not panel_in_session: return
-                session_req = requests.Session()
-                res = session_req.post(f"{panel_in_session.url.rstrip('/')}/login", data={'username': panel_in_session.username, 'password': panel_in_session.password}, timeout=10)
-                res.raise_for_status()
-                res_db = session_req.get(f"{panel_in_session.url.rstrip('/')}/server/getDb", timeout=20)
-                res_db.raise_for_status()
+                db_content = get_panel_client(panel_in_session).get_db_backup()
                 panel_backup_dir = os.path.join(BACKUP_DIR, str(panel_in_session.id))
                 os.makedirs(panel_backup_dir, exist_ok=True)
                 date_str = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
                 file_name = f"manual_backup_{date_str}.db"
                 local_file_path = os.path.join(panel_backup_dir, file_name)
-                with open(local_file_path, "wb") as f: f.write(res_db.content)
+                with open(local_file_path, "wb") as f: f.write(db_content)
                 download_path = f"/static/backups/{panel_in_session.id}/{file_name}"
                 new_backup = Backup(panel_id=panel_in_session.id, file_name=file_name, file_path=download_path)
                 session.add(new_backup)
@@ -219,6 +229,7 @@ def panel_table() -> rx.Component:
                 rx.table.column_header_cell("عملیات", text_align="center", width="5%"),
                 rx.table.column_header_cell("ترافیک مصرفی (GB)", text_align="center"),
                 rx.table.column_header_cell("کاربران آنلاین", text_align="center"),
+                rx.table.column_header_cell("وضعیت", text_align="center"),
                 rx.table.column_header_cell("آدرس پنل", text_align="center"),
                 rx.table.column_header_cell("پیشوند", text_align="right"),
             )
@@ -241,6 +252,7 @@ def panel_table() -> rx.Component:
                     ),
                     rx.table.cell(rx.badge(rx.cond(panel.total_traffic_gb >= 0, panel.total_traffic_gb.to_string(), "خطا"), color_scheme=rx.cond(panel.total_traffic_gb >= 0, "blue", "red"))),
                     rx.table.cell(rx.badge(rx.cond(panel.online_users >= 0, panel.online_users.to_string(), "خطا"), color_scheme=rx.cond(panel.online_users >= 0, "teal", "red"))),
+                    rx.table.cell(rx.badge(panel.status, color_scheme=rx.match(panel.status, ("آنلاین", "green"), ("آفلاین", "red"), "gray"))),
                     rx.table.cell(rx.code(panel.url, style={"direction": "ltr"})),
                     rx.table.cell(panel.remark_prefix),
                 ),
@@ -0,0 +1,106 @@
+# xui_multi/port_allocator.py
+
+import os
+import threading
+import logging
+from uuid import uuid4
+from typing import Dict, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+# Port range used for new inbounds on every panel
+XUI_PORT_RANGE_START = int(os.getenv("XUI_PORT_RANGE_START", "20000"))
+XUI_PORT_RANGE_END = int(os.getenv("XUI_PORT_RANGE_END", "60000"))
+# How long (seconds) a port stays reserved for the worker that picked it
+XUI_PORT_RESERVATION_TTL = int(os.getenv("XUI_PORT_RESERVATION_TTL", "300"))
+
+class PortAllocator:
+    """
+    تخصیص پورت آزاد برای یک پنل.
+    پورت‌های استفاده شده در یک bitmap (یک بایت برای هر پورت) نگه داشته می‌شوند که از snapshot لیست inbound ها
+    ساخته می‌شود و هر پورت انتخاب شده به صورت اتمیک در Redis رزرو می‌شود تا workerهای همزمان پورت تکراری نگیرند.
+    """
+
+    def __init__(self, panel_id: int, start: int = XUI_PORT_RANGE_START, end: int = XUI_PORT_RANGE_END):
+        self.panel_id = panel_id
+        self.start = start
+        self.end = end
+        self._used = bytearray(end - start + 1)
+        self._cursor = 0
+        self._source = None
+        self._lock = threading.Lock()
+        self._token = uuid4().hex
+
+    def _reservation_key(self, port: int) -> str:
+        return f"port_reservation:{self.panel_id}:{port}"
+
+    def sync(self, snapshot):
+        """بازسازی bitmap از روی snapshot لیست inbound ها (فقط وقتی snapshot جدیدی دریافت شده باشد)"""
+        if snapshot is self._source:
+            return
+        self.rebuild(snapshot.used_ports())
+        self._source = snapshot
+
+    def rebuild(self, used_ports: Iterable[int]):
+        used = bytearray(self.end - self.start + 1)
+        for port in used_ports:
+            if isinstance(port, int) and self.start <= port <= self.end:
+                used[port - self.start] = 1
+        with self._lock:
+            self._used = used
+            self._cursor = 0
+
+    def _reserve(self, port: int) -> bool:
+        try:
+            from .redis_queue import redis_queue
+            return bool(redis_queue.redis_client.set(self._reservation_key(port), self._token, nx=True, ex=XUI_PORT_RESERVATION_TTL))
+        except Exception as e:
+            # Without Redis we can still avoid collisions inside this process
+            logger.error(f"Could not reserve port {port} for panel {self.panel_id} in Redis: {e}")
+            return True
+
+    def allocate(self) -> int:
+        """اولین پورت آزاد را پیدا، رزرو و برمی‌گرداند"""
+        with self._lock:
+            index = self._cursor
+            wrapped = False
+            while True:
+                index = self._used.find(0, index)
+                if index == -1:
+                    if wrapped:
+                        break
+                    # Wrap around to the start of the range
+                    wrapped = True
+                    index = 0
+                    continue
+                port = self.start + index
+                self._used[index] = 1
+                if self._reserve(port):
+                    self._cursor = index + 1
+                    return port
+                # Reserved by another worker: it stays marked as used here
+                index += 1
+        raise Exception(f"No free port left in range {self.start}-{self.end} on panel {self.panel_id}")
+
+    def release(self, port: Optional[int]):
+        """آزاد کردن پورت (بعد از حذف inbound یا شکست در ساخت آن)"""
+        if not isinstance(port, int) or not (self.start <= port <= self.end):
+            return
+        with self._lock:
+            self._used[port - self.start] = 0
+        try:
+            from .redis_queue import redis_queue
+            redis_queue.redis_client.delete(self._reservation_key(port))
+        except Exception as e:
+            logger.error(f"Could not release port {port} for panel {self.panel_id} in Redis: {e}")
+
+_allocators: Dict[int, PortAllocator] = {}
+_allocators_lock = threading.Lock()
+
+def get_port_allocator(panel_id: int) -> PortAllocator:
+    with _allocators_lock:
+        allocator = _allocators.get(panel_id)
+        if allocator is None:
+            allocator = PortAllocator(panel_id)
+            _allocators[panel_id] = allocator
+        return allocator
@@ -0,0 +1,145 @@
+# xui_multi/provisioning.py
+
+import os
+import asyncio
+import logging
+from uuid import uuid4
+from typing import Dict, Any
+
+from .models import ManagedService, Panel, PanelConfig
+from .port_allocator import get_port_allocator
+
+logger = logging.getLogger(__name__)
+
+# "inbound": یک inbound اختصاصی برای هر سرویس در هر پنل (حالت پیش‌فرض)
+# "shared":  هر سرویس یک کلاینت در چند inbound اشتراکی هر پروتکل
+XUI_PROVISIONING_MODE = os.getenv("XUI_PROVISIONING_MODE", "inbound").lower()
+
+def shared_mode() -> bool:
+    return XUI_PROVISIONING_MODE == "shared"
+
+def service_spec(service: ManagedService) -> Dict[str, Any]:
+    """مقادیر لازم برای ساخت کانفیگ، جدا از session دیتابیس (برای استفاده در fan-out)"""
+    return {
+        "name": service.name,
+        "protocol": service.protocol,
+        "expiry_days": (service.end_date - service.start_date).days,
+        "limit_gb": service.data_limit_gb,
+    }
+
+def _unique_remark(panel: Panel, spec: Dict[str, Any]) -> str:
+    # Create unique remark to prevent duplicates
+    return f"{panel.remark_prefix}-{spec['name']}-{str(uuid4())[:8]}"
+
+def _check_protocol(spec: Dict[str, Any]):
+    if spec["protocol"] not in ("vless", "shadowsocks"):
+        raise ValueError(f"Unsupported protocol: {spec['protocol']}")
+
+def provision_service(client, panel: Panel, spec: Dict[str, Any]) -> Dict[str, Any]:
+    """ساخت کانفیگ سرویس روی یک پنل؛ خروجی شامل link و inbound_id (و در حالت اشتراکی client_id/client_email)"""
+    _check_protocol(spec)
+    remark = _unique_remark(panel, spec)
+    allocator = get_port_allocator(panel.id)
+    allocator.sync(client.inbound_snapshot())
+    if shared_mode():
+        expiry_time_ms, total_gb_bytes = client.limits(spec["expiry_days"], spec["limit_gb"], None, None)
+        return client.create_shared_client(spec["protocol"], panel.remark_prefix, panel.domain, remark, expiry_time_ms, total_gb_bytes, allocate_port=allocator.allocate)
+
+    # Find available port
+    port = allocator.allocate()
+    create = client.create_vless_inbound if spec["protocol"] == "vless" else client.create_shadowsocks_inbound
+    try:
+        return create(remark=remark, domain=panel.domain, port=port, expiry_days=spec["expiry_days"], limit_gb=spec["limit_gb"])
+    except Exception:
+        allocator.release(port)
+        raise
+
+async def provision_service_async(client, panel: Panel, spec: Dict[str, Any]) -> Dict[str, Any]:
+    """نسخه async از provision_service برای AsyncXUIClient"""
+    _check_protocol(spec)
+    remark = _unique_remark(panel, spec)
+    allocator = get_port_allocator(panel.id)
+    allocator.sync(await client.inbound_snapshot())
+    if shared_mode():
+        expiry_time_ms, total_gb_bytes = client.limits(spec["expiry_days"], spec["limit_gb"], None, None)
+        return await client.create_shared_client(spec["protocol"], panel.remark_prefix, panel.domain, remark, expiry_time_ms, total_gb_bytes, allocate_port=allocator.allocate)
+
+    # Port reservations are Redis calls; keep them off the event loop
+    port = await asyncio.to_thread(allocator.allocate)
+    create = client.create_vless_inbound if spec["protocol"] == "vless" else client.create_shadowsocks_inbound
+    try:
+        return await create(remark=remark, domain=panel.domain, port=port, expiry_days=spec["expiry_days"], limit_gb=spec["limit_gb"])
+    except Exception:
+        await asyncio.to_thread(allocator.release, port)
+        raise
+
+def new_panel_config(service_id: int, panel_id: int, result: Dict[str, Any]) -> PanelConfig:
+    return PanelConfig(
+        managed_service_id=service_id,
+        panel_id=panel_id,
+        panel_inbound_id=result["inbound_id"],
+        config_link=result["link"],
+        client_id=result.get("client_id"),
+        client_email=result.get("client_email"),
+    )
+
+def is_shared_config(config: PanelConfig) -> bool:
+    return config.client_id is not None
+
+def update_panel_config(client, config: PanelConfig, expiry_days: int, limit_gb: float) -> bool:
+    if is_shared_config(config):
+        expiry_time_ms, total_gb_bytes = client.limits(expiry_days, limit_gb, None, None)
+        return client.update_client_limits(config.panel_inbound_id, config.client_id, config.client_email, total_gb_bytes, expiry_time_ms)
+    return client.update_inbound_simple(inbound_id=config.panel_inbound_id, expiry_days=expiry_days, limit_gb=limit_gb)
+
+async def update_panel_config_async(client, config: PanelConfig, expiry_days: int, limit_gb: float) -> bool:
+    """نسخه async از update_panel_config برای AsyncXUIClient"""
+    if is_shared_config(config):
+        expiry_time_ms, total_gb_bytes = client.limits(expiry_days, limit_gb, None, None)
+        return await client.update_client_limits(config.panel_inbound_id, config.client_id, config.client_email, total_gb_bytes, expiry_time_ms)
+    return await client.update_inbound_simple(inbound_id=config.panel_inbound_id, expiry_days=expiry_days, limit_gb=limit_gb)
+
+def _group_configs(configs):
+    """تفکیک کانفیگ‌ها به inbound های اختصاصی و کلاینت‌های اشتراکی ({email: client_key} به ازای هر inbound)"""
+    inbound_ids = []
+    shared: Dict[int, Dict[str, str]] = {}
+    for config in configs:
+        if is_shared_config(config):
+            shared.setdefault(config.panel_inbound_id, {})[config.client_email] = config.client_id
+        else:
+            inbound_ids.append(config.panel_inbound_id)
+    return inbound_ids, shared
+
+def disable_panel_configs(client, configs) -> int:
+    """
+    غیرفعال کردن گروهی کانفیگ‌های یک پنل: inbound های اختصاصی با یک snapshot مشترک
+    و کلاینت‌های اشتراکی با updateClient هر کلاینت. خروجی: تعداد کانفیگ‌های غیرفعال شده.
+    """
+    inbound_ids, shared = _group_configs(configs)
+    count = len(client.disable_inbounds(inbound_ids)) if inbound_ids else 0
+    for inbound_id, clients in shared.items():
+        try:
+            count += client.disable_clients(inbound_id, clients)
+        except Exception as e:
+            logger.error(f"Error disabling clients of inbound {inbound_id}: {e}")
+    return count
+
+async def disable_panel_configs_async(client, configs) -> int:
+    inbound_ids, shared = _group_configs(configs)
+    count = len(await client.disable_inbounds(inbound_ids)) if inbound_ids else 0
+    for inbound_id, clients in shared.items():
+        try:
+            count += await client.disable_clients(inbound_id, clients)
+        except Exception as e:
+            logger.error(f"Error disabling clients of inbound {inbound_id}: {e}")
+    return count
+
+def delete_panel_config(client, config: PanelConfig) -> bool:
+    if is_shared_config(config):
+        return client.delete_client(config.panel_inbound_id, config.client_id, config.client_email)
+    # پورت قبل از حذف خوانده می‌شود تا بعد از حذف inbound آزاد شود
+    port = client.inbound_port(config.panel_inbound_id)
+    result = client.delete_inbound(config.panel_inbound_id)
+    if port:
+        get_port_allocator(config.panel_id).release(port)
+    return result
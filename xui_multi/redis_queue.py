@@ -1,10 +1,16 @@
 import redis
 import json
+import asyncio
+import random
 import threading
 import time
+import socket
 import logging
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
-from typing import Dict, Any, Callable
+from typing import Dict, Any, Awaitable, Callable, Iterable, List, Optional
+from uuid import uuid4
 import os
 
 # Configure logging
@@ -15,37 +21,218 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Seconds a popped task stays leased to its worker without a heartbeat before it is put back on the queue
+XUI_TASK_VISIBILITY_TIMEOUT = float(os.getenv("XUI_TASK_VISIBILITY_TIMEOUT", "60"))
+# How often running tasks' leases are extended and expired leases are reaped
+XUI_TASK_HEARTBEAT_INTERVAL = float(os.getenv("XUI_TASK_HEARTBEAT_INTERVAL", str(XUI_TASK_VISIBILITY_TIMEOUT / 3)))
+# How often delayed retries that are due are moved back to their queue
+XUI_TASK_DELAY_POLL = float(os.getenv("XUI_TASK_DELAY_POLL", "1"))
+
+# Worker pool kinds: threads in the worker process, a process pool for CPU-heavy tasks,
+# or coroutines on the process's single asyncio event loop for I/O-bound tasks
+POOL_THREAD = "thread"
+POOL_PROCESS = "process"
+POOL_ASYNC = "async"
+
+# hash task_name -> worker count; written by the API and applied by every worker process at runtime
+CONCURRENCY_KEY = "worker_concurrency"
+# Each worker process publishes its pools here (expires when the process is gone)
+WORKER_STATUS_PREFIX = "worker_process:"
+
+# Coalescing modes for a task whose coalesce_key matches a task still waiting in the queue
+COALESCE_DROP = "drop"      # keep the queued task, drop the new one (periodic sweeps)
+COALESCE_REPLACE = "replace"  # the new data replaces the queued task's data
+COALESCE_MERGE = "merge"    # the new fields are merged into the queued task's data (last writer wins per field)
+
+# Wake-up tokens kept per queue for idle workers blocked in BLPOP
+WAKE_LIST_LIMIT = 1000
+
+# KEYS: queue, new task hash, coalesce key, wake-up list
+# ARGV: task_id, priority, mode, data json, task_name, created_at, coalesce_key
+ENQUEUE_COALESCED_SCRIPT = """
+local existing = redis.call('GET', KEYS[3])
+if existing and redis.call('ZSCORE', KEYS[1], existing) then
+    if ARGV[3] == 'replace' or ARGV[3] == 'merge' then
+        local data = ARGV[4]
+        if ARGV[3] == 'merge' then
+            local current = redis.call('HGET', 'task:' .. existing, 'data') or '{}'
+            local merged = cjson.decode(current)
+            for field, value in pairs(cjson.decode(ARGV[4])) do
+                merged[field] = value
+            end
+            -- cjson encodes an empty table as [], keep the stored JSON object instead
+            if next(merged) == nil then
+                data = current
+            else
+                data = cjson.encode(merged)
+            end
+        end
+        redis.call('HSET', 'task:' .. existing, 'data', data, 'updated_at', ARGV[6])
+    end
+    return existing
+end
+redis.call('HSET', KEYS[2], 'name', ARGV[5], 'task_type', ARGV[5], 'data', ARGV[4], 'priority', ARGV[2],
+    'created_at', ARGV[6], 'status', 'pending', 'coalesce_key', ARGV[7])
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+redis.call('SET', KEYS[3], ARGV[1])
+redis.call('LPUSH', KEYS[4], ARGV[1])
+redis.call('LTRIM', KEYS[4], 0, ARGV[8])
+return ARGV[1]
+"""
+
+# Pops the highest priority task, leases it in the processing set until the visibility deadline,
+# marks it processing and returns {task_id, task hash fields} in one round-trip.
+# A task with a coalesce_key releases it so later tasks with the same key start a new queued task.
+# KEYS: queue, processing set; ARGV: task_name, started_at, lease deadline
+DEQUEUE_SCRIPT = """
+local popped = redis.call('ZPOPMAX', KEYS[1])
+if #popped == 0 then
+    return nil
+end
+local task_id = popped[1]
+redis.call('ZADD', KEYS[2], ARGV[3], task_id)
+local task_key = 'task:' .. task_id
+local fields = redis.call('HGETALL', task_key)
+if #fields == 0 then
+    return {task_id, fields}
+end
+for i = 1, #fields, 2 do
+    if fields[i] == 'coalesce_key' and fields[i + 1] ~= '' then
+        local coalesce_key = 'coalesce:' .. ARGV[1] .. ':' .. fields[i + 1]
+        if redis.call('GET', coalesce_key) == task_id then
+            redis.call('DEL', coalesce_key)
+        end
+    end
+end
+redis.call('HSET', task_key, 'status', 'processing', 'started_at', ARGV[2])
+redis.call('HINCRBY', task_key, 'attempts', 1)
+return {task_id, fields}
+"""
+
+# Moves tasks whose score is due from a sorted set (expired leases in processing:{name}, due retries
+# in delayed:{name}) back on the queue as pending.
+# KEYS: queue, source set, wake-up list; ARGV: now, batch size, requeued_at, counter field ('' for none)
+REQUEUE_DUE_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, task_id in ipairs(due) do
+    redis.call('ZREM', KEYS[2], task_id)
+    local task_key = 'task:' .. task_id
+    if redis.call('EXISTS', task_key) == 1 then
+        local priority = redis.call('HGET', task_key, 'priority') or '0'
+        redis.call('HSET', task_key, 'status', 'pending', 'requeued_at', ARGV[3])
+        if ARGV[4] ~= '' then
+            redis.call('HINCRBY', task_key, ARGV[4], 1)
+        end
+        redis.call('ZADD', KEYS[1], priority, task_id)
+        redis.call('LPUSH', KEYS[3], task_id)
+    end
+end
+return #due
+"""
+
+class RetryableTaskError(Exception):
+    """
+    خطای موقتی که تسک باید طبق RetryPolicy دوباره اجرا شود.
+    retry_data (اختیاری) قبل از تلاش بعدی در داده تسک ادغام می‌شود (مثلاً فقط بخش‌هایی که انجام نشده‌اند)؛
+    با replace_data=True به جای ادغام، کل داده تسک با آن جایگزین می‌شود.
+    """
+    def __init__(self, message: str, retry_data: Optional[Dict[str, Any]] = None, replace_data: bool = False):
+        super().__init__(message)
+        self.retry_data = retry_data
+        self.replace_data = replace_data
+
+class RetryPolicy:
+    """
+    سیاست تلاش مجدد یک نوع تسک: حداکثر تعداد اجرا، backoff نمایی با jitter و خطاهایی که موقتی حساب می‌شوند.
+    تسکی که تلاش‌هایش تمام شود (یا خطای غیرموقتی بدهد) به dead-letter queue منتقل می‌شود.
+    """
+    def __init__(self, max_attempts: int = 5, base_delay: float = 5, max_delay: float = 300, retry_on: tuple = ()):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # A crashed pool process is transient: the task is re-run on a fresh pool
+        self.retry_on = (RetryableTaskError, BrokenProcessPool) + tuple(retry_on)
+
+    def is_retryable(self, error: Exception) -> bool:
+        return isinstance(error, self.retry_on)
+
+    def delay(self, attempt: int) -> float:
+        """Backoff before the next run after `attempt` failed runs, with jitter so retries of one outage spread out"""
+        backoff = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return random.uniform(backoff / 2, backoff)
+
+def new_task_id(task_name: str) -> str:
+    """Unique task id; the millisecond timestamp keeps ids readable and roughly ordered"""
+    return f"{task_name}_{int(datetime.now().timestamp() * 1000)}_{uuid4().hex[:12]}"
+
 class RedisQueue:
     def __init__(self, host='localhost', port=6379, db=0):
         """Initialize Redis queue system"""
         self.redis_client = redis.Redis(host=host, port=port, db=db, decode_responses=True)
         self.workers = {}
+        # Worker threads per task type in this process
+        self.concurrency = {}
         self.running = False
+        self._enqueue_coalesced = self.redis_client.register_script(ENQUEUE_COALESCED_SCRIPT)
+        self._dequeue = self.redis_client.register_script(DEQUEUE_SCRIPT)
+        self._requeue_due = self.redis_client.register_script(REQUEUE_DUE_SCRIPT)
+        # Retry policy per task type (tasks without one are just marked failed)
+        self.retry_policies = {}
+        # Pool kind and running threads (slot -> thread) per task type, process pools of POOL_PROCESS types
+        self.pools = {}
+        self.worker_threads = {}
+        self.process_pools = {}
+        self.process_pools_lock = threading.Lock()
+        # Async runtime: coroutine function, dispatcher and running coroutines per POOL_ASYNC type, on one event loop
+        self.async_workers = {}
+        self.async_dispatchers = {}
+        self.async_running = {}
+        self.async_loop = None
+        self.async_thread = None
+        # Coroutine functions run on the event loop when the runtime stops (closing async DB/HTTP pools)
+        self.async_cleanups = []
+        self.process_token = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+        self.started_at = None
+        # Tasks leased by this process: task_id -> task_name (extended by the heartbeat thread)
+        self.in_flight = {}
+        self.lease_thread = None
+        
+    def _add_task(self, pipe, task_name: str, task_id: str, task_data: Dict[str, Any], priority: int, created_at: str):
+        """Queue commands of one task on a pipeline"""
+        # Store task data separately
+        pipe.hset(f"task:{task_id}", mapping={
+            'name': task_name,
+            'task_type': task_name,  # Store task type for filtering
+            'data': json.dumps(task_data),
+            'priority': str(priority),
+            'created_at': created_at,
+            'status': 'pending'
+        })
+        
+        # Add to queue with priority
+        pipe.zadd(f"queue:{task_name}", {task_id: priority})
         
-    def enqueue_task(self, task_name: str, task_id: str, task_data: Dict[str, Any], priority: int = 0):
-        """Add task to queue"""
+        # Wake up one idle worker
+        pipe.lpush(f"queue_wake:{task_name}", task_id)
+    
+    def enqueue_task(self, task_name: str, task_id: str, task_data: Dict[str, Any], priority: int = 0,
+                     coalesce_key: Optional[str] = None, coalesce: str = COALESCE_DROP):
+        """
+        Add task to queue.
+        With coalesce_key, a task with the same key that is still waiting in the queue absorbs the new one
+        (see COALESCE_*) and its id is returned instead of task_id.
+        """
         try:
-            task = {
-                'id': task_id,
-                'name': task_name,
-                'data': task_data,
-                'priority': priority,
-                'created_at': datetime.now().isoformat(),
-                'status': 'pending'
-            }
+            if coalesce_key is not None:
+                return self._enqueue_coalesced(
+                    keys=[f"queue:{task_name}", f"task:{task_id}", f"coalesce:{task_name}:{coalesce_key}", f"queue_wake:{task_name}"],
+                    args=[task_id, priority, coalesce, json.dumps(task_data), task_name, datetime.now().isoformat(), coalesce_key, WAKE_LIST_LIMIT - 1],
+                )
             
-            # Add to queue with priority
-            self.redis_client.zadd(f"queue:{task_name}", {task_id: priority})
-            
-            # Store task data separately
-            self.redis_client.hset(f"task:{task_id}", mapping={
-                'name': task_name,
-                'task_type': task_name,  # Store task type for filtering
-                'data': json.dumps(task_data),
-                'priority': str(priority),
-                'created_at': task['created_at'],
-                'status': 'pending'
-            })
+            pipe = self.redis_client.pipeline()
+            self._add_task(pipe, task_name, task_id, task_data, priority, datetime.now().isoformat())
+            pipe.ltrim(f"queue_wake:{task_name}", 0, WAKE_LIST_LIMIT - 1)
+            pipe.execute()
             
             return task_id
             
@@ -53,78 +240,437 @@ class RedisQueue:
             logger.error(f"Error enqueueing task {task_name}: {e}")
             raise
     
+    def enqueue_many(self, task_name: str, tasks: Iterable[Dict[str, Any]], priority: int = 0) -> List[str]:
+        """Add a batch of tasks of one type in a single pipeline (one round-trip); returns the new task ids"""
+        try:
+            created_at = datetime.now().isoformat()
+            task_ids = []
+            pipe = self.redis_client.pipeline()
+            for task_data in tasks:
+                task_id = new_task_id(task_name)
+                self._add_task(pipe, task_name, task_id, task_data, priority, created_at)
+                task_ids.append(task_id)
+            if not task_ids:
+                return []
+            pipe.ltrim(f"queue_wake:{task_name}", 0, WAKE_LIST_LIMIT - 1)
+            pipe.execute()
+            return task_ids
+            
+        except Exception as e:
+            logger.error(f"Error enqueueing {task_name} tasks: {e}")
+            raise
+    
     def dequeue_task(self, task_name: str):
-        """Get next task from queue"""
+        """Atomically pop the highest priority task (already marked processing), or None if the queue is empty"""
         try:
-            # Get highest priority task
-            tasks = self.redis_client.zrevrange(f"queue:{task_name}", 0, 0, withscores=True)
-            if tasks:
-                task_id, priority = tasks[0]
-                
-                # Get task data from hash
-                task_data = self.redis_client.hgetall(f"task:{task_id}")
-                if task_data:
-                    try:
-                        data_json = task_data.get('data', '{}')
-                        if data_json:
-                            task = {
-                                'id': task_id,
-                                'name': task_data.get('name', task_name),
-                                'data': json.loads(data_json),
-                                'priority': int(task_data.get('priority', 0)),
-                                'created_at': task_data.get('created_at', ''),
-                                'status': task_data.get('status', 'pending')
-                            }
-                            
-                            # Remove from queue
-                            self.redis_client.zrem(f"queue:{task_name}", task_id)
-                            
-                            return task
-                        else:
-                            # Remove invalid task from queue
-                            self.redis_client.zrem(f"queue:{task_name}", task_id)
-                            logger.warning(f"Removed invalid task {task_id} from queue")
-                    except json.JSONDecodeError as e:
-                        # Remove invalid task from queue
-                        self.redis_client.zrem(f"queue:{task_name}", task_id)
-                        logger.warning(f"Removed task {task_id} with invalid JSON: {e}")
-            return None
+            popped = self._dequeue(
+                keys=[f"queue:{task_name}", f"processing:{task_name}"],
+                args=[task_name, datetime.now().isoformat(), time.time() + XUI_TASK_VISIBILITY_TIMEOUT],
+            )
+            if not popped:
+                return None
+            task_id, fields = popped
+            task_data = dict(zip(fields[::2], fields[1::2]))
+            if not task_data.get('data'):
+                self.ack_task(task_name, task_id)
+                logger.warning(f"Removed invalid task {task_id} from queue")
+                return None
+            try:
+                return {
+                    'id': task_id,
+                    'name': task_data.get('name', task_name),
+                    'data': json.loads(task_data['data']),
+                    'priority': int(task_data.get('priority', 0)),
+                    'created_at': task_data.get('created_at', ''),
+                    'status': 'processing',
+                    'attempts': int(task_data.get('attempts', 0)) + 1
+                }
+            except json.JSONDecodeError as e:
+                self.ack_task(task_name, task_id)
+                logger.warning(f"Removed task {task_id} with invalid JSON: {e}")
+                return None
             
         except Exception as e:
             logger.error(f"Error dequeuing task {task_name}: {e}")
             return None
     
-    def register_worker(self, task_name: str, worker_func: Callable):
-        """Register a worker function for a task type"""
+    def ack_task(self, task_name: str, task_id: str, status: Optional[Dict[str, str]] = None):
+        """Release the lease of a finished task, storing its final status in the same round-trip"""
+        self.in_flight.pop(task_id, None)
+        pipe = self.redis_client.pipeline()
+        if status:
+            pipe.hset(f"task:{task_id}", mapping=status)
+        pipe.zrem(f"processing:{task_name}", task_id)
+        pipe.execute()
+    
+    def extend_leases(self):
+        """Heartbeat: push the visibility deadline of every task this process is running"""
+        in_flight = list(self.in_flight.items())
+        if not in_flight:
+            return
+        deadline = time.time() + XUI_TASK_VISIBILITY_TIMEOUT
+        pipe = self.redis_client.pipeline()
+        for task_id, task_name in in_flight:
+            pipe.zadd(f"processing:{task_name}", {task_id: deadline}, xx=True)
+        pipe.execute()
+    
+    def reap_expired_leases(self, batch_size: int = 100) -> int:
+        """Put tasks whose lease expired back on their queue; safe to run from every worker process"""
+        recovered = 0
+        for task_name in list(self.workers):
+            count = self._requeue_due(
+                keys=[f"queue:{task_name}", f"processing:{task_name}", f"queue_wake:{task_name}"],
+                args=[time.time(), batch_size, datetime.now().isoformat(), 'recoveries'],
+            )
+            if count:
+                logger.warning(f"Recovered {count} {task_name} tasks with expired leases")
+                recovered += count
+        return recovered
+    
+    def promote_delayed_tasks(self, batch_size: int = 100) -> int:
+        """Move retries whose backoff is over from delayed:{name} back to their queue"""
+        promoted = 0
+        for task_name in list(self.workers):
+            promoted += self._requeue_due(
+                keys=[f"queue:{task_name}", f"delayed:{task_name}", f"queue_wake:{task_name}"],
+                args=[time.time(), batch_size, datetime.now().isoformat(), ''],
+            )
+        return promoted
+    
+    def _fail_task(self, task_name: str, task: Dict[str, Any], error: Exception):
+        """Schedule a retry with backoff, or move the task to the dead-letter queue once it cannot be retried"""
+        task_id = task['id']
+        status = {
+            'failed_at': datetime.now().isoformat(),
+            'error': str(error)
+        }
+        policy = self.retry_policies.get(task_name)
+        if policy is None and isinstance(error, BrokenProcessPool):
+            # Keep the lease without heartbeats; reap_expired_leases puts the task back on the queue
+            self.in_flight.pop(task_id, None)
+            logger.warning(f"Task {task_id} lost its pool process, it is re-queued when its lease expires")
+            return
+        if policy is None:
+            self.ack_task(task_name, task_id, {'status': 'failed', **status})
+            return
+        
+        self.in_flight.pop(task_id, None)
+        pipe = self.redis_client.pipeline()
+        if policy.is_retryable(error) and task['attempts'] < policy.max_attempts:
+            delay = policy.delay(task['attempts'])
+            status.update({'status': 'retrying', 'next_attempt_at': datetime.fromtimestamp(time.time() + delay).isoformat()})
+            if getattr(error, 'retry_data', None):
+                data = error.retry_data if getattr(error, 'replace_data', False) else {**task['data'], **error.retry_data}
+                status['data'] = json.dumps(data)
+            pipe.zadd(f"delayed:{task_name}", {task_id: time.time() + delay})
+            logger.warning(f"Task {task_id} failed (attempt {task['attempts']}/{policy.max_attempts}), retrying in {delay:.1f}s")
+        else:
+            status['status'] = 'dead'
+            pipe.zadd(f"dead:{task_name}", {task_id: time.time()})
+            logger.error(f"Task {task_id} moved to dead-letter queue after {task['attempts']} attempts")
+        pipe.hset(f"task:{task_id}", mapping=status)
+        pipe.zrem(f"processing:{task_name}", task_id)
+        pipe.execute()
+    
+    def get_dead_tasks(self, task_name: str, limit: int = 100):
+        """Tasks in the dead-letter queue of a task type, most recent first"""
+        task_ids = self.redis_client.zrevrange(f"dead:{task_name}", 0, limit - 1)
+        pipe = self.redis_client.pipeline()
+        for task_id in task_ids:
+            pipe.hgetall(f"task:{task_id}")
+        return [{'id': task_id, **info} for task_id, info in zip(task_ids, pipe.execute())]
+    
+    def replay_dead_tasks(self, task_name: str, task_ids: Optional[List[str]] = None) -> int:
+        """Put dead tasks (all of them when task_ids is None) back on the queue with a fresh attempt budget"""
+        if task_ids is None:
+            task_ids = self.redis_client.zrange(f"dead:{task_name}", 0, -1)
+        replayed = 0
+        for task_id in task_ids:
+            if not self.redis_client.zrem(f"dead:{task_name}", task_id):
+                continue
+            priority = self.redis_client.hget(f"task:{task_id}", 'priority') or 0
+            pipe = self.redis_client.pipeline()
+            pipe.hset(f"task:{task_id}", mapping={'status': 'pending', 'attempts': 0, 'replayed_at': datetime.now().isoformat()})
+            pipe.zadd(f"queue:{task_name}", {task_id: float(priority)})
+            pipe.lpush(f"queue_wake:{task_name}", task_id)
+            pipe.execute()
+            replayed += 1
+        return replayed
+    
+    def purge_dead_tasks(self, task_name: str, task_ids: Optional[List[str]] = None) -> int:
+        """Delete dead tasks (all of them when task_ids is None) together with their task hashes"""
+        if task_ids is None:
+            task_ids = self.redis_client.zrange(f"dead:{task_name}", 0, -1)
+        if not task_ids:
+            return 0
+        pipe = self.redis_client.pipeline()
+        pipe.zrem(f"dead:{task_name}", *task_ids)
+        pipe.delete(*[f"task:{task_id}" for task_id in task_ids])
+        return pipe.execute()[0]
+    
+    def start_lease_keeper(self):
+        """Start the thread that promotes due retries, sends heartbeats for running tasks and reaps expired leases"""
+        def lease_loop():
+            last_heartbeat = 0.0
+            while self.running:
+                try:
+                    self.promote_delayed_tasks()
+                    self.apply_concurrency_overrides()
+                    if time.time() - last_heartbeat >= XUI_TASK_HEARTBEAT_INTERVAL:
+                        last_heartbeat = time.time()
+                        self.extend_leases()
+                        self.reap_expired_leases()
+                        self.publish_worker_status()
+                except Exception as e:
+                    logger.error(f"Lease keeper error: {e}")
+                time.sleep(XUI_TASK_DELAY_POLL)
+        
+        self.lease_thread = threading.Thread(target=lease_loop, daemon=True)
+        self.lease_thread.start()
+        return self.lease_thread
+    
+    def wait_for_task(self, task_name: str, timeout: int = 1):
+        """Block until a task of this type is enqueued (or timeout seconds pass so the worker can check running)"""
+        self.redis_client.blpop([f"queue_wake:{task_name}"], timeout=timeout)
+    
+    def register_worker(self, task_name: str, worker_func: Callable, concurrency: int = 1, retry: Optional[RetryPolicy] = None,
+                        pool: str = POOL_THREAD, async_func: Optional[Callable[..., Awaitable[Any]]] = None):
+        """
+        Register a worker function for a task type.
+        async_func is the coroutine version used when the type runs on the async runtime (POOL_ASYNC).
+        concurrency and pool can be overridden per type with XUI_WORKERS_<TASK_NAME> and XUI_WORKER_POOL_<TASK_NAME>.
+        """
         self.workers[task_name] = worker_func
-        logger.info(f"Worker registered for task: {task_name}")
+        self.concurrency[task_name] = max(0, int(os.getenv(f"XUI_WORKERS_{task_name.upper()}", concurrency)))
+        self.pools[task_name] = os.getenv(f"XUI_WORKER_POOL_{task_name.upper()}", pool)
+        if async_func is not None:
+            self.async_workers[task_name] = async_func
+        if self.pools[task_name] == POOL_ASYNC and task_name not in self.async_workers:
+            logger.warning(f"No async function for task {task_name}; running it on threads")
+            self.pools[task_name] = POOL_THREAD
+        if retry is not None:
+            self.retry_policies[task_name] = retry
+        logger.info(f"Worker registered for task: {task_name} ({self.concurrency[task_name]} {self.pools[task_name]} workers)")
+    
+    def _run_task(self, task_name: str, task_data: Dict[str, Any]):
+        """Run the worker function in this thread, or in the type's process pool"""
+        if self.pools.get(task_name) == POOL_PROCESS:
+            pool = self.process_pools[task_name]
+            try:
+                return pool.submit(self.workers[task_name], **task_data).result()
+            except BrokenProcessPool:
+                # A child process died; the pool stays unusable until it is replaced
+                self._replace_process_pool(task_name, pool)
+                raise
+        return self.workers[task_name](**task_data)
+    
+    def _replace_process_pool(self, task_name: str, broken: ProcessPoolExecutor):
+        """Swap a broken process pool for a new one (once, even when several workers saw it break)"""
+        with self.process_pools_lock:
+            if self.process_pools.get(task_name) is not broken:
+                return
+            size = self.concurrency.get(task_name, 1)
+            if size > 0 and self.running:
+                self.process_pools[task_name] = ProcessPoolExecutor(max_workers=size)
+            else:
+                del self.process_pools[task_name]
+            logger.error(f"Process pool of {task_name} broke, replaced it")
+        broken.shutdown(wait=False)
+    
+    def register_async_cleanup(self, cleanup: Callable[[], Awaitable[Any]]):
+        """Coroutine function awaited on the async runtime's event loop when the workers stop"""
+        if cleanup not in self.async_cleanups:
+            self.async_cleanups.append(cleanup)
+    
+    def _start_async_runtime(self):
+        if self.async_loop is None:
+            self.async_loop = asyncio.new_event_loop()
+            self.async_thread = threading.Thread(target=self.async_loop.run_forever, daemon=True)
+            self.async_thread.start()
+            logger.info("Started async worker runtime")
+    
+    def _stop_async_runtime(self):
+        """Wait for the dispatchers to exit, run the cleanups and stop the event loop"""
+        loop = self.async_loop
+        if loop is None:
+            return
+        
+        async def shutdown():
+            dispatchers = [asyncio.wrap_future(dispatcher) for dispatcher in self.async_dispatchers.values() if not dispatcher.done()]
+            if dispatchers:
+                await asyncio.wait(dispatchers, timeout=5)
+            for cleanup in self.async_cleanups:
+                try:
+                    await cleanup()
+                except Exception as e:
+                    logger.error(f"Error in async runtime cleanup: {e}")
+        
+        try:
+            asyncio.run_coroutine_threadsafe(shutdown(), loop).result(timeout=15)
+        except Exception as e:
+            logger.error(f"Error stopping async worker runtime: {e}")
+        loop.call_soon_threadsafe(loop.stop)
+        self.async_loop = None
+        self.async_thread = None
+        self.async_dispatchers = {}
+        self.async_running = {}
+    
+    async def _run_async_task(self, task_name: str, task: Dict[str, Any]):
+        try:
+            result = await self.async_workers[task_name](**task['data'])
+            await asyncio.to_thread(self.ack_task, task_name, task['id'], {
+                'status': 'completed',
+                'completed_at': datetime.now().isoformat(),
+                'result': json.dumps(result) if result else ''
+            })
+            logger.info(f"Completed task: {task['id']}")
+        except Exception as e:
+            logger.error(f"Error executing task {task['id']}: {e}")
+            await asyncio.to_thread(self._fail_task, task_name, task, e)
+    
+    async def _async_dispatch(self, task_name: str):
+        """
+        Dispatcher of one POOL_ASYNC task type: keeps up to concurrency tasks of the type running on the event loop
+        (a semaphore whose size follows set_concurrency). Queue bookkeeping is a single Redis round-trip and runs
+        in the default executor so the loop never blocks on it.
+        """
+        running = self.async_running.setdefault(task_name, set())
+        logger.info(f"Starting async dispatcher for task: {task_name}")
+        while self.running:
+            try:
+                if len(running) >= self.concurrency.get(task_name, 1):
+                    # Full: wait for a slot (or a resize, checked at least every second)
+                    await asyncio.wait(running, timeout=1, return_when=asyncio.FIRST_COMPLETED) if running else await asyncio.sleep(1)
+                    continue
+                task = await asyncio.to_thread(self.dequeue_task, task_name)
+                if task is None:
+                    await asyncio.to_thread(self.wait_for_task, task_name)
+                    continue
+                logger.info(f"Starting task: {task['id']}")
+                self.in_flight[task['id']] = task_name
+                job = asyncio.create_task(self._run_async_task(task_name, task))
+                running.add(job)
+                job.add_done_callback(running.discard)
+            except Exception as e:
+                logger.error(f"Async dispatcher error for {task_name}: {e}")
+                await asyncio.sleep(5)
+        if running:
+            # Let running tasks finish; unfinished ones are recovered from their leases
+            await asyncio.wait(running, timeout=5)
+        logger.info(f"Stopped async dispatcher for task: {task_name}")
+    
+    def _dispatcher_alive(self, task_name: str) -> bool:
+        dispatcher = self.async_dispatchers.get(task_name)
+        return dispatcher is not None and not dispatcher.done()
+    
+    def _scale_workers(self, task_name: str) -> List[threading.Thread]:
+        """Start missing worker threads of a task type; threads above the configured count exit after their current task"""
+        size = self.concurrency.get(task_name, 1)
+        if self.pools.get(task_name) == POOL_ASYNC:
+            # One dispatcher per type; its concurrency limit is read on every iteration
+            self._start_async_runtime()
+            if not self._dispatcher_alive(task_name):
+                self.async_dispatchers[task_name] = asyncio.run_coroutine_threadsafe(self._async_dispatch(task_name), self.async_loop)
+            return []
+        if self.pools.get(task_name) == POOL_PROCESS and size > 0:
+            with self.process_pools_lock:
+                current = self.process_pools.get(task_name)
+                if current is None or current._max_workers != size:
+                    self.process_pools[task_name] = ProcessPoolExecutor(max_workers=size)
+                    if current is not None:
+                        current.shutdown(wait=False)
+        
+        threads = self.worker_threads.setdefault(task_name, {})
+        for slot in [slot for slot, thread in threads.items() if not thread.is_alive()]:
+            del threads[slot]
+        started = []
+        for slot in range(size):
+            if slot not in threads:
+                threads[slot] = self.start_worker(task_name, slot=slot)
+                started.append(threads[slot])
+        return started
+    
+    def set_concurrency(self, task_name: str, concurrency: int):
+        """Resize the worker pool of a task type in this process"""
+        concurrency = max(0, int(concurrency))
+        if self.concurrency.get(task_name) == concurrency:
+            return
+        logger.info(f"Resizing {task_name} workers from {self.concurrency.get(task_name)} to {concurrency}")
+        self.concurrency[task_name] = concurrency
+        if self.running:
+            self._scale_workers(task_name)
+    
+    def resize_workers(self, task_name: str, concurrency: int):
+        """Set the worker count of a task type for every worker process (applied within XUI_TASK_DELAY_POLL)"""
+        self.redis_client.hset(CONCURRENCY_KEY, task_name, max(0, int(concurrency)))
+    
+    def apply_concurrency_overrides(self):
+        """Apply worker counts set at runtime with resize_workers"""
+        for task_name, concurrency in self.redis_client.hgetall(CONCURRENCY_KEY).items():
+            if task_name in self.workers:
+                self.set_concurrency(task_name, concurrency)
+    
+    def worker_pool_status(self) -> Dict[str, Dict[str, Any]]:
+        """Pools of this process: configured size, running threads and busy workers per task type"""
+        busy = {}
+        for task_name in list(self.in_flight.values()):
+            busy[task_name] = busy.get(task_name, 0) + 1
+        return {
+            task_name: {
+                'pool': self.pools.get(task_name, POOL_THREAD),
+                'concurrency': self.concurrency.get(task_name, 1),
+                'running': (
+                    self.concurrency.get(task_name, 1) if self.pools.get(task_name) == POOL_ASYNC and self._dispatcher_alive(task_name)
+                    else sum(1 for thread in self.worker_threads.get(task_name, {}).values() if thread.is_alive())
+                ),
+                'busy': busy.get(task_name, 0),
+            }
+            for task_name in self.workers
+        }
     
-    def start_worker(self, task_name: str, worker_func: Callable = None):
+    def publish_worker_status(self):
+        """Publish this process's pools so the API (another process) can report them"""
+        status = {
+            'process': self.process_token,
+            'started_at': self.started_at,
+            'updated_at': datetime.now().isoformat(),
+            'workers': self.worker_pool_status(),
+        }
+        self.redis_client.set(f"{WORKER_STATUS_PREFIX}{self.process_token}", json.dumps(status), ex=int(XUI_TASK_HEARTBEAT_INTERVAL * 3) + 1)
+    
+    def get_workers_status(self) -> Dict[str, Any]:
+        """Pools of every live worker process plus runtime worker count overrides"""
+        processes = []
+        for key in self.redis_client.scan_iter(f"{WORKER_STATUS_PREFIX}*"):
+            raw = self.redis_client.get(key)
+            if raw:
+                processes.append(json.loads(raw))
+        return {
+            'processes': processes,
+            'overrides': {task_name: int(size) for task_name, size in self.redis_client.hgetall(CONCURRENCY_KEY).items()},
+        }
+    
+    def start_worker(self, task_name: str, worker_func: Callable = None, slot: int = 0):
         """Start a worker for a specific task type"""
         if worker_func:
             self.register_worker(task_name, worker_func)
         
         def worker_loop():
-            logger.info(f"Starting worker for task: {task_name}")
-            while self.running:
+            logger.info(f"Starting worker {slot} for task: {task_name}")
+            while self.running and slot < self.concurrency.get(task_name, 1):
                 try:
                     task = self.dequeue_task(task_name)
                     if task:
                         logger.info(f"Starting task: {task['id']}")
-                        
-                        # Update task status
-                        self.redis_client.hset(f"task:{task['id']}", mapping={
-                            'status': 'processing',
-                            'started_at': datetime.now().isoformat()
-                        })
+                        self.in_flight[task['id']] = task_name
                         
                         # Execute task
                         if task_name in self.workers:
                             try:
-                                result = self.workers[task_name](**task['data'])
+                                result = self._run_task(task_name, task['data'])
                                 
-                                # Update task status
-                                self.redis_client.hset(f"task:{task['id']}", mapping={
+                                # Update task status and release the lease
+                                self.ack_task(task_name, task['id'], {
                                     'status': 'completed',
                                     'completed_at': datetime.now().isoformat(),
                                     'result': json.dumps(result) if result else ''
@@ -135,22 +681,20 @@ class RedisQueue:
                             except Exception as e:
                                 logger.error(f"Error executing task {task['id']}: {e}")
                                 
-                                # Update task status
-                                self.redis_client.hset(f"task:{task['id']}", mapping={
-                                    'status': 'failed',
-                                    'failed_at': datetime.now().isoformat(),
-                                    'error': str(e)
-                                })
+                                # Retry, dead-letter or mark failed, and release the lease
+                                self._fail_task(task_name, task, e)
                         else:
                             logger.warning(f"No worker registered for task: {task_name}")
+                            self.ack_task(task_name, task['id'])
                             
                     else:
-                        # No tasks available, sleep for a bit
-                        time.sleep(1)
+                        # No tasks available, wait for the next enqueue
+                        self.wait_for_task(task_name)
                         
                 except Exception as e:
                     logger.error(f"Worker error for {task_name}: {e}")
                     time.sleep(5)
+            logger.info(f"Stopped worker {slot} for task: {task_name}")
         
         # Start worker in a separate thread
         worker_thread = threading.Thread(target=worker_loop, daemon=True)
@@ -159,12 +703,17 @@ class RedisQueue:
     
     def start_all_workers(self):
         """Start workers for all registered task types"""
+        try:
+            self.apply_concurrency_overrides()
+        except Exception as e:
+            logger.error(f"Error reading worker concurrency overrides: {e}")
         self.running = True
+        self.started_at = datetime.now().isoformat()
         threads = []
         
         for task_name in self.workers:
-            thread = self.start_worker(task_name)
-            threads.append(thread)
+            threads.extend(self._scale_workers(task_name))
+        self.start_lease_keeper()
         
         logger.info(f"Started {len(threads)} workers")
         return threads
@@ -172,6 +721,15 @@ class RedisQueue:
     def stop_workers(self):
         """Stop all workers"""
         self.running = False
+        self._stop_async_runtime()
+        with self.process_pools_lock:
+            for pool in self.process_pools.values():
+                pool.shutdown(wait=False)
+            self.process_pools = {}
+        try:
+            self.redis_client.delete(f"{WORKER_STATUS_PREFIX}{self.process_token}")
+        except Exception as e:
+            logger.error(f"Error removing worker status: {e}")
         logger.info("Stopping all workers")
     
     def get_task_status(self, task_id: str):
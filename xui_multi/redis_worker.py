@@ -1,11 +1,10 @@
-import threading
-import time
+import os
 import logging
-from datetime import datetime
-import reflex as rx
 
-from .redis_queue import redis_queue
-from .tasks import sync_usage_task, sync_usage_continuous_task, build_configs_task, cleanup_deleted_panels_task, update_service_task, delete_service_task, sync_services_with_panels_task, check_and_update_service_status, check_expired_services
+from .redis_queue import redis_queue, POOL_ASYNC, POOL_THREAD
+from .scheduler import scheduler, Schedule
+from .usage_shards import XUI_SYNC_SHARD_WORKERS
+from .tasks import sync_usage_task, sync_usage_shard_task, sync_usage_reduce_task, sync_watchlist_usage_task, sync_usage_continuous_task, build_configs_task, cleanup_deleted_panels_task, update_service_task, delete_service_task, sync_services_with_panels_task, check_and_update_service_status, check_expired_services, PANEL_TASK_RETRY
 
 # Configure logging
 logging.basicConfig(
@@ -15,6 +14,17 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# "async": provisioning and enforcement tasks run as coroutines on one event loop per worker process
+XUI_WORKER_RUNTIME = os.getenv("XUI_WORKER_RUNTIME", POOL_THREAD)
+# Concurrent tasks per type on the async runtime
+XUI_ASYNC_WORKER_CONCURRENCY = int(os.getenv("XUI_ASYNC_WORKER_CONCURRENCY", "100"))
+
+def _io_pool(threads: int, async_concurrency: int = XUI_ASYNC_WORKER_CONCURRENCY):
+    """pool و تعداد worker تسک‌های I/O محوری که نسخه async دارند"""
+    if XUI_WORKER_RUNTIME == POOL_ASYNC:
+        return {"pool": POOL_ASYNC, "concurrency": async_concurrency}
+    return {"pool": POOL_THREAD, "concurrency": threads}
+
 class RedisWorkerManager:
     def __init__(self):
         """Initialize Redis worker manager"""
@@ -30,15 +40,25 @@ class RedisWorkerManager:
             # Set running flag first
             self.running = True
             
-            # Register worker functions
+            # Register worker functions (worker counts can be overridden with XUI_WORKERS_<TASK_NAME> or at runtime)
             redis_queue.register_worker('sync_usage', sync_usage_task)
-            redis_queue.register_worker('build_configs', build_configs_task)
+            redis_queue.register_worker('sync_usage_shard', sync_usage_shard_task, concurrency=XUI_SYNC_SHARD_WORKERS)
+            redis_queue.register_worker('sync_usage_reduce', sync_usage_reduce_task)
+            redis_queue.register_worker('sync_usage_watchlist', sync_watchlist_usage_task)
+            from .async_tasks import build_configs_task_async, update_service_task_async, delete_service_task_async, check_expired_services_async
+            redis_queue.register_worker('build_configs', build_configs_task, retry=PANEL_TASK_RETRY, async_func=build_configs_task_async, **_io_pool(4))
             redis_queue.register_worker('cleanup_panels', cleanup_deleted_panels_task)
-            redis_queue.register_worker('update_service', update_service_task)
-            redis_queue.register_worker('delete_service', delete_service_task)
+            redis_queue.register_worker('update_service', update_service_task, retry=PANEL_TASK_RETRY, async_func=update_service_task_async, **_io_pool(4))
+            redis_queue.register_worker('delete_service', delete_service_task, retry=PANEL_TASK_RETRY, async_func=delete_service_task_async, **_io_pool(2))
             redis_queue.register_worker('sync_services_with_panels', sync_services_with_panels_task)
             redis_queue.register_worker('check_service_status', check_and_update_service_status)
-            redis_queue.register_worker('check_expired_services', check_expired_services)
+            redis_queue.register_worker('check_expired_services', check_expired_services, async_func=check_expired_services_async, **_io_pool(1, async_concurrency=1))
+            
+            # Close the async runtime's DB and panel connections when the workers stop
+            from .async_db import dispose_async_engine
+            from .xui_client import aclose_async_http_clients
+            redis_queue.register_async_cleanup(dispose_async_engine)
+            redis_queue.register_async_cleanup(aclose_async_http_clients)
             
             # Start continuous sync_usage task in a separate thread
             import threading
@@ -63,46 +83,11 @@ class RedisWorkerManager:
             raise
     
     def start_scheduler(self):
-        """Start scheduler for periodic tasks"""
-        def scheduler_loop():
-            logger.info("Starting Redis task scheduler...")
-            last_cleanup_time = None
-            
-            while self.running:
-                try:
-                    current_time = datetime.now()
-                    
-                    # Note: sync_usage is now running in continuous mode
-                    # No need to schedule it every 2 minutes
-                    
-                    # Run cleanup every hour (time-based)
-                    if (last_cleanup_time is None or 
-                        (current_time - last_cleanup_time).total_seconds() >= 3600):
-                        from .tasks import enqueue_cleanup_panels
-                        enqueue_cleanup_panels()
-                        last_cleanup_time = current_time
-                        logger.info(f"Enqueued cleanup_panels task at {current_time}")
-                    
-                    # Run check_service_status every 5 minutes
-                    if (current_time.minute % 5 == 0 and current_time.second < 10):
-                        from .tasks import enqueue_check_service_status
-                        enqueue_check_service_status()
-                        logger.info(f"Enqueued check_service_status task at {current_time}")
-                    
-                    # Run check_expired_services every 10 minutes
-                    if (current_time.minute % 10 == 0 and current_time.second < 10):
-                        from .tasks import enqueue_check_expired_services
-                        enqueue_check_expired_services()
-                        logger.info(f"Enqueued check_expired_services task at {current_time}")
-                    
-                    time.sleep(10)  # Check every 10 seconds for faster response
-                    
-                except Exception as e:
-                    logger.error(f"Scheduler error: {e}")
-                    time.sleep(5)
-        
-        self.scheduler_thread = threading.Thread(target=scheduler_loop, daemon=True)
-        self.scheduler_thread.start()
+        """Start scheduler for periodic tasks (only the leader process across all nodes enqueues them)"""
+        scheduler.add(Schedule("cleanup_panels", "cleanup_panels", interval=3600, run_at_start=True))
+        scheduler.add(Schedule("check_service_status", "check_service_status", cron="*/5 * * * *"))
+        scheduler.add(Schedule("check_expired_services", "check_expired_services", cron="*/10 * * * *"))
+        self.scheduler_thread = scheduler.start()
         logger.info("Redis task scheduler started")
     
     def stop_workers(self):
@@ -110,7 +95,14 @@ class RedisWorkerManager:
         try:
             logger.info("Stopping Redis workers...")
             self.running = False
+            scheduler.stop()
             redis_queue.stop_workers()
+            
+            # Release pooled keep-alive connections to the panels
+            from .xui_client import close_http_clients
+            from .panel_clients import close_fan_out_loop
+            close_fan_out_loop()
+            close_http_clients()
             logger.info("Redis workers stopped successfully")
             
         except Exception as e:
@@ -123,6 +115,18 @@ class RedisWorkerManager:
     def get_task_status(self, task_id: str):
         """Get status of a specific task"""
         return redis_queue.get_task_status(task_id)
+    
+    def get_workers_status(self):
+        """Get worker pools of all worker processes"""
+        return redis_queue.get_workers_status()
+    
+    def resize_workers(self, task_name: str, concurrency: int):
+        """Change the worker count of a task type in all worker processes"""
+        redis_queue.resize_workers(task_name, concurrency)
+    
+    def get_scheduler_status(self):
+        """Get next and last run of every periodic task"""
+        return scheduler.status()
 
 # Global worker manager instance
 worker_manager = RedisWorkerManager()
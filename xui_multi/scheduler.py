@@ -0,0 +1,314 @@
+# xui_multi/scheduler.py
+
+import os
+import time
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Set
+from uuid import uuid4
+
+logger = logging.getLogger(__name__)
+
+# How long the leader lock lives without renewal; the leader renews it on every tick
+XUI_SCHEDULER_LOCK_TTL = int(os.getenv("XUI_SCHEDULER_LOCK_TTL", "15"))
+# Longest sleep between ticks (the leader otherwise wakes exactly at the next due run)
+XUI_SCHEDULER_MAX_SLEEP = float(os.getenv("XUI_SCHEDULER_MAX_SLEEP", "1"))
+
+NEXT_RUN_KEY = "scheduler:next_run"  # zset: schedule name -> next run (epoch ms)
+SPEC_KEY = "scheduler:spec"          # hash: schedule name -> spec the next run was computed from
+LAST_RUN_KEY = "scheduler:last_run"  # hash: schedule name -> "scheduled_at|enqueued_at|task_id"
+LEADER_KEY = "scheduler:leader"
+
+# Misfire policies for a run found later than its grace period
+MISFIRE_COALESCE = "coalesce"  # run once for all missed runs
+MISFIRE_CATCH_UP = "catch_up"  # run every missed run (up to max_catch_up)
+MISFIRE_SKIP = "skip"          # drop missed runs and wait for the next one
+
+# Advances a schedule's next run only if it still has the score this leader read, so a run is
+# enqueued once even if two processes briefly both think they are leader.
+# KEYS: next-run zset; ARGV: name, expected score, new score
+CLAIM_SCRIPT = """
+local current = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if current and tonumber(current) == tonumber(ARGV[2]) then
+    redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+    return 1
+end
+return 0
+"""
+
+def _redis():
+    from .redis_queue import redis_queue
+    return redis_queue.redis_client
+
+def _to_ms(moment: datetime) -> int:
+    return int(moment.timestamp() * 1000)
+
+def _from_ms(ms: int) -> datetime:
+    return datetime.fromtimestamp(ms / 1000)
+
+class CronSpec:
+    """
+    عبارت cron پنج بخشی (minute hour day-of-month month day-of-week) با پشتیبانی از * و */n و a-b و a-b/n و لیست.
+    زمان‌ها به وقت محلی سرور هستند (مثل بقیه datetime.now() های پروژه).
+    """
+
+    FIELDS = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 6)]
+
+    def __init__(self, expression: str):
+        parts = expression.split()
+        if len(parts) != 5:
+            raise ValueError(f"Invalid cron expression: {expression}")
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, self.weekdays = (
+            self._parse(part, low, high) for part, (low, high) in zip(parts, self.FIELDS)
+        )
+        # Like cron: when both day fields are restricted a day matches either of them
+        self.any_day = parts[2] == "*"
+        self.any_weekday = parts[4] == "*"
+
+    @staticmethod
+    def _parse(field: str, low: int, high: int) -> Set[int]:
+        values = set()
+        for item in field.split(","):
+            step = 1
+            if "/" in item:
+                item, step = item.split("/")
+                step = int(step)
+            if item == "*":
+                start, end = low, high
+            elif "-" in item:
+                start, end = (int(value) for value in item.split("-"))
+            else:
+                start = end = int(item)
+                if step != 1:
+                    end = high
+            if start < low or end > high or start > end or step < 1:
+                raise ValueError(f"Invalid cron field: {field}")
+            values.update(range(start, end + 1, step))
+        # Sunday may be written as 7
+        if high == 6 and 7 in values:
+            values.discard(7)
+            values.add(0)
+        return values
+
+    def _day_matches(self, moment: datetime) -> bool:
+        weekday = (moment.weekday() + 1) % 7  # cron: 0 = Sunday
+        if self.any_day:
+            return self.any_weekday or weekday in self.weekdays
+        if self.any_weekday:
+            return moment.day in self.days
+        return moment.day in self.days or weekday in self.weekdays
+
+    def next_after(self, moment: datetime) -> datetime:
+        """اولین زمان اجرای بعد از moment"""
+        candidate = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = candidate + timedelta(days=366 * 5)
+        while candidate < limit:
+            if candidate.month not in self.months:
+                candidate = (candidate.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(candidate):
+                candidate = candidate.replace(hour=0, minute=0) + timedelta(days=1)
+            elif candidate.hour not in self.hours:
+                candidate = candidate.replace(minute=0) + timedelta(hours=1)
+            elif candidate.minute not in self.minutes:
+                candidate += timedelta(minutes=1)
+            else:
+                return candidate
+        raise ValueError(f"Cron expression never matches: {self.expression}")
+
+class Schedule:
+    """
+    یک تسک دوره‌ای: با interval (ثانیه، لنگر شده روی زمان اجرای قبلی تا انحراف جمع نشود) یا cron.
+    اجرایی که بیش از misfire_grace ثانیه دیر پیدا شود طبق misfire (coalesce / catch_up / skip) اجرا می‌شود.
+    """
+
+    def __init__(self, name: str, task_name: str, interval: Optional[float] = None, cron: Optional[str] = None,
+                 task_data: Optional[Dict[str, Any]] = None, misfire: str = MISFIRE_COALESCE,
+                 misfire_grace: float = 60, max_catch_up: int = 10, run_at_start: bool = False):
+        if (interval is None) == (cron is None):
+            raise ValueError(f"Schedule {name} needs exactly one of interval or cron")
+        self.name = name
+        self.task_name = task_name
+        self.interval_ms = int(interval * 1000) if interval is not None else None
+        self.cron = CronSpec(cron) if cron is not None else None
+        self.task_data = task_data or {}
+        self.misfire = misfire
+        self.misfire_grace_ms = int(misfire_grace * 1000)
+        self.max_catch_up = max_catch_up
+        self.run_at_start = run_at_start
+
+    @property
+    def spec(self) -> str:
+        return f"cron:{self.cron.expression}" if self.cron else f"interval:{self.interval_ms}"
+
+    def first_run(self, now_ms: int) -> int:
+        if self.run_at_start:
+            return now_ms
+        return self.next_after(now_ms, now_ms)
+
+    def next_after(self, after_ms: int, anchor_ms: int) -> int:
+        """اولین اجرای بعد از after_ms (interval ها روی anchor_ms لنگر می‌شوند)"""
+        if self.cron:
+            return _to_ms(self.cron.next_after(_from_ms(after_ms)))
+        periods = max(1, (after_ms - anchor_ms) // self.interval_ms + 1)
+        return anchor_ms + periods * self.interval_ms
+
+    def due_runs(self, scheduled_ms: int, now_ms: int) -> List[int]:
+        """اجراهایی که برای یک سررسید باید ارسال شوند (طبق سیاست misfire)"""
+        if now_ms - scheduled_ms <= self.misfire_grace_ms:
+            return [scheduled_ms]
+        if self.misfire == MISFIRE_SKIP:
+            return []
+        if self.misfire == MISFIRE_CATCH_UP:
+            runs = [scheduled_ms]
+            while len(runs) < self.max_catch_up:
+                following = self.next_after(runs[-1], scheduled_ms)
+                if following > now_ms:
+                    break
+                runs.append(following)
+            return runs
+        return [scheduled_ms]
+
+class RedisScheduler:
+    """
+    زمان‌بند تسک‌های دوره‌ای روی sorted set زمان اجرای بعدی در Redis. همه پروسه‌های worker آن را اجرا می‌کنند
+    ولی فقط دارنده قفل leader تسک‌ها را ارسال می‌کند و دقیقاً در زمان سررسید بیدار می‌شود.
+    """
+
+    def __init__(self):
+        self.schedules: Dict[str, Schedule] = {}
+        self.token = uuid4().hex
+        self.running = False
+        self.thread = None
+        self.is_leader = False
+        self._claim = None
+
+    def add(self, schedule: Schedule):
+        self.schedules[schedule.name] = schedule
+
+    def _acquire_leadership(self, redis) -> bool:
+        if redis.set(LEADER_KEY, self.token, nx=True, ex=XUI_SCHEDULER_LOCK_TTL):
+            return True
+        if redis.get(LEADER_KEY) == self.token:
+            redis.expire(LEADER_KEY, XUI_SCHEDULER_LOCK_TTL)
+            return True
+        return False
+
+    def _sync_schedules(self, redis, now_ms: int):
+        """ثبت زمان اجرای اول schedule های جدید یا تغییر کرده و حذف schedule هایی که دیگر تعریف نشده‌اند"""
+        stored = redis.hgetall(SPEC_KEY)
+        removed = set(redis.zrange(NEXT_RUN_KEY, 0, -1)) - set(self.schedules)
+        pipe = redis.pipeline()
+        if removed:
+            pipe.zrem(NEXT_RUN_KEY, *removed)
+            pipe.hdel(SPEC_KEY, *removed)
+        for name, schedule in self.schedules.items():
+            if stored.get(name) != schedule.spec:
+                pipe.zadd(NEXT_RUN_KEY, {name: schedule.first_run(now_ms)})
+                pipe.hset(SPEC_KEY, name, schedule.spec)
+            else:
+                # Keep the stored next run across restarts so runs are neither repeated nor lost
+                pipe.zadd(NEXT_RUN_KEY, {name: schedule.first_run(now_ms)}, nx=True)
+        pipe.execute()
+
+    def _enqueue(self, schedule: Schedule, scheduled_ms: int) -> str:
+        from .redis_queue import redis_queue, new_task_id
+        # Like the enqueue_* helpers a run coalesces with a sweep that is still queued, except when every missed run is wanted
+        coalesce_key = None if schedule.misfire == MISFIRE_CATCH_UP else "all"
+        task_id = redis_queue.enqueue_task(
+            schedule.task_name, new_task_id(schedule.task_name), schedule.task_data, coalesce_key=coalesce_key,
+        )
+        _redis().hset(LAST_RUN_KEY, schedule.name, f"{_from_ms(scheduled_ms).isoformat()}|{datetime.now().isoformat()}|{task_id}")
+        return task_id
+
+    def run_due(self, now_ms: Optional[int] = None) -> int:
+        """ارسال اجراهای سررسید شده؛ خروجی: تعداد تسک‌های ارسال شده"""
+        redis = _redis()
+        now_ms = now_ms or _to_ms(datetime.now())
+        enqueued = 0
+        for name, score in redis.zrangebyscore(NEXT_RUN_KEY, "-inf", now_ms, withscores=True):
+            schedule = self.schedules.get(name)
+            if schedule is None:
+                continue
+            scheduled_ms = int(score)
+            next_ms = schedule.next_after(now_ms, scheduled_ms)
+            if not self._claim(keys=[NEXT_RUN_KEY], args=[name, scheduled_ms, next_ms]):
+                continue
+            runs = schedule.due_runs(scheduled_ms, now_ms)
+            if not runs:
+                logger.warning(f"Skipped missed run of {name} scheduled at {_from_ms(scheduled_ms)}")
+            elif len(runs) > 1 or now_ms - scheduled_ms > schedule.misfire_grace_ms:
+                logger.warning(f"Schedule {name} was {(now_ms - scheduled_ms) / 1000:.0f}s late; enqueueing {len(runs)} run(s)")
+            for run_ms in runs:
+                try:
+                    self._enqueue(schedule, run_ms)
+                    enqueued += 1
+                except Exception as e:
+                    logger.error(f"Error enqueueing scheduled {name}: {e}")
+        return enqueued
+
+    def _seconds_until_next_run(self, redis) -> float:
+        upcoming = redis.zrange(NEXT_RUN_KEY, 0, 0, withscores=True)
+        if not upcoming:
+            return XUI_SCHEDULER_MAX_SLEEP
+        return max(0.0, min(XUI_SCHEDULER_MAX_SLEEP, (upcoming[0][1] - _to_ms(datetime.now())) / 1000))
+
+    def _loop(self):
+        logger.info("Starting Redis task scheduler...")
+        while self.running:
+            delay = XUI_SCHEDULER_MAX_SLEEP
+            try:
+                redis = _redis()
+                if self._acquire_leadership(redis):
+                    if not self.is_leader:
+                        logger.info("This process is now the scheduler leader")
+                        self._sync_schedules(redis, _to_ms(datetime.now()))
+                        self.is_leader = True
+                    self.run_due()
+                    delay = self._seconds_until_next_run(redis)
+                else:
+                    self.is_leader = False
+            except Exception as e:
+                logger.error(f"Scheduler error: {e}")
+                self.is_leader = False
+                delay = 5
+            time.sleep(delay)
+
+    def start(self):
+        from .redis_queue import redis_queue
+        self._claim = redis_queue.redis_client.register_script(CLAIM_SCRIPT)
+        self.running = True
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def stop(self):
+        self.running = False
+        if self.is_leader:
+            try:
+                redis = _redis()
+                if redis.get(LEADER_KEY) == self.token:
+                    redis.delete(LEADER_KEY)
+            except Exception as e:
+                logger.error(f"Error releasing scheduler leadership: {e}")
+        self.is_leader = False
+
+    def status(self) -> Dict[str, Any]:
+        """زمان اجرای بعدی و آخرین اجرای هر schedule (از Redis، پس از هر پروسه‌ای قابل خواندن است)"""
+        redis = _redis()
+        specs = redis.hgetall(SPEC_KEY)
+        last_runs = redis.hgetall(LAST_RUN_KEY)
+        schedules = []
+        for name, score in redis.zrange(NEXT_RUN_KEY, 0, -1, withscores=True):
+            last_run = dict(zip(("scheduled_at", "enqueued_at", "task_id"), last_runs[name].split("|"))) if name in last_runs else None
+            schedules.append({
+                "name": name,
+                "spec": specs.get(name),
+                "next_run": _from_ms(int(score)).isoformat(),
+                "last_run": last_run,
+            })
+        return {"leader": redis.get(LEADER_KEY), "schedules": schedules}
+
+# Global scheduler instance
+scheduler = RedisScheduler()
@@ -1,13 +1,27 @@
 import os
-import json
-import tempfile
-from datetime import datetime
-from uuid import uuid4
+import asyncio
+import base64
+from datetime import datetime, timedelta
 import reflex as rx
-from sqlalchemy import create_engine
+import httpx
+from typing import Any, Dict, List, Optional, Tuple
+from sqlalchemy import BigInteger, Integer, bindparam, column, create_engine, or_, update, values
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import Session
-from .models import ManagedService, Panel, PanelConfig, User
-from .xui_client import XUIClient
+from .models import ManagedService, Panel, PanelConfig, UsageCounter, User
+from .panel_clients import get_panel_client, run_fan_out
+from .circuit_breaker import PanelUnavailableError
+from .redis_queue import RetryPolicy, RetryableTaskError
+from .usage_sync import PanelUsage, GB, counter_delta
+from .inbound_cache import store_panel_inbounds
+from . import usage_scheduler
+from .usage_shards import ConfigRef, XUI_SYNC_SHARD_SIZE, acquire_dispatcher, clear_run, empty_summary, finish_shard, run_results, shard_panels, start_run
+from .watchlist import XUI_WATCHLIST_INTERVAL, needs_watch, update_watchlist, watched_service_ids
+from .provisioning import (
+    service_spec, provision_service, provision_service_async, new_panel_config,
+    update_panel_config, disable_panel_configs_async,
+)
 import logging
 
 # Configure logging
@@ -15,137 +29,480 @@ logging.basicConfig(level=logging.ERROR)
 logging.getLogger("httpx").setLevel(logging.ERROR)
 logger = logging.getLogger(__name__)
 
-def sync_usage_task():
-    """تسک همگام‌سازی حجم استفاده شده سرویس‌ها با استفاده از فایل‌های JSON"""
-    logger.info(f"[{datetime.now()}] Starting sync_usage_task")
+# وضعیت سرویس‌هایی که کانفیگ‌هایشان باید روی پنل غیرفعال باشند
+DISABLED_STATUSES = ["limit_reached", "expired"]
+
+# خطاهای موقتی پنل (timeout، قطع اتصال، circuit باز) و قطع اتصال دیتابیس که ارزش تلاش مجدد دارند
+TRANSIENT_ERRORS = (httpx.TransportError, PanelUnavailableError, TimeoutError, OperationalError)
+
+# Retry policy of tasks that change services on the panels
+PANEL_TASK_RETRY = RetryPolicy(
+    max_attempts=int(os.getenv("XUI_TASK_MAX_ATTEMPTS", "5")),
+    base_delay=float(os.getenv("XUI_TASK_RETRY_BASE_DELAY", "5")),
+    max_delay=float(os.getenv("XUI_TASK_RETRY_MAX_DELAY", "300")),
+    retry_on=TRANSIENT_ERRORS,
+)
+
+def disable_configs(panels, configs) -> int:
+    """کانفیگ‌ها به تفکیک پنل گروه‌بندی و روی همه پنل‌ها به صورت همزمان و دسته‌ای غیرفعال می‌شوند"""
+    by_panel = {}
+    for config in configs:
+        by_panel.setdefault(config.panel_id, []).append(config)
+    targets = [panel for panel in panels if panel.id in by_panel]
+    for panel_id in set(by_panel) - {panel.id for panel in targets}:
+        logger.warning(f"Panel {panel_id} not found for {len(by_panel[panel_id])} configs")
+    if not targets:
+        return 0
+    
+    async def disable_on_panel(client, panel):
+        return await disable_panel_configs_async(client, by_panel[panel.id])
+    
+    result = run_fan_out(targets, disable_on_panel)
+    for panel in targets:
+        if panel.id in result["errors"]:
+            logger.error(f"Error disabling configs on panel {panel.url}: {result['errors'][panel.id]}")
+    return sum(result["results"].values())
+
+def write_subscription_file(service_uuid: str, subscription_content: str) -> str:
+    """نوشتن فایل subscription سرویس (base64 لینک کانفیگ‌ها)؛ خروجی: مسیر فایل"""
+    subs_dir = "static/subs"
+    os.makedirs(subs_dir, exist_ok=True)
+    file_path = os.path.join(subs_dir, f"{service_uuid}.txt")
+    
+    # Encode to base64
+    encoded_content = base64.b64encode(subscription_content.encode('utf-8')).decode('utf-8')
+    
+    with open(file_path, "w", encoding='utf-8') as f:
+        f.write(encoded_content)
+    return file_path
+
+def _service_config_rows(session, service_ids):
+    return session.query(
+        PanelConfig.id.label("config_id"),
+        PanelConfig.panel_id, PanelConfig.panel_inbound_id, PanelConfig.client_id, PanelConfig.client_email,
+    ).filter(PanelConfig.managed_service_id.in_(service_ids)).all()
+
+def _load_services(session, service_ids, expiring_before: Optional[datetime] = None):
+    """
+    سرویس‌های فعال با مصرف فعلی‌شان (فقط ستون‌های لازم برای بررسی سقف حجم و انقضا)؛
+    با expiring_before سرویس‌هایی که تا آن زمان منقضی می‌شوند هم (حتی بدون مصرف جدید) برگردانده می‌شوند.
+    """
+    condition = ManagedService.id.in_(list(service_ids))
+    if expiring_before is not None:
+        condition = or_(condition, ManagedService.end_date <= expiring_before)
+    return session.query(
+        ManagedService.id,
+        ManagedService.name,
+        ManagedService.end_date,
+        ManagedService.data_limit_gb,
+        ManagedService.data_used_bytes,
+    ).filter(
+        ManagedService.status == "active",
+        condition,
+    ).all()
+
+def _apply_counters(session, rows, observed: Dict[int, Tuple[int, int]]) -> Dict[int, int]:
+    """
+    مصرف جدید هر کانفیگ را از اختلاف شمارنده‌های فعلی پنل (observed) با آخرین مقدار دیده شده در UsageCounter
+    حساب می‌کند و آن را با عملیات صحیح به PanelConfig.used_bytes و ManagedService.data_used_bytes اضافه می‌کند.
+    ردیف‌ها باید config_id, service_id, last_up و last_down داشته باشند. فقط کانفیگ‌ها و سرویس‌هایی که مصرف جدید دارند نوشته می‌شوند.
+    شمارنده با compare-and-set نوشته می‌شود: اگر نویسنده دیگری (shard، مسیر سریع یا sync دستی) همزمان همین شمارنده‌ها را
+    ثبت کرده باشد، delta این کانفیگ دوباره حساب نمی‌شود.
+    خروجی: {service_id: بایت مصرف جدید}
+    """
+    now = datetime.now()
+    new_counters = []
+    changed_counters = []
+    deltas: Dict[int, Tuple[int, int]] = {}
+    for row in rows:
+        counter = observed.get(row.config_id)
+        if counter is None:
+            continue
+        up, down = counter
+        last_up, last_down = row.last_up or 0, row.last_down or 0
+        if up == last_up and down == last_down and row.last_up is not None:
+            continue
+        if row.last_up is None:
+            new_counters.append({"config_id": row.config_id, "last_up": up, "last_down": down, "updated_at": now})
+        else:
+            changed_counters.append((row.config_id, last_up, last_down, up, down))
+        deltas[row.config_id] = (row.service_id, counter_delta(last_up, last_down, up, down))
+    
+    # Only the counters this call actually advanced contribute their delta
+    claimed = set()
+    if new_counters:
+        statement = pg_insert(UsageCounter).values(new_counters).on_conflict_do_nothing(index_elements=["config_id"])
+        claimed.update(session.execute(statement.returning(UsageCounter.config_id)).scalars())
+    if changed_counters:
+        counters = UsageCounter.__table__
+        seen = values(
+            column("config_id", Integer), column("old_up", BigInteger), column("old_down", BigInteger),
+            column("up", BigInteger), column("down", BigInteger),
+            name="seen",
+        ).data(changed_counters)
+        claimed.update(session.execute(
+            update(counters).where(
+                counters.c.config_id == seen.c.config_id,
+                counters.c.last_up == seen.c.old_up,
+                counters.c.last_down == seen.c.old_down,
+            ).values(last_up=seen.c.up, last_down=seen.c.down, updated_at=now).returning(counters.c.config_id)
+        ).scalars())
+    
+    config_deltas = []
+    service_deltas: Dict[int, int] = {}
+    for config_id in claimed:
+        service_id, delta = deltas[config_id]
+        if delta:
+            config_deltas.append({"config_key": config_id, "delta": delta})
+            service_deltas[service_id] = service_deltas.get(service_id, 0) + delta
+    if config_deltas:
+        configs = PanelConfig.__table__
+        session.execute(
+            update(configs).where(configs.c.id == bindparam("config_key")).values(used_bytes=configs.c.used_bytes + bindparam("delta")),
+            config_deltas,
+        )
+    if service_deltas:
+        services = ManagedService.__table__
+        new_total = services.c.data_used_bytes + bindparam("delta")
+        session.execute(
+            update(services).where(services.c.id == bindparam("service_key")).values(data_used_bytes=new_total, data_used_gb=new_total / float(GB)),
+            [{"service_key": service_id, "delta": delta} for service_id, delta in service_deltas.items()],
+        )
+    session.commit()
+    return service_deltas
+
+def _enforce_limits(session, services, check_expiry: bool = False):
+    """
+    وضعیت سرویس‌هایی که به سقف حجم رسیده‌اند (و در صورت check_expiry منقضی شده‌اند) را تغییر می‌دهد
+    و لیست پایش سریع را به‌روز می‌کند.
+    خروجی: (تعداد سرویس‌های تغییر وضعیت داده، شناسه سرویس‌هایی که باید غیرفعال شوند، حجم باقیمانده هر سرویس)
+    """
+    now = datetime.now()
+    status_changes = []
+    remaining = {}
+    watch_ids = []
+    unwatch_ids = []
+    for service in services:
+        try:
+            limit_bytes = int(service.data_limit_gb * GB)
+            remaining[service.id] = limit_bytes - service.data_used_bytes
+            
+            # Check if service should be disabled
+            status = None
+            if service.data_used_bytes >= limit_bytes:
+                logger.warning(f"Service {service.name} has exceeded limit: {service.data_used_bytes / GB:.2f} GB >= {service.data_limit_gb} GB")
+                status = "limit_reached"
+            elif check_expiry and service.end_date < now:
+                status = "expired"
+            
+            if status:
+                status_changes.append({"id": service.id, "status": status})
+                unwatch_ids.append(service.id)
+                logger.info(f"Updated service {service.name} status to {status}")
+            elif needs_watch(service.data_used_bytes, service.data_limit_gb, service.end_date, usage_scheduler.XUI_SYNC_MAX_INTERVAL, now):
+                watch_ids.append(service.id)
+            else:
+                unwatch_ids.append(service.id)
+            
+        except Exception as e:
+            logger.error(f"Error processing service {service.name}: {e}")
+            continue
+    
+    if status_changes:
+        session.bulk_update_mappings(ManagedService, status_changes)
+        session.commit()
+    update_watchlist(watch_ids, unwatch_ids)
+    return status_changes, [change["id"] for change in status_changes], remaining
+
+def _sync_panel_usage(engine, panel_id: int, inbounds: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    پردازش پاسخ یک پنل در تراکنش‌های کوتاه: ذخیره در PanelInboundCache و جمع delta شمارنده‌های کانفیگ‌های همین پنل.
+    خروجی فقط خلاصه کوچکی است تا داده کامل پنل بعد از پردازش آزاد شود.
+    """
+    usage = PanelUsage(inbounds)
+    with Session(engine) as session:
+        try:
+            # Persist the snapshot so other code can read traffic without calling the panel
+            store_panel_inbounds(session, panel_id, inbounds)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Error caching inbounds of panel {panel_id}: {e}")
+        
+        # Configs on this panel (active and disabled services) with their last-seen counters
+        rows = session.query(
+            PanelConfig.id.label("config_id"),
+            PanelConfig.managed_service_id.label("service_id"),
+            PanelConfig.panel_id,
+            PanelConfig.panel_inbound_id,
+            PanelConfig.client_id,
+            PanelConfig.client_email,
+            ManagedService.status,
+            UsageCounter.last_up,
+            UsageCounter.last_down,
+        ).join(
+            ManagedService, PanelConfig.managed_service_id == ManagedService.id
+        ).outerjoin(
+            UsageCounter, UsageCounter.config_id == PanelConfig.id
+        ).filter(
+            PanelConfig.panel_id == panel_id,
+            ManagedService.status.in_(["active"] + DISABLED_STATUSES),
+        ).all()
+        
+        # Accumulate counter deltas; services without new traffic are skipped from here on
+        active_rows = [row for row in rows if row.status == "active"]
+        observed = usage.config_counters(
+            (row.config_id, row.panel_inbound_id, row.client_email if row.client_id else None)
+            for row in active_rows
+        )
+        service_deltas = _apply_counters(session, active_rows, observed)
+    
+    return {
+        "service_deltas": service_deltas,
+        # Already disabled services whose configs the panel still shows as enabled
+        "stale_configs": [
+            ConfigRef(row.config_id, row.panel_id, row.panel_inbound_id, row.client_id, row.client_email) for row in rows
+            if row.status != "active" and usage.config_enabled(row.panel_inbound_id, row.client_email if row.client_id else None) is True
+        ],
+        "traffic_bytes": usage.total_traffic(),
+    }
+
+def _sync_shard(engine, panels) -> Dict[str, Any]:
+    """
+    مرحله map همگام‌سازی: پنل‌ها به صورت pipeline دریافت و پردازش می‌شوند (پاسخ هر پنل به محض دریافت
+    در تراکنش کوتاه خودش) و فقط خلاصه کوچکی قابل تبدیل به JSON برمی‌گردد.
+    """
+    async def sync_panel(client, panel):
+        inbounds = await client._get_inbounds_list(force=True)
+        # The snapshot is not needed after this run; keep only one payload per panel in memory
+        client.invalidate_snapshot()
+        # DB work runs in a thread so the other panels keep downloading meanwhile
+        return await asyncio.to_thread(_sync_panel_usage, engine, panel.id, inbounds)
+    
+    synced = run_fan_out(panels, sync_panel)
+    for panel in panels:
+        if panel.id in synced["errors"]:
+            logger.error(f"Error syncing usage of panel {panel.url}: {synced['errors'][panel.id]}")
+    
+    summary = empty_summary()
+    for panel_id, result in synced["results"].items():
+        for service_id, delta in result["service_deltas"].items():
+            summary["service_deltas"][service_id] = summary["service_deltas"].get(service_id, 0) + delta
+        summary["stale_configs"].extend(result["stale_configs"])
+        summary["panels"][panel_id] = {
+            "traffic_bytes": result["traffic_bytes"],
+            "service_ids": list(result["service_deltas"]),
+        }
+    return summary
+
+def _reduce_usage(engine, panels, summaries) -> Dict[str, int]:
+    """
+    مرحله reduce همگام‌سازی: جمع مصرف هر سرویس از همه shard ها، بررسی سقف حجم، غیرفعال کردن کانفیگ‌ها
+    و تنظیم فاصله همگام‌سازی بعدی پنل‌ها. مصرف قبلاً توسط shard ها در دیتابیس نوشته شده است.
+    """
+    service_deltas: Dict[int, int] = {}
+    stale_configs = []
+    panel_stats = {}
+    for summary in summaries:
+        for service_id, delta in summary["service_deltas"].items():
+            service_deltas[service_id] = service_deltas.get(service_id, 0) + delta
+        stale_configs.extend(summary["stale_configs"])
+        panel_stats.update(summary["panels"])
+    if not panel_stats:
+        return {"updated": 0, "services": 0, "disabled": 0}
+    
+    with Session(engine) as session:
+        # Check limits of the services that used traffic, and put idle services expiring before the next sweep on the watchlist
+        expiring_before = datetime.now() + timedelta(seconds=usage_scheduler.XUI_SYNC_MAX_INTERVAL)
+        services = _load_services(session, service_deltas, expiring_before=expiring_before)
+        status_changes, exceeded_ids, remaining = _enforce_limits(session, services)
+        logger.info(f"sync_usage added usage to {len(service_deltas)} services, {len(status_changes)} reached their limit")
+        # Services that just crossed their limit: every config (already disabled inbounds are skipped on the panel side)
+        to_disable = list(_service_config_rows(session, exceeded_ids)) if exceeded_ids else []
     
-    # Create temporary directory for JSON files
-    temp_dir = tempfile.mkdtemp(prefix="xui_cache_")
+    # Disable configs grouped per panel
+    to_disable.extend(stale_configs)
+    disabled = disable_configs(panels, to_disable) if to_disable else 0
+    
+    # Adapt each synced panel's polling interval
+    usage_scheduler.reschedule({
+        panel_id: {
+            "traffic_bytes": stats["traffic_bytes"],
+            "min_remaining_bytes": min(
+                (remaining[service_id] for service_id in stats["service_ids"] if service_id in remaining),
+                default=None,
+            ),
+        }
+        for panel_id, stats in panel_stats.items()
+    })
+    return {"updated": len(service_deltas), "services": len(services), "disabled": disabled}
+
+def sync_usage_task(panel_ids: Optional[List[int]] = None):
+    """
+    تسک همگام‌سازی حجم استفاده شده سرویس‌ها در یک پروسه (map و reduce پشت سر هم).
+    اگر panel_ids داده شود فقط همان پنل‌ها دریافت می‌شوند. همگام‌سازی دوره‌ای از sync_usage_shard استفاده می‌کند.
+    مصرف به صورت delta شمارنده‌ها جمع می‌شود، پس هزینه هر دور به تعداد کانفیگ‌های دارای ترافیک جدید بستگی دارد.
+    """
+    logger.info(f"[{datetime.now()}] Starting sync_usage_task")
     
     try:
         engine = create_engine(rx.config.get_config().db_url)
         with Session(engine) as session:
             # Get all panels
             panels = session.query(Panel).all()
-            
-            # Step 1: Fetch data from all panels and save to JSON files
-            for panel in panels:
-                try:
-                    client = XUIClient(panel.url, panel.username, panel.password)
-                    inbounds_data = client.get_all_inbounds_data()
-                    
-                    # Save to JSON file
-                    json_file = os.path.join(temp_dir, f"panel_{panel.id}.json")
-                    with open(json_file, 'w', encoding='utf-8') as f:
-                        json.dump(inbounds_data, f, ensure_ascii=False, indent=2)
-                    
-                except Exception as e:
-                    logger.error(f"Error fetching data from panel {panel.url}: {e}")
-                    continue
-            
-            # Step 2: Process services using JSON files
-            services = session.query(ManagedService).filter(
-                ManagedService.status == "active"
-            ).all()
-            
-            for service in services:
-                try:
-                    total_usage_gb = 0
-                    service_configs = session.query(PanelConfig).filter(
-                        PanelConfig.managed_service_id == service.id
-                    ).all()
-                    
-                    for config in service_configs:
-                        try:
-                            # Load panel data from JSON file
-                            json_file = os.path.join(temp_dir, f"panel_{config.panel_id}.json")
-                            if os.path.exists(json_file):
-                                with open(json_file, 'r', encoding='utf-8') as f:
-                                    panel_data = json.load(f)
-                                
-                                # Find inbound data
-                                inbound_data = None
-                                for inbound in panel_data:
-                                    if inbound.get("id") == config.panel_inbound_id:
-                                        inbound_data = inbound
-                                        break
-                                
-                                if inbound_data:
-                                    # Calculate usage
-                                    up_gb = inbound_data.get("up", 0) / (1024 * 1024 * 1024)
-                                    down_gb = inbound_data.get("down", 0) / (1024 * 1024 * 1024)
-                                    traffic_gb = up_gb + down_gb
-                                    total_usage_gb += traffic_gb
-                                else:
-                                    # logger.warning(f"Inbound {config.panel_inbound_id} not found for service {service.name}") # Disabled log
-                                    pass
-                            else:
-                                # logger.warning(f"JSON file not found for panel {config.panel_id}") # Disabled log
-                                pass
-                                
-                        except Exception as e:
-                            logger.error(f"Error processing config {config.panel_inbound_id} for service {service.name}: {e}")
-                            continue
-                    
-                    # Update service usage
-                    service.data_used_gb = total_usage_gb
-                    
-                    # Check if service should be disabled
-                    if total_usage_gb >= service.data_limit_gb:
-                        logger.warning(f"Service {service.name} has exceeded limit: {total_usage_gb:.2f} GB >= {service.data_limit_gb} GB")
-                        
-                        # Update service status to limit_reached
-                        if service.status != "limit_reached":
-                            service.status = "limit_reached"
-                            logger.info(f"Updated service {service.name} status to limit_reached")
-                        
-                        # Disable all configs for this service
-                        for config in service_configs:
-                            try:
-                                panel = session.query(Panel).filter(Panel.id == config.panel_id).first()
-                                if panel:
-                                    client = XUIClient(panel.url, panel.username, panel.password)
-                                    client.disable_inbound(config.panel_inbound_id)
-                                else:
-                                    logger.warning(f"Panel not found for config {config.id}")
-                            except Exception as e:
-                                logger.error(f"Error disabling inbound {config.panel_inbound_id}: {e}")
-                    
-                    session.add(service)
-                    
-                except Exception as e:
-                    logger.error(f"Error processing service {service.name}: {e}")
-                    continue
-            
-            session.commit()
+        sync_panels = panels if panel_ids is None else [panel for panel in panels if panel.id in set(panel_ids)]
+        return _reduce_usage(engine, panels, [_sync_shard(engine, sync_panels)])
             
     except Exception as e:
         logger.error(f"Error in sync_usage_task: {e}")
         raise
-    
+
+def sync_usage_shard_task(run_id: str, panel_ids: List[int]):
+    """
+    یک تکه از دور همگام‌سازی: فقط panel_ids دریافت و مصرفشان در دیتابیس نوشته می‌شود.
+    هر پروسه worker می‌تواند shard ها را بردارد؛ آخرین shard تمام شده تسک sync_usage_reduce را ارسال می‌کند.
+    """
+    logger.info(f"[{datetime.now()}] Starting sync_usage_shard_task {run_id} for panels {panel_ids}")
+    summary = empty_summary()
+    try:
+        engine = create_engine(rx.config.get_config().db_url)
+        with Session(engine) as session:
+            panels = session.query(Panel).filter(Panel.id.in_(panel_ids)).all()
+        summary = _sync_shard(engine, panels)
+        return {"panels": len(summary["panels"]), "services": len(summary["service_deltas"])}
+    except Exception as e:
+        logger.error(f"Error in sync_usage_shard_task {run_id}: {e}")
+        raise
     finally:
-        # Step 3: Clean up JSON files
+        # A failed shard still counts as finished so the run is reduced with the other shards
         try:
-            import shutil
-            shutil.rmtree(temp_dir)
+            if finish_shard(run_id, ",".join(str(panel_id) for panel_id in panel_ids), summary):
+                from .redis_queue import redis_queue
+                redis_queue.enqueue_task("sync_usage_reduce", f"sync_usage_reduce_{run_id}", {"run_id": run_id})
         except Exception as e:
-            logger.error(f"Error cleaning up temporary files: {e}")
+            logger.error(f"Error finishing sync_usage_shard_task {run_id}: {e}")
+
+def sync_usage_reduce_task(run_id: str):
+    """جمع خلاصه همه shard های یک دور همگام‌سازی، بررسی سقف حجم سرویس‌ها و غیرفعال کردن کانفیگ‌ها"""
+    logger.info(f"[{datetime.now()}] Starting sync_usage_reduce_task {run_id}")
+    try:
+        summaries = run_results(run_id)
+        engine = create_engine(rx.config.get_config().db_url)
+        with Session(engine) as session:
+            panels = session.query(Panel).all()
+        return _reduce_usage(engine, panels, summaries)
+    except Exception as e:
+        logger.error(f"Error in sync_usage_reduce_task {run_id}: {e}")
+        raise
+    finally:
+        clear_run(run_id)
+
+def sync_watchlist_usage_task():
+    """
+    پایش سریع سرویس‌های لیست پایش (نزدیک سقف حجم یا زمان انقضا): فقط کانفیگ‌های همین سرویس‌ها
+    از طریق endpoint ترافیک هر کلاینت/inbound خوانده می‌شوند و لیست کامل inbound پنل‌ها دریافت نمی‌شود.
+    """
+    service_ids = watched_service_ids()
+    if not service_ids:
+        return {"services": 0}
+    
+    try:
+        engine = create_engine(rx.config.get_config().db_url)
+        with Session(engine) as session:
+            rows = session.query(
+                PanelConfig.id.label("config_id"),
+                PanelConfig.managed_service_id.label("service_id"),
+                PanelConfig.panel_id,
+                PanelConfig.panel_inbound_id,
+                PanelConfig.client_id,
+                PanelConfig.client_email,
+                UsageCounter.last_up,
+                UsageCounter.last_down,
+            ).join(
+                ManagedService, PanelConfig.managed_service_id == ManagedService.id
+            ).outerjoin(
+                UsageCounter, UsageCounter.config_id == PanelConfig.id
+            ).filter(
+                ManagedService.id.in_(service_ids),
+                ManagedService.status == "active",
+            ).all()
+            # Services that are no longer active leave the watchlist
+            update_watchlist([], set(service_ids) - {row.service_id for row in rows})
+            if not rows:
+                return {"services": 0}
+            
+            by_panel = {}
+            for row in rows:
+                by_panel.setdefault(row.panel_id, []).append(row)
+            panels = session.query(Panel).all()
+        
+        async def poll_panel(client, panel):
+            configs = by_panel[panel.id]
+            results = await asyncio.gather(*(
+                client.get_client_traffic(config.client_email) if config.client_id else client.get_single_inbound_traffic(config.panel_inbound_id)
+                for config in configs
+            ), return_exceptions=True)
+            return {config.config_id: result for config, result in zip(configs, results) if isinstance(result, dict)}
+        
+        # No DB session is held while the panels are polled
+        polled = run_fan_out([panel for panel in panels if panel.id in by_panel], poll_panel)
+        for panel_id, error in polled["errors"].items():
+            logger.error(f"Error polling watched configs on panel {panel_id}: {error}")
+        traffic = {}
+        for panel_traffic in polled["results"].values():
+            traffic.update(panel_traffic)
+        
+        with Session(engine) as session:
+            service_deltas = _apply_counters(session, rows, {config_id: (t["up"], t["down"]) for config_id, t in traffic.items()})
+            # Every watched service is checked, also those without new traffic (for expiry)
+            services = _load_services(session, {row.service_id for row in rows})
+            status_changes, disable_ids, _ = _enforce_limits(session, services, check_expiry=True)
+            to_disable = [
+                config for config in _service_config_rows(session, disable_ids)
+                if traffic.get(config.config_id, {}).get("enable") is not False
+            ] if disable_ids else []
+        
+        disabled = disable_configs(panels, to_disable) if to_disable else 0
+        return {"services": len(services), "updated": len(service_deltas), "disabled": disabled}
+    
+    except Exception as e:
+        logger.error(f"Error in sync_watchlist_usage_task: {e}")
+        raise
 
 def sync_usage_continuous_task():
-    """تسک همگام‌سازی حجم استفاده شده سرویس‌ها - Continuous Mode"""
+    """تسک همگام‌سازی حجم استفاده شده سرویس‌ها - Continuous Mode (هر پنل با فاصله تطبیقی خودش، پخش شده بین shard ها)"""
     logger.info(f"[{datetime.now()}] Starting sync_usage_continuous_task")
+    import time
+    engine = create_engine(rx.config.get_config().db_url)
+    last_watchlist_run = 0.0
     
     while True:
         try:
-            # Enqueue a new sync_usage task for each iteration
-            task_id = f"sync_usage_{int(datetime.now().timestamp() * 1000)}"
-            from .redis_queue import redis_queue
-            redis_queue.enqueue_task("sync_usage", task_id, {})
+            with Session(engine) as session:
+                panel_ids = [panel_id for (panel_id,) in session.query(Panel.id).all()]
+            
+            from .redis_queue import redis_queue, new_task_id
+            # Only one worker process dispatches; every process runs shard workers
+            if not acquire_dispatcher(usage_scheduler.XUI_SYNC_TICK * 3):
+                time.sleep(usage_scheduler.XUI_SYNC_TICK)
+                continue
+            
+            # Split the panels whose next sync is due into shard tasks of one sync run
+            # While shards of an earlier run are still unclaimed, due panels wait instead of piling up
+            due = usage_scheduler.due_panels(panel_ids) if not redis_queue.redis_client.zcard("queue:sync_usage_shard") else []
+            if due:
+                shards = shard_panels(due, XUI_SYNC_SHARD_SIZE)
+                run_id = start_run(len(shards))
+                redis_queue.enqueue_many("sync_usage_shard", ({"run_id": run_id, "panel_ids": shard} for shard in shards))
+            
+            # Services close to their limit or end date are polled on the fast lane
+            if time.time() - last_watchlist_run >= XUI_WATCHLIST_INTERVAL:
+                last_watchlist_run = time.time()
+                if watched_service_ids():
+                    task_id = new_task_id("sync_usage_watchlist")
+                    redis_queue.enqueue_task("sync_usage_watchlist", task_id, {}, coalesce_key="all")
             
-            # Wait 30 seconds before next iteration
-            logger.info("Waiting 30 seconds before next sync_usage iteration...")
-            import time
-            time.sleep(30)
+            time.sleep(usage_scheduler.XUI_SYNC_TICK)
             
         except KeyboardInterrupt:
             logger.info("sync_usage_continuous_task interrupted by user")
@@ -153,7 +510,6 @@ def sync_usage_continuous_task():
         except Exception as e:
             logger.error(f"Critical error in sync_usage_continuous_task: {e}")
             # Wait a bit before retrying
-            import time
             time.sleep(60)
 
 def build_configs_task(service_uuid: str):
@@ -168,59 +524,35 @@ def build_configs_task(service_uuid: str):
                 logger.error(f"Service with UUID {service_uuid} not found")
                 return
             
-            # Get all panels
-            panels = session.query(Panel).all()
+            # Panels that already have this service's config (from an earlier attempt) are skipped
+            existing_panel_ids = {
+                panel_id for (panel_id,) in
+                session.query(PanelConfig.panel_id).filter(PanelConfig.managed_service_id == service.id).all()
+            }
+            panels = [panel for panel in session.query(Panel).all() if panel.id not in existing_panel_ids]
+            
+            spec = service_spec(service)
+            
+            async def create_on_panel(client, panel):
+                logger.info(f"[{datetime.now()}] Processing panel: {panel.url}")
+                return await provision_service_async(client, panel, spec)
+            
+            # Create inbounds on all panels concurrently, then save the results
+            created = run_fan_out(panels, create_on_panel)
             
             for panel in panels:
+                if panel.id in created["errors"]:
+                    logger.error(f"Error processing panel {panel.url}: {created['errors'][panel.id]}")
+                    continue
+                result = created["results"][panel.id]
                 try:
-                    logger.info(f"[{datetime.now()}] Processing panel: {panel.url}")
-                    logger.info(f"[{datetime.now()}] Attempt 1 for panel {panel.url}")
-                    
-                    client = XUIClient(panel.url, panel.username, panel.password)
-                    
-                    # Find available port
-                    used_ports = client.get_used_ports()
-                    port = 20000
-                    while port in used_ports:
-                        port += 1
-                    
-                    # Create inbound based on service protocol
-                    if service.protocol == "vless":
-                        # Create unique remark to prevent duplicates
-                        unique_remark = f"{panel.remark_prefix}-{service.name}-{str(uuid4())[:8]}"
-                        result = client.create_vless_inbound(
-                            remark=unique_remark,
-                            domain=panel.domain,
-                            port=port,
-                            expiry_days=(service.end_date - service.start_date).days,
-                            limit_gb=service.data_limit_gb
-                        )
-                    elif service.protocol == "shadowsocks":
-                        # Create unique remark to prevent duplicates
-                        unique_remark = f"{panel.remark_prefix}-{service.name}-{str(uuid4())[:8]}"
-                        result = client.create_shadowsocks_inbound(
-                            remark=unique_remark,
-                            domain=panel.domain,
-                            port=port,
-                            expiry_days=(service.end_date - service.start_date).days,
-                            limit_gb=service.data_limit_gb
-                        )
-                    else:
-                        logger.warning(f"Unsupported protocol: {service.protocol}")
-                        continue
-                    
                     # Verify result has valid data
                     if not result.get("link") or not result.get("inbound_id"):
                         logger.error(f"[{datetime.now()}] ERROR: Invalid result from panel {panel.url}: {result}")
                         continue
                     
                     # Save config to database
-                    config = PanelConfig(
-                        managed_service_id=service.id,
-                        panel_id=panel.id,
-                        panel_inbound_id=result["inbound_id"],
-                        config_link=result["link"]
-                    )
+                    config = new_panel_config(service.id, panel.id, result)
                     session.add(config)
                     session.commit()
                     
@@ -231,6 +563,7 @@ def build_configs_task(service_uuid: str):
                         logger.error(f"[{datetime.now()}] ERROR: config_link is empty after saving! Panel: {panel.url}")
                         # Try to regenerate config_link
                         try:
+                            client = get_panel_client(panel)
                             inbound_data = client.get_inbound(result["inbound_id"])
                             if inbound_data:
                                 config_link = client._construct_config_link(inbound_data, panel.domain)
@@ -251,16 +584,7 @@ def build_configs_task(service_uuid: str):
                 
                 if subscription_content.strip():
                     # Create subscription file
-                    subs_dir = "static/subs"
-                    os.makedirs(subs_dir, exist_ok=True)
-                    file_path = os.path.join(subs_dir, f"{service_uuid}.txt")
-                    
-                    # Encode to base64
-                    import base64
-                    encoded_content = base64.b64encode(subscription_content.encode('utf-8')).decode('utf-8')
-                    
-                    with open(file_path, "w", encoding='utf-8') as f:
-                        f.write(encoded_content)
+                    file_path = write_subscription_file(service_uuid, subscription_content)
                     
                     # Also update service.subscription_link
                     service.subscription_link = subscription_content
@@ -276,6 +600,11 @@ def build_configs_task(service_uuid: str):
             
             logger.info(f"[{datetime.now()}] Celery background config building completed for service {service_uuid}")
             
+            # Panels that were down or timed out are retried later; the next attempt only builds those
+            transient = [panel.url for panel in panels if isinstance(created["errors"].get(panel.id), TRANSIENT_ERRORS)]
+            if transient:
+                raise RetryableTaskError(f"Could not reach panels {transient} for service {service_uuid}")
+            
     except Exception as e:
         logger.error(f"Build configs job failed with error: {e}")
         raise
@@ -304,8 +633,11 @@ def cleanup_deleted_panels_task():
         logger.error(f"Cleanup job failed with error: {e}")
         raise
 
-def update_service_task(service_uuid: str, **updates):
-    """تسک به‌روزرسانی سرویس"""
+def update_service_task(service_uuid: str, retry_config_ids: Optional[List[int]] = None, **updates):
+    """
+    تسک به‌روزرسانی سرویس.
+    retry_config_ids: کانفیگ‌هایی که در تلاش قبلی به خاطر خطای موقتی پنل به‌روز نشدند (توسط retry پر می‌شود)
+    """
     logger.info(f"[{datetime.now()}] Starting update_service_task for service: {service_uuid}")
     
     try:
@@ -334,35 +666,45 @@ def update_service_task(service_uuid: str, **updates):
                 service.data_limit_gb != original_data_limit
             )
             
-            if configs_need_update:
+            failed_config_ids = []
+            if configs_need_update or retry_config_ids:
                 logger.info(f"Service {service_uuid} has important updates, updating X-UI configs...")
                 
-                # Get all configs for this service
-                configs = session.query(PanelConfig).filter(PanelConfig.managed_service_id == service.id).all()
+                # Get all configs for this service (on a retry only the ones that failed before)
+                query = session.query(PanelConfig).filter(PanelConfig.managed_service_id == service.id)
+                if not configs_need_update:
+                    query = query.filter(PanelConfig.id.in_(retry_config_ids))
+                configs = query.all()
                 
                 for config in configs:
                     try:
                         panel = session.query(Panel).filter(Panel.id == config.panel_id).first()
                         if panel:
-                            client = XUIClient(panel.url, panel.username, panel.password)
+                            client = get_panel_client(panel)
                             
                             # Calculate new expiry days
                             expiry_days = (service.end_date - service.start_date).days
                             
-                            # Update the inbound with new settings
-                            client.update_inbound_simple(
-                                inbound_id=config.panel_inbound_id,
-                                expiry_days=expiry_days,
-                                limit_gb=service.data_limit_gb
-                            )
+                            # Update the inbound (or shared-inbound client) with new settings
+                            update_panel_config(client, config, expiry_days, service.data_limit_gb)
                             
                             logger.info(f"Updated config {config.panel_inbound_id} for service {service.name} on panel {panel.url}")
                         else:
                             logger.warning(f"Panel not found for config {config.id}")
                     except Exception as e:
                         logger.error(f"Error updating config {config.panel_inbound_id} for service {service.name}: {e}")
+                        if isinstance(e, TRANSIENT_ERRORS):
+                            failed_config_ids.append(config.id)
             
             session.commit()
+            if failed_config_ids:
+                raise RetryableTaskError(
+                    f"Could not update {len(failed_config_ids)} configs of service {service_uuid}",
+                    # The field updates are already saved; the retry only pushes the current values to the failed configs
+                    # so it can never revert an update of the same service that ran in between
+                    retry_data={"service_uuid": service_uuid, "retry_config_ids": failed_config_ids},
+                    replace_data=True,
+                )
             logger.info(f"[{datetime.now()}] Service {service_uuid} updated successfully")
             
     except Exception as e:
@@ -423,38 +765,12 @@ def sync_services_with_panels_task():
                         try:
                             logger.info(f"[{datetime.now()}] Creating config for service {service.name} on panel {panel.url}")
                             
-                            client = XUIClient(panel.url, panel.username, panel.password)
-                            used_ports = client.get_used_ports()
-                            port = 20000
-                            while port in used_ports:
-                                port += 1
+                            client = get_panel_client(panel)
                             
                             if service.protocol in ["vless", "shadowsocks"]:
-                                # Create unique remark to prevent duplicates
-                                unique_remark = f"{panel.remark_prefix}-{service.name}-{str(uuid4())[:8]}"
-                                if service.protocol == "vless":
-                                    result = client.create_vless_inbound(
-                                        remark=unique_remark,
-                                        domain=panel.domain,
-                                        port=port,
-                                        expiry_days=(service.end_date - service.start_date).days,
-                                        limit_gb=service.data_limit_gb
-                                    )
-                                else:
-                                    result = client.create_shadowsocks_inbound(
-                                        remark=unique_remark,
-                                        domain=panel.domain,
-                                        port=port,
-                                        expiry_days=(service.end_date - service.start_date).days,
-                                        limit_gb=service.data_limit_gb
-                                    )
+                                result = provision_service(client, panel, service_spec(service))
                                 
-                                config = PanelConfig(
-                                    managed_service_id=service.id,
-                                    panel_id=panel.id,
-                                    panel_inbound_id=result["inbound_id"],
-                                    config_link=result["link"]
-                                )
+                                config = new_panel_config(service.id, panel.id, result)
                                 session.add(config)
                                 session.commit()  # Commit immediately to avoid conflicts
                                 
@@ -489,16 +805,7 @@ def sync_services_with_panels_task():
                         subscription_content = "\n".join([config.config_link for config in configs if config.config_link])
                         
                         # Create subscription file
-                        subs_dir = "static/subs"
-                        os.makedirs(subs_dir, exist_ok=True)
-                        file_path = os.path.join(subs_dir, f"{service.uuid}.txt")
-                        
-                        # Encode to base64
-                        import base64
-                        encoded_content = base64.b64encode(subscription_content.encode('utf-8')).decode('utf-8')
-                        
-                        with open(file_path, "w", encoding='utf-8') as f:
-                            f.write(encoded_content)
+                        write_subscription_file(service.uuid, subscription_content)
                         
                         logger.info(f"[{datetime.now()}] Updated subscription file for service {service.name} with {len(configs)} configs")
                     else:
@@ -516,49 +823,53 @@ def sync_services_with_panels_task():
 # Helper functions for enqueuing tasks
 def enqueue_sync_usage():
     """Enqueue sync_usage task"""
-    from .redis_queue import redis_queue
-    task_id = f"sync_usage_{int(datetime.now().timestamp() * 1000)}"
-    redis_queue.enqueue_task("sync_usage", task_id, {})
+    from .redis_queue import redis_queue, new_task_id
+    task_id = new_task_id("sync_usage")
+    task_id = redis_queue.enqueue_task("sync_usage", task_id, {}, coalesce_key="all")
     # Silent execution - no logging
     return task_id
 
 def enqueue_build_configs(service_uuid: str):
     """Enqueue build_configs task"""
-    from .redis_queue import redis_queue
-    task_id = f"build_configs_{int(datetime.now().timestamp() * 1000)}"
-    redis_queue.enqueue_task("build_configs", task_id, {"service_uuid": service_uuid})
+    from .redis_queue import redis_queue, new_task_id
+    task_id = new_task_id("build_configs")
+    task_id = redis_queue.enqueue_task("build_configs", task_id, {"service_uuid": service_uuid}, coalesce_key=service_uuid)
     logger.info(f"Build configs task enqueued: {task_id}")
     return task_id
 
 def enqueue_cleanup_panels():
     """Enqueue cleanup_panels task"""
-    from .redis_queue import redis_queue
-    task_id = f"cleanup_panels_{int(datetime.now().timestamp() * 1000)}"
-    redis_queue.enqueue_task("cleanup_panels", task_id, {})
+    from .redis_queue import redis_queue, new_task_id
+    task_id = new_task_id("cleanup_panels")
+    task_id = redis_queue.enqueue_task("cleanup_panels", task_id, {}, coalesce_key="all")
     logger.info(f"Cleanup panels task enqueued: {task_id}")
     return task_id
 
 def enqueue_update_service(service_uuid: str, **updates):
     """Enqueue update_service task"""
-    from .redis_queue import redis_queue
-    task_id = f"update_service_{int(datetime.now().timestamp() * 1000)}"
-    redis_queue.enqueue_task("update_service", task_id, {"service_uuid": service_uuid, **updates})
+    from .redis_queue import redis_queue, new_task_id, COALESCE_MERGE
+    task_id = new_task_id("update_service")
+    # Repeated updates of a service that is still queued are merged into one task (last writer wins per field)
+    task_id = redis_queue.enqueue_task(
+        "update_service", task_id, {"service_uuid": service_uuid, **updates},
+        coalesce_key=service_uuid, coalesce=COALESCE_MERGE,
+    )
     logger.info(f"Update service task enqueued: {task_id}")
     return task_id
 
 def enqueue_delete_service(service_uuid: str):
     """Enqueue delete_service task"""
-    from .redis_queue import redis_queue
-    task_id = f"delete_service_{int(datetime.now().timestamp() * 1000)}"
-    redis_queue.enqueue_task("delete_service", task_id, {"service_uuid": service_uuid})
+    from .redis_queue import redis_queue, new_task_id
+    task_id = new_task_id("delete_service")
+    task_id = redis_queue.enqueue_task("delete_service", task_id, {"service_uuid": service_uuid}, coalesce_key=service_uuid)
     logger.info(f"Delete service task enqueued: {task_id}")
     return task_id
 
 def enqueue_sync_services_with_panels():
     """Enqueue sync_services_with_panels task"""
-    from .redis_queue import redis_queue
-    task_id = f"sync_services_with_panels_{int(datetime.now().timestamp() * 1000)}"
-    redis_queue.enqueue_task("sync_services_with_panels", task_id, {})
+    from .redis_queue import redis_queue, new_task_id
+    task_id = new_task_id("sync_services_with_panels")
+    task_id = redis_queue.enqueue_task("sync_services_with_panels", task_id, {}, coalesce_key="all")
     logger.info(f"Sync services with panels task enqueued: {task_id}")
     return task_id
 
@@ -571,6 +882,7 @@ def check_and_update_service_status():
         with Session(engine) as session:
             active_services = session.query(ManagedService).filter(ManagedService.status == "active").all()
             updated_count = 0
+            disabled_service_ids = []
             for service in active_services:
                 current_time = datetime.now()
                 status_changed = False
@@ -586,21 +898,13 @@ def check_and_update_service_status():
                 if status_changed:
                     service.status = new_status
                     updated_count += 1
-                    if new_status in ["expired", "limit_reached"]:
-                        configs = session.query(PanelConfig).filter(PanelConfig.managed_service_id == service.id).all()
-                        for config in configs:
-                            try:
-                                panel = config.panel
-                                if panel:
-                                    client = XUIClient(panel.url, panel.username, panel.password)
-                                    client.disable_inbound(config.panel_inbound_id)
-                                else:
-                                    logger.warning(f"Panel not found for config {config.id}")
-                            except Exception as e:
-                                logger.error(f"Error disabling inbound {config.panel_inbound_id}: {e}")
+                    if new_status in DISABLED_STATUSES:
+                        disabled_service_ids.append(service.id)
             if updated_count > 0:
                 session.commit()
                 logger.info(f"Updated status for {updated_count} services")
+                if disabled_service_ids:
+                    disable_configs(session.query(Panel).all(), _service_config_rows(session, disabled_service_ids))
             else:
                 pass # logger.info("No service status updates needed") # Disabled log
     except Exception as e:
@@ -621,37 +925,29 @@ def check_expired_services():
             ).all()
             if not expired_services:
                 return
+            disabled_service_ids = []
             for service in expired_services:
                 service.status = "expired"
-                configs = session.query(PanelConfig).filter(PanelConfig.managed_service_id == service.id).all()
-                for config in configs:
-                    try:
-                        panel = config.panel
-                        if panel:
-                            client = XUIClient(panel.url, panel.username, panel.password)
-                            client.disable_inbound(config.panel_inbound_id)
-                        else:
-                            logger.warning(f"Panel not found for config {config.id}")
-                    except Exception as e:
-                        logger.error(f"Error disabling expired inbound {config.panel_inbound_id}: {e}")
-                session.commit()
+                disabled_service_ids.append(service.id)
+            session.commit()
+            disable_configs(session.query(Panel).all(), _service_config_rows(session, disabled_service_ids))
     except Exception as e:
         logger.error(f"Error in check_expired_services: {e}")
         raise
 
 def enqueue_check_service_status():
     """Enqueue check_service_status task"""
-    from .redis_queue import redis_queue
-    task_id = f"check_service_status_{int(datetime.now().timestamp() * 1000)}"
-    redis_queue.enqueue_task("check_service_status", task_id, {})
+    from .redis_queue import redis_queue, new_task_id
+    task_id = new_task_id("check_service_status")
+    task_id = redis_queue.enqueue_task("check_service_status", task_id, {}, coalesce_key="all")
     logger.info(f"Check service status task enqueued: {task_id}")
     return task_id
 
 def enqueue_check_expired_services():
     """Enqueue check_expired_services task"""
-    from .redis_queue import redis_queue
-    task_id = f"check_expired_services_{int(datetime.now().timestamp() * 1000)}"
-    redis_queue.enqueue_task("check_expired_services", task_id, {})
+    from .redis_queue import redis_queue, new_task_id
+    task_id = new_task_id("check_expired_services")
+    task_id = redis_queue.enqueue_task("check_expired_services", task_id, {}, coalesce_key="all")
     logger.info(f"Check expired services task enqueued: {task_id}")
     return task_id
 
@@ -0,0 +1,114 @@
+# xui_multi/usage_scheduler.py
+
+import os
+import time
+import logging
+from typing import Dict, Iterable, List, Optional
+
+from .panel_clients import XUI_FANOUT_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+# Bounds (seconds) of each panel's adaptive usage-sync interval
+XUI_SYNC_MIN_INTERVAL = float(os.getenv("XUI_SYNC_MIN_INTERVAL", "15"))
+XUI_SYNC_MAX_INTERVAL = float(os.getenv("XUI_SYNC_MAX_INTERVAL", "300"))
+XUI_SYNC_DEFAULT_INTERVAL = float(os.getenv("XUI_SYNC_DEFAULT_INTERVAL", "30"))
+# Factor by which a quiet panel's interval grows per sync (up to XUI_SYNC_MAX_INTERVAL)
+XUI_SYNC_BACKOFF_FACTOR = max(1.0, float(os.getenv("XUI_SYNC_BACKOFF_FACTOR", "1.5")))
+# How often the dispatcher looks for due panels
+XUI_SYNC_TICK = float(os.getenv("XUI_SYNC_TICK", "5"))
+# Minimum time a dispatched panel stays reserved: its shard may wait in the queue and then take up to the
+# fan-out timeout. The run's reduce step replaces the reservation with the panel's real next due time.
+XUI_SYNC_PANEL_LEASE = float(os.getenv("XUI_SYNC_PANEL_LEASE", str(XUI_FANOUT_TIMEOUT * 4)))
+
+DUE_KEY = "usage_sync:due"            # zset: panel_id -> next due time
+INTERVAL_KEY = "usage_sync:interval"  # hash: panel_id -> current interval
+TRAFFIC_KEY = "usage_sync:traffic"    # hash: panel_id -> "total_bytes:timestamp" of the last sync
+
+def _redis():
+    from .redis_queue import redis_queue
+    return redis_queue.redis_client
+
+def _clamp(interval: float) -> float:
+    return max(XUI_SYNC_MIN_INTERVAL, min(XUI_SYNC_MAX_INTERVAL, interval))
+
+def next_interval(previous: float, traffic_rate: Optional[float], min_remaining_bytes: Optional[int]) -> float:
+    """
+    فاصله بعدی همگام‌سازی یک پنل:
+    - بدون ترافیک جدید یا بدون سرویس فعالی که در این دور مصرف جدید داشته باشد: فاصله قبلی ضرب در XUI_SYNC_BACKOFF_FACTOR
+      (پنل ساکت به تدریج به حداکثر فاصله می‌رسد، نه بعد از یک دور)
+    - با ترافیک: نصف زمانی که نزدیک‌ترین سرویس فعال پنل با نرخ فعلی ترافیک پنل به سقف حجمش می‌رسد
+    """
+    if min_remaining_bytes is not None and min_remaining_bytes <= 0:
+        return XUI_SYNC_MIN_INTERVAL
+    if min_remaining_bytes is None or not traffic_rate or traffic_rate <= 0:
+        return _clamp(previous * XUI_SYNC_BACKOFF_FACTOR)
+    return _clamp(min_remaining_bytes / traffic_rate / 2)
+
+def due_panels(panel_ids: Iterable[int], now: Optional[float] = None) -> List[int]:
+    """
+    پنل‌هایی که زمان همگام‌سازی‌شان رسیده را برمی‌گرداند و آن‌ها را تا پایان فاصله فعلی‌شان (و حداقل XUI_SYNC_PANEL_LEASE)
+    رزرو می‌کند تا تا پایان دور همگام‌سازی دوباره ارسال نشوند. پنل‌های جدید بلافاصله سررسید می‌شوند و پنل‌های حذف شده از زمان‌بند پاک می‌شوند.
+    """
+    now = now or time.time()
+    redis = _redis()
+    known = {str(panel_id) for panel_id in panel_ids}
+    scheduled = set(redis.zrange(DUE_KEY, 0, -1))
+    removed = scheduled - known
+    if removed:
+        redis.zrem(DUE_KEY, *removed)
+        redis.hdel(INTERVAL_KEY, *removed)
+        redis.hdel(TRAFFIC_KEY, *removed)
+    added = known - scheduled
+    if added:
+        redis.zadd(DUE_KEY, {panel_id: 0 for panel_id in added}, nx=True)
+
+    due = redis.zrangebyscore(DUE_KEY, "-inf", now)
+    if not due:
+        return []
+    intervals = redis.hmget(INTERVAL_KEY, due)
+    redis.zadd(DUE_KEY, {
+        panel_id: now + max(float(interval or XUI_SYNC_DEFAULT_INTERVAL), XUI_SYNC_PANEL_LEASE)
+        for panel_id, interval in zip(due, intervals)
+    }, xx=True)
+    return [int(panel_id) for panel_id in due]
+
+def reschedule(panel_stats: Dict[int, Dict[str, Optional[int]]], now: Optional[float] = None):
+    """
+    بعد از همگام‌سازی، فاصله و زمان سررسید بعدی هر پنل را بر اساس ترافیک مشاهده شده و
+    نزدیکی سرویس‌های فعال به سقف حجم به‌روز می‌کند.
+    panel_stats: {panel_id: {"traffic_bytes": مجموع up+down پنل, "min_remaining_bytes": کمترین حجم باقیمانده}}
+    """
+    if not panel_stats:
+        return
+    now = now or time.time()
+    try:
+        redis = _redis()
+        keys = [str(panel_id) for panel_id in panel_stats]
+        intervals = redis.hmget(INTERVAL_KEY, keys)
+        last_traffic = redis.hmget(TRAFFIC_KEY, keys)
+        new_intervals = {}
+        new_traffic = {}
+        due = {}
+        for key, previous, last, stats in zip(keys, intervals, last_traffic, panel_stats.values()):
+            traffic_bytes = stats.get("traffic_bytes")
+            rate = None
+            if last and traffic_bytes is not None:
+                last_bytes, last_time = last.split(":")
+                elapsed = now - float(last_time)
+                if elapsed > 0:
+                    # A panel traffic reset makes the delta negative; treat it as unknown
+                    rate = max(0, traffic_bytes - int(last_bytes)) / elapsed
+            interval = next_interval(float(previous or XUI_SYNC_DEFAULT_INTERVAL), rate, stats.get("min_remaining_bytes"))
+            new_intervals[key] = interval
+            due[key] = now + interval
+            if traffic_bytes is not None:
+                new_traffic[key] = f"{traffic_bytes}:{now}"
+        pipe = redis.pipeline()
+        pipe.hset(INTERVAL_KEY, mapping=new_intervals)
+        if new_traffic:
+            pipe.hset(TRAFFIC_KEY, mapping=new_traffic)
+        pipe.zadd(DUE_KEY, due)
+        pipe.execute()
+    except Exception as e:
+        logger.error(f"Error rescheduling usage sync: {e}")
@@ -0,0 +1,96 @@
+# xui_multi/usage_shards.py
+
+import os
+import json
+import logging
+from collections import namedtuple
+from typing import Any, Dict, Iterable, List
+from uuid import uuid4
+
+logger = logging.getLogger(__name__)
+
+# Panels per sync_usage_shard task (1 = one task per panel)
+XUI_SYNC_SHARD_SIZE = max(1, int(os.getenv("XUI_SYNC_SHARD_SIZE", "5")))
+# sync_usage_shard worker threads per worker process
+XUI_SYNC_SHARD_WORKERS = max(1, int(os.getenv("XUI_SYNC_SHARD_WORKERS", "2")))
+# How long (seconds) the bookkeeping of an unfinished sync run is kept
+XUI_SYNC_RUN_TTL = int(os.getenv("XUI_SYNC_RUN_TTL", "600"))
+
+DISPATCHER_KEY = "usage_sync:dispatcher"
+
+# کانفیگی که باید غیرفعال شود، به شکلی که از خروجی shard ها (JSON) دوباره ساخته می‌شود
+ConfigRef = namedtuple("ConfigRef", ["config_id", "panel_id", "panel_inbound_id", "client_id", "client_email"])
+
+# شناسه این پروسه برای قفل dispatcher
+_process_token = uuid4().hex
+
+def _redis():
+    from .redis_queue import redis_queue
+    return redis_queue.redis_client
+
+def _pending_key(run_id: str) -> str:
+    return f"usage_sync_run:{run_id}:pending"
+
+def _results_key(run_id: str) -> str:
+    return f"usage_sync_run:{run_id}:results"
+
+def shard_panels(panel_ids: Iterable[int], size: int = XUI_SYNC_SHARD_SIZE) -> List[List[int]]:
+    panel_ids = list(panel_ids)
+    return [panel_ids[i:i + size] for i in range(0, len(panel_ids), size)]
+
+def acquire_dispatcher(ttl: float) -> bool:
+    """
+    فقط یک پروسه (در میان همه پروسه‌های worker) پنل‌های سررسید شده را بین shard ها پخش می‌کند.
+    قفل تا زمانی که صاحبش آن را تمدید کند نگه داشته می‌شود.
+    """
+    try:
+        redis = _redis()
+        ttl = max(1, int(ttl))
+        if redis.set(DISPATCHER_KEY, _process_token, nx=True, ex=ttl):
+            return True
+        if redis.get(DISPATCHER_KEY) == _process_token:
+            redis.expire(DISPATCHER_KEY, ttl)
+            return True
+        return False
+    except Exception as e:
+        logger.error(f"Error acquiring usage sync dispatcher lock: {e}")
+        return False
+
+def start_run(shard_count: int) -> str:
+    """ثبت یک دور همگام‌سازی با shard_count تکه؛ خروجی: شناسه دور"""
+    run_id = uuid4().hex
+    _redis().set(_pending_key(run_id), shard_count, ex=XUI_SYNC_RUN_TTL)
+    return run_id
+
+def finish_shard(run_id: str, shard_key: str, summary: Dict[str, Any]) -> bool:
+    """
+    ذخیره خلاصه یک shard و کم کردن شمارنده shard های باقیمانده.
+    فقط برای آخرین shard (شمارنده به صفر رسیده) True برمی‌گرداند تا reduce دقیقاً یک بار ارسال شود.
+    """
+    pipe = _redis().pipeline()
+    pipe.hset(_results_key(run_id), shard_key, json.dumps(summary))
+    pipe.expire(_results_key(run_id), XUI_SYNC_RUN_TTL)
+    pipe.decr(_pending_key(run_id))
+    remaining = pipe.execute()[-1]
+    return remaining == 0
+
+def run_results(run_id: str) -> List[Dict[str, Any]]:
+    """خلاصه همه shard های یک دور (کلیدهای JSON به عدد برگردانده می‌شوند)"""
+    summaries = []
+    for raw in _redis().hvals(_results_key(run_id)):
+        summary = json.loads(raw)
+        summaries.append({
+            "service_deltas": {int(service_id): delta for service_id, delta in summary["service_deltas"].items()},
+            "stale_configs": [ConfigRef(*config) for config in summary["stale_configs"]],
+            "panels": {int(panel_id): stats for panel_id, stats in summary["panels"].items()},
+        })
+    return summaries
+
+def clear_run(run_id: str):
+    try:
+        _redis().delete(_pending_key(run_id), _results_key(run_id))
+    except Exception as e:
+        logger.error(f"Error clearing usage sync run {run_id}: {e}")
+
+def empty_summary() -> Dict[str, Any]:
+    return {"service_deltas": {}, "stale_configs": [], "panels": {}}
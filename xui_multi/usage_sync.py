@@ -0,0 +1,61 @@
+# xui_multi/usage_sync.py
+
+from typing import Dict, Any, Iterable, List, Optional, Tuple
+
+GB = 1024 * 1024 * 1024
+
+# (up, down, enable)
+Traffic = Tuple[int, int, bool]
+
+class PanelUsage:
+    """
+    داده فشرده ترافیک یک پنل که از لیست inbound ها ساخته می‌شود: فقط up/down/enable
+    به ازای هر inbound و به ازای هر کلاینت inbound های اشتراکی (بر اساس email).
+    """
+
+    __slots__ = ("inbounds", "clients")
+
+    def __init__(self, inbounds: List[Dict[str, Any]]):
+        self.inbounds: Dict[int, Traffic] = {}
+        self.clients: Dict[str, Traffic] = {}
+        for inbound in inbounds:
+            self.inbounds[inbound.get("id")] = (inbound.get("up", 0) or 0, inbound.get("down", 0) or 0, inbound.get("enable", True))
+            for stat in inbound.get("clientStats") or []:
+                self.clients[stat.get("email")] = (stat.get("up", 0) or 0, stat.get("down", 0) or 0, stat.get("enable", True))
+
+    def traffic(self, inbound_id: int, client_email: Optional[str] = None) -> Optional[Traffic]:
+        if client_email is None:
+            return self.inbounds.get(inbound_id)
+        return self.clients.get(client_email)
+
+    def config_enabled(self, inbound_id: int, client_email: Optional[str] = None) -> Optional[bool]:
+        """وضعیت فعال بودن کانفیگ روی پنل؛ None اگر inbound/کلاینت در لیست پنل نباشد"""
+        traffic = self.traffic(inbound_id, client_email)
+        return None if traffic is None else traffic[2]
+
+    def config_counters(self, configs: Iterable[Tuple[int, int, Optional[str]]]) -> Dict[int, Tuple[int, int]]:
+        """
+        شمارنده‌های فعلی (up, down) هر کانفیگ در یک پیمایش روی ردیف‌های (config_id, inbound_id, client_email).
+        کانفیگ‌هایی که inbound/کلاینت آن‌ها در لیست پنل پیدا نشده در خروجی نیستند.
+        """
+        counters: Dict[int, Tuple[int, int]] = {}
+        inbounds = self.inbounds
+        clients = self.clients
+        for config_id, inbound_id, client_email in configs:
+            traffic = clients.get(client_email) if client_email is not None else inbounds.get(inbound_id)
+            if traffic is not None:
+                counters[config_id] = (traffic[0], traffic[1])
+        return counters
+
+    def total_traffic(self) -> int:
+        """مجموع up+down همه inbound های پنل (برای تخمین نرخ ترافیک در زمان‌بند)"""
+        return sum(up + down for up, down, _ in self.inbounds.values())
+
+def counter_delta(last_up: int, last_down: int, up: int, down: int) -> int:
+    """
+    مصرف جدید بین دو مقدار شمارنده. شمارنده‌ای که عقب رفته باشد (ریست ترافیک روی پنل یا ساخت مجدد inbound)
+    از صفر شروع شده در نظر گرفته می‌شود.
+    """
+    delta_up = up - last_up if up >= last_up else up
+    delta_down = down - last_down if down >= last_down else down
+    return delta_up + delta_down
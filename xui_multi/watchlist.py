@@ -0,0 +1,53 @@
+# xui_multi/watchlist.py
+
+import os
+import logging
+from datetime import datetime, timedelta
+from typing import Iterable, List, Optional
+
+from .usage_sync import GB
+
+logger = logging.getLogger(__name__)
+
+# Services above this fraction of data_limit_gb are polled on the fast lane
+XUI_WATCHLIST_USAGE_FRACTION = float(os.getenv("XUI_WATCHLIST_USAGE_FRACTION", "0.9"))
+# How often (seconds) watched services are polled
+XUI_WATCHLIST_INTERVAL = float(os.getenv("XUI_WATCHLIST_INTERVAL", "10"))
+
+WATCHLIST_KEY = "usage_watchlist"
+
+def _redis():
+    from .redis_queue import redis_queue
+    return redis_queue.redis_client
+
+def needs_watch(used_bytes: int, data_limit_gb: float, end_date: Optional[datetime], window_seconds: float, now: Optional[datetime] = None) -> bool:
+    """سرویس نزدیک سقف حجم است یا تا پایان پنجره همگام‌سازی بعدی منقضی می‌شود"""
+    if used_bytes >= data_limit_gb * GB * XUI_WATCHLIST_USAGE_FRACTION:
+        return True
+    if end_date is not None:
+        now = now or datetime.now()
+        return end_date <= now + timedelta(seconds=window_seconds)
+    return False
+
+def update_watchlist(watch_ids: Iterable[int], unwatch_ids: Iterable[int]):
+    """افزودن/حذف سرویس‌ها از لیست پایش سریع"""
+    watch_ids = list(watch_ids)
+    unwatch_ids = list(unwatch_ids)
+    if not watch_ids and not unwatch_ids:
+        return
+    try:
+        pipe = _redis().pipeline()
+        if watch_ids:
+            pipe.sadd(WATCHLIST_KEY, *watch_ids)
+        if unwatch_ids:
+            pipe.srem(WATCHLIST_KEY, *unwatch_ids)
+        pipe.execute()
+    except Exception as e:
+        logger.error(f"Error updating usage watchlist: {e}")
+
+def watched_service_ids() -> List[int]:
+    try:
+        return [int(service_id) for service_id in _redis().smembers(WATCHLIST_KEY)]
+    except Exception as e:
+        logger.error(f"Error reading usage watchlist: {e}")
+        return []
@@ -1,5 +1,6 @@
 # xui_multi/xui_client.py
 
+import asyncio
 import base64
 import httpx
 import json
@@ -7,7 +8,12 @@ import urllib.parse
 from uuid import uuid4
 from datetime import datetime, timedelta
 import os
-from typing import Optional, Dict, List, Any
+import threading
+import time
+import weakref
+from typing import Optional, Dict, List, Any, Callable
+
+from .circuit_breaker import PanelCircuitBreaker, is_panel_failure
 
 # Configure logging
 import logging
@@ -18,47 +24,250 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-class XUIClient:
-    def __init__(self, base_url, username, password):
+# --- HTTP connection pool settings (per panel) ---
+XUI_MAX_CONNECTIONS = int(os.getenv("XUI_MAX_CONNECTIONS", "20"))
+XUI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("XUI_MAX_KEEPALIVE_CONNECTIONS", "10"))
+XUI_KEEPALIVE_EXPIRY = float(os.getenv("XUI_KEEPALIVE_EXPIRY", "60"))
+XUI_CONNECT_TIMEOUT = float(os.getenv("XUI_CONNECT_TIMEOUT", "5"))
+XUI_READ_TIMEOUT = float(os.getenv("XUI_READ_TIMEOUT", "30"))
+XUI_HTTP2 = os.getenv("XUI_HTTP2", "false").lower() in ("1", "true", "yes")
+
+# How long (seconds) a fetched /panel/inbound/list snapshot is reused before refetching
+XUI_SNAPSHOT_TTL = float(os.getenv("XUI_SNAPSHOT_TTL", "10"))
+
+# Shared multi-client inbounds: how many per protocol on each panel and how many clients each should hold
+XUI_SHARED_INBOUNDS_PER_PROTOCOL = int(os.getenv("XUI_SHARED_INBOUNDS_PER_PROTOCOL", "4"))
+XUI_SHARED_INBOUND_MAX_CLIENTS = int(os.getenv("XUI_SHARED_INBOUND_MAX_CLIENTS", "1000"))
+XUI_FIRST_PORT = 20000
+
+_http_clients: Dict[str, httpx.Client] = {}
+_http_clients_lock = threading.Lock()
+
+def _http2_enabled() -> bool:
+    """HTTP/2 فقط در صورت نصب بودن پکیج h2 فعال می‌شود"""
+    if not XUI_HTTP2:
+        return False
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        logger.error("XUI_HTTP2 is enabled but the 'h2' package is not installed; falling back to HTTP/1.1")
+        return False
+
+def _pool_options() -> Dict[str, Any]:
+    return {
+        "limits": httpx.Limits(
+            max_connections=XUI_MAX_CONNECTIONS,
+            max_keepalive_connections=XUI_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=XUI_KEEPALIVE_EXPIRY,
+        ),
+        "timeout": httpx.Timeout(XUI_READ_TIMEOUT, connect=XUI_CONNECT_TIMEOUT),
+        "http2": _http2_enabled(),
+    }
+
+def get_http_client(base_url: str) -> httpx.Client:
+    """کلاینت HTTP مشترک و keep-alive هر پنل را برمی‌گرداند (یک pool برای هر آدرس پنل)"""
+    base_url = base_url.rstrip('/')
+    with _http_clients_lock:
+        client = _http_clients.get(base_url)
+        if client is None or client.is_closed:
+            client = httpx.Client(**_pool_options())
+            _http_clients[base_url] = client
+        return client
+
+_async_http_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, httpx.AsyncClient]]" = weakref.WeakKeyDictionary()
+
+def get_async_http_client(base_url: str) -> httpx.AsyncClient:
+    """نسخه async: کلاینت‌های AsyncClient به event loop وابسته‌اند، پس برای هر loop یک pool جدا نگه داشته می‌شود"""
+    base_url = base_url.rstrip('/')
+    loop = asyncio.get_running_loop()
+    with _http_clients_lock:
+        loop_clients = _async_http_clients.setdefault(loop, {})
+        client = loop_clients.get(base_url)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(**_pool_options())
+            loop_clients[base_url] = client
+        return client
+
+async def aclose_async_http_clients():
+    """بستن pool های async مربوط به event loop جاری"""
+    loop = asyncio.get_running_loop()
+    with _http_clients_lock:
+        loop_clients = _async_http_clients.pop(loop, {})
+    for client in loop_clients.values():
+        try:
+            await client.aclose()
+        except Exception as e:
+            logger.error(f"Error closing async HTTP client: {e}")
+
+def close_http_clients():
+    """بستن تمام اتصال‌های باز پنل‌ها (هنگام خاموش شدن پروسه)"""
+    with _http_clients_lock:
+        for client in _http_clients.values():
+            try:
+                client.close()
+            except Exception as e:
+                logger.error(f"Error closing HTTP client: {e}")
+        _http_clients.clear()
+
+class InboundSnapshot:
+    """کپی کوتاه‌مدت از لیست inbound های یک پنل با ایندکس بر اساس id، remark و port"""
+
+    def __init__(self, inbounds: List[Dict[str, Any]], ttl: float = XUI_SNAPSHOT_TTL):
+        self.fetched_at = time.monotonic()
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self.by_id: Dict[int, Dict[str, Any]] = {}
+        self.by_remark: Dict[str, int] = {}
+        self.by_port: Dict[int, int] = {}
+        for inbound in inbounds:
+            self._index(inbound)
+
+    def is_fresh(self) -> bool:
+        return time.monotonic() - self.fetched_at < self.ttl
+
+    def _index(self, inbound: Dict[str, Any]):
+        inbound_id = inbound.get("id")
+        if inbound_id is None:
+            return
+        self.by_id[inbound_id] = inbound
+        if inbound.get("remark") is not None:
+            self.by_remark[inbound["remark"]] = inbound_id
+        if inbound.get("port") is not None:
+            self.by_port[inbound["port"]] = inbound_id
+
+    def _unindex(self, inbound_id: int):
+        old = self.by_id.pop(inbound_id, None)
+        if not old:
+            return
+        if self.by_remark.get(old.get("remark")) == inbound_id:
+            del self.by_remark[old["remark"]]
+        if self.by_port.get(old.get("port")) == inbound_id:
+            del self.by_port[old["port"]]
+
+    def inbounds(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return list(self.by_id.values())
+
+    def get(self, inbound_id: int) -> Optional[Dict[str, Any]]:
+        return self.by_id.get(inbound_id)
+
+    def id_for_remark(self, remark: str) -> Optional[int]:
+        return self.by_remark.get(remark)
+
+    def used_ports(self) -> set:
+        with self._lock:
+            return set(self.by_port)
+
+    def upsert(self, inbound: Dict[str, Any]):
+        with self._lock:
+            self._unindex(inbound.get("id"))
+            self._index(inbound)
+
+    def remove(self, inbound_id: int):
+        with self._lock:
+            self._unindex(inbound_id)
+
+class _XUIClientBase:
+    """منطق مشترک XUIClient و AsyncXUIClient (ساخت payload، لینک کانفیگ و تشخیص خطای نشست)"""
+
+    def __init__(self, base_url, username, password, session_cookie: Optional[str] = None, on_login: Optional[Callable[[str], None]] = None, breaker: Optional[PanelCircuitBreaker] = None):
         self.base_url = base_url.rstrip('/')
         self.username = username
         self.password = password
-        self.session_cookie = self._login()
+        # کوکی نشست ذخیره شده (مثلاً Panel.cookie) دوباره استفاده می‌شود و لاگین فقط در صورت نیاز انجام می‌شود
+        self.session_cookie = {"session": session_cookie} if session_cookie else None
+        self.on_login = on_login
+        # circuit breaker مشترک پنل (در Redis)؛ وقتی باز است درخواست‌ها بدون انتظار برای timeout رد می‌شوند
+        self.breaker = breaker
+        self._snapshot: Optional[InboundSnapshot] = None
 
-    def _login(self):
-        login_url = f"{self.base_url}/login"
-        try:
-            with httpx.Client() as client:
-                response = client.post(login_url, data={"username": self.username, "password": self.password})
-                response.raise_for_status()
-                if "session" not in response.cookies:
-                    raise Exception("Login failed: 'session' cookie not found.")
-                return {"session": response.cookies["session"]}
-        except Exception as e:
-            raise Exception(f"Login failed for panel {self.base_url}: {e}")
+    def invalidate_snapshot(self):
+        """دور انداختن snapshot لیست inbound ها تا درخواست بعدی لیست را دوباره دریافت کند"""
+        self._snapshot = None
+
+    def _cached_snapshot(self) -> Optional[InboundSnapshot]:
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.is_fresh():
+            return snapshot
+        return None
+
+    def _store_snapshot(self, inbounds: List[Dict[str, Any]]) -> InboundSnapshot:
+        self._snapshot = InboundSnapshot(inbounds)
+        return self._snapshot
+
+    def _snapshot_upsert(self, inbound_data: Dict[str, Any], **changes):
+        """اعمال تغییرات یک نوشتن موفق روی snapshot به جای دریافت دوباره لیست"""
+        if self._snapshot is not None:
+            self._snapshot.upsert({**inbound_data, **changes})
+
+    def _snapshot_remove(self, inbound_id: int):
+        if self._snapshot is not None:
+            self._snapshot.remove(inbound_id)
+
+    def _breaker_check(self):
+        if self.breaker is not None:
+            self.breaker.before_request()
+
+    def _breaker_failure(self):
+        if self.breaker is not None:
+            self.breaker.record_failure()
+
+    def _breaker_result(self, response: httpx.Response):
+        if self.breaker is None:
+            return
+        if is_panel_failure(response):
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+
+    @staticmethod
+    def _is_auth_failure(response: httpx.Response) -> bool:
+        if response.status_code == 401:
+            return True
+        return response.is_redirect and "login" in response.headers.get("location", "")
 
-    def _get_inbounds_list(self):
-        list_url = f"{self.base_url}/panel/inbound/list"
-        with httpx.Client(cookies=self.session_cookie) as client:
-            response = client.post(list_url)
-            response.raise_for_status()
-            data = response.json()
-            if data and data.get("success"):
-                return data.get("obj", [])
+    @staticmethod
+    def _cookie_headers(cookie: Dict[str, str], headers: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+        headers = dict(headers or {})
+        headers["Cookie"] = "; ".join(f"{k}={v}" for k, v in cookie.items())
+        return headers
+
+    def _login_result(self, response: httpx.Response) -> Dict[str, str]:
+        response.raise_for_status()
+        if "session" not in response.cookies:
+            raise Exception("Login failed: 'session' cookie not found.")
+        return {"session": response.cookies["session"]}
+
+    def _notify_login(self):
+        if self.on_login:
+            try:
+                self.on_login(self.session_cookie["session"])
+            except Exception as e:
+                logger.error(f"Error storing session cookie for panel {self.base_url}: {e}")
+
+    @staticmethod
+    def _inbounds_from_response(response: httpx.Response) -> List[Dict[str, Any]]:
+        response.raise_for_status()
+        data = response.json()
+        if data and data.get("success"):
+            return data.get("obj", [])
         raise Exception("Failed to get inbounds list.")
 
-    def get_inbound(self, inbound_id: int):
-        try:
-            all_inbounds = self._get_inbounds_list()
-            for inbound in all_inbounds:
-                if inbound.get("id") == inbound_id:
-                    return inbound
+    def _created_inbound_id(self, payload, result) -> Optional[int]:
+        """شناسه inbound جدید را از پاسخ /panel/inbound/add برمی‌دارد و آن را به snapshot اضافه می‌کند"""
+        created = result.get("obj")
+        if not isinstance(created, dict) or not created.get("id"):
             return None
-        except Exception as e:
-            logger.error(f"Error getting inbound {inbound_id} from {self.base_url}: {e}")
-            raise
+        if self._snapshot is not None:
+            self._snapshot.upsert({**payload, **created})
+        return created["id"]
 
-    def _construct_config_link(self, inbound_data, domain, config_remark: Optional[str] = None):
+    def _construct_config_link(self, inbound_data, domain, config_remark: Optional[str] = None, client: Optional[Dict[str, Any]] = None):
+        """
+        لینک کانفیگ را می‌سازد. برای inbound های اشتراکی، client مشخص می‌کند لینک برای کدام کلاینت ساخته شود
+        (در غیر این صورت اولین کلاینت inbound استفاده می‌شود).
+        """
         protocol = inbound_data.get("protocol")
         
         if config_remark is None:
@@ -68,52 +277,121 @@ class XUIClient:
         port = inbound_data.get("port")
         settings_str = inbound_data.get("settings", "{}")
         settings = json.loads(settings_str)
+        if client is None:
+            client = settings["clients"][0]
 
         if protocol == "vless":
-            uuid = settings["clients"][0]["id"]
+            uuid = client["id"]
             return f"vless://{uuid}@{domain}:{port}?type=tcp&security=none&headerType=http#{remark}"
 
         elif protocol == "shadowsocks":
-            password = settings["clients"][0].get("password")
-            method = settings["clients"][0].get("method")
+            password = client.get("password")
+            method = client.get("method") or settings.get("method")
             encoded_part = base64.b64encode(f"{method}:{password}".encode()).decode()
             return f"ss://{encoded_part}@{domain}:{port}#{remark}"
 
         raise ValueError(f"Link construction for protocol '{protocol}' is not supported.")
 
-    def _create_inbound(self, payload, domain, config_remark: Optional[str] = None):
-        add_url = f"{self.base_url}/panel/inbound/add"
-        with httpx.Client(cookies=self.session_cookie) as client:
-            response = client.post(add_url, data=payload)
-            response.raise_for_status()
-            result = response.json()
-            if not result.get("success"):
-                raise Exception(f"Failed to create inbound: {result.get('msg')}")
-            
-            # Wait a moment for the inbound to be properly created
-            import time
-            time.sleep(1)
-            
-            inbound_id = self._get_id_from_remark(payload['remark'])
-            if inbound_id is None:
-                # Try again after a longer delay
-                time.sleep(2)
-                inbound_id = self._get_id_from_remark(payload['remark'])
-                if inbound_id is None:
-                    raise Exception(f"Could not find inbound with remark '{payload['remark']}' after creation")
-            
-            inbound_data = self.get_inbound(inbound_id)
-            if not inbound_data:
-                raise Exception(f"Could not get inbound data for ID {inbound_id}")
-            
-            config_link = self._construct_config_link(inbound_data, domain, config_remark)
-            return {"link": config_link, "inbound_id": inbound_id}
+    # --- Shared multi-client inbounds ---
 
-    def create_vless_inbound(self, remark, domain, port, expiry_days, limit_gb, config_remark: Optional[str] = None, expiry_time_ms: Optional[int] = None, total_gb_bytes: Optional[int] = None):
+    @staticmethod
+    def _new_client(protocol: str, email: str, expiry_time_ms: int, total_gb_bytes: int) -> Dict[str, Any]:
+        if protocol == "vless":
+            return {"id": str(uuid4()), "email": email, "totalGB": total_gb_bytes, "expiryTime": expiry_time_ms, "enable": True}
+        if protocol == "shadowsocks":
+            password = base64.b64encode(os.urandom(32)).decode('utf-8')
+            return {"method": "chacha20-ietf-poly1305", "password": password, "email": email, "totalGB": total_gb_bytes, "expiryTime": expiry_time_ms, "enable": True}
+        raise ValueError(f"Shared inbounds are not supported for protocol '{protocol}'.")
+
+    @staticmethod
+    def _client_key(protocol: str, client: Dict[str, Any]) -> str:
+        """شناسه‌ای که x-ui در updateClient/delClient انتظار دارد (uuid برای vless، email برای shadowsocks)"""
+        return client["id"] if protocol == "vless" else client["email"]
+
+    @staticmethod
+    def _inbound_clients(inbound_data) -> List[Dict[str, Any]]:
+        try:
+            return json.loads(inbound_data.get("settings") or "{}").get("clients", [])
+        except (TypeError, json.JSONDecodeError):
+            return []
+
+    def _find_client(self, inbound_data, email: str) -> Optional[Dict[str, Any]]:
+        for client in self._inbound_clients(inbound_data):
+            if client.get("email") == email:
+                return client
+        return None
+
+    @staticmethod
+    def _shared_remark_prefix(remark_prefix: str, protocol: str) -> str:
+        return f"{remark_prefix}-shared-{protocol}-"
+
+    def _pick_shared_inbound(self, snapshot: InboundSnapshot, protocol: str, remark_prefix: str):
+        """
+        inbound اشتراکی با کمترین تعداد کلاینت را انتخاب می‌کند.
+        خروجی: (inbound انتخاب شده, None) یا (None, remark برای ساخت inbound اشتراکی جدید)
+        """
+        prefix = self._shared_remark_prefix(remark_prefix, protocol)
+        candidates = [
+            inbound for inbound in snapshot.inbounds()
+            if inbound.get("protocol") == protocol and str(inbound.get("remark", "")).startswith(prefix)
+        ]
+        if candidates:
+            least_loaded = min(candidates, key=lambda inbound: len(self._inbound_clients(inbound)))
+            if (len(self._inbound_clients(least_loaded)) < XUI_SHARED_INBOUND_MAX_CLIENTS
+                    or len(candidates) >= XUI_SHARED_INBOUNDS_PER_PROTOCOL):
+                return least_loaded, None
+        indexes = [int(remark[len(prefix):]) for remark in (c.get("remark", "") for c in candidates) if remark[len(prefix):].isdigit()]
+        return None, f"{prefix}{max(indexes, default=0) + 1}"
+
+    def _shared_inbound_payload(self, protocol: str, remark: str, port: int, client: Dict[str, Any]):
+        """payload یک inbound اشتراکی بدون محدودیت حجم/زمان؛ محدودیت‌ها روی هر کلاینت اعمال می‌شوند"""
+        if protocol == "vless":
+            payload = self._vless_inbound_payload(remark, port, 0, 0, expiry_time_ms=0, total_gb_bytes=0)
+        else:
+            payload = self._shadowsocks_inbound_payload(remark, port, 0, 0, expiry_time_ms=0, total_gb_bytes=0)
+        settings = json.loads(payload["settings"])
+        settings["clients"] = [client]
+        payload["settings"] = json.dumps(settings)
+        return payload
+
+    @staticmethod
+    def _clients_payload(inbound_id: int, client: Dict[str, Any]):
+        return {"id": inbound_id, "settings": json.dumps({"clients": [client]})}
+
+    def _snapshot_update_clients(self, inbound_id: int, mutate: Callable[[List[Dict[str, Any]]], List[Dict[str, Any]]]):
+        snapshot = self._snapshot
+        inbound = snapshot.get(inbound_id) if snapshot is not None else None
+        if inbound is None:
+            return
+        settings = json.loads(inbound.get("settings") or "{}")
+        settings["clients"] = mutate(settings.get("clients", []))
+        snapshot.upsert({**inbound, "settings": json.dumps(settings)})
+
+    def _clients_to_disable(self, inbound_data, clients: Dict[str, str]):
+        """کلاینت‌های داده شده ({email: client_key}) که هنوز فعال هستند، به صورت (client_key, کلاینت غیرفعال شده)"""
+        return [
+            (clients[client["email"]], {**client, "enable": False})
+            for client in self._inbound_clients(inbound_data)
+            if client.get("email") in clients and client.get("enable", True)
+        ]
+
+    @staticmethod
+    def _first_free_port(used_ports) -> int:
+        port = XUI_FIRST_PORT
+        while port in used_ports:
+            port += 1
+        return port
+
+    @staticmethod
+    def limits(expiry_days, limit_gb, expiry_time_ms: Optional[int], total_gb_bytes: Optional[int]):
         if expiry_time_ms is None:
             expiry_time_ms = int((datetime.now() + timedelta(days=expiry_days)).timestamp() * 1000)
         if total_gb_bytes is None:
             total_gb_bytes = int(limit_gb * 1024 * 1024 * 1024)
+        return expiry_time_ms, total_gb_bytes
+
+    def _vless_inbound_payload(self, remark, port, expiry_days, limit_gb, expiry_time_ms: Optional[int] = None, total_gb_bytes: Optional[int] = None):
+        expiry_time_ms, total_gb_bytes = self.limits(expiry_days, limit_gb, expiry_time_ms, total_gb_bytes)
 
         client_id = str(uuid4())
         # Use remark as email since remark is now unique
@@ -121,20 +399,16 @@ class XUIClient:
         stream_settings = {"network": "tcp", "security": "none", "tcpSettings": {"header": {"type": "http", "request": {"version": "1.1", "method": "GET", "path": ["/"], "headers": {}}, "response": {"version": "1.1", "status": "200", "reason": "OK", "headers": {}}}}}
         sniffing = {"enabled": True, "destOverride": ["http", "tls", "quic", "fakedns"]}
 
-        inbound_payload = {
+        return {
             "remark": remark, "port": port, "protocol": "vless", "enable": "true",
             "expiryTime": expiry_time_ms, "total": total_gb_bytes, "listen": "",
             "settings": json.dumps(settings),
             "streamSettings": json.dumps(stream_settings),
             "sniffing": json.dumps(sniffing)
         }
-        return self._create_inbound(inbound_payload, domain, config_remark)
 
-    def create_shadowsocks_inbound(self, remark, domain, port, expiry_days, limit_gb, config_remark: Optional[str] = None, expiry_time_ms: Optional[int] = None, total_gb_bytes: Optional[int] = None):
-        if expiry_time_ms is None:
-            expiry_time_ms = int((datetime.now() + timedelta(days=expiry_days)).timestamp() * 1000)
-        if total_gb_bytes is None:
-            total_gb_bytes = int(limit_gb * 1024 * 1024 * 1024)
+    def _shadowsocks_inbound_payload(self, remark, port, expiry_days, limit_gb, expiry_time_ms: Optional[int] = None, total_gb_bytes: Optional[int] = None):
+        expiry_time_ms, total_gb_bytes = self.limits(expiry_days, limit_gb, expiry_time_ms, total_gb_bytes)
 
         method = "chacha20-ietf-poly1305"
         main_password = base64.b64encode(os.urandom(32)).decode('utf-8')
@@ -148,20 +422,16 @@ class XUIClient:
         stream_settings = {"network": "tcp", "security": "none", "tcpSettings": {"header": {"type": "none"}}}
         sniffing = {"enabled": True, "destOverride": ["http", "tls", "quic", "fakedns"]}
 
-        inbound_payload = {
+        return {
             "remark": remark, "port": port, "protocol": "shadowsocks", "enable": "true",
             "expiryTime": expiry_time_ms, "total": total_gb_bytes, "listen": "",
             "settings": json.dumps(settings),
             "streamSettings": json.dumps(stream_settings),
             "sniffing": json.dumps(sniffing)
         }
-        return self._create_inbound(inbound_payload, domain, config_remark)
-
-    def update_inbound(self, inbound_id: int, new_total_gb: int, new_expiry_time_ms: int) -> bool:
-        original_inbound = self.get_inbound(inbound_id)
-        if not original_inbound:
-            raise Exception(f"Cannot update: Inbound {inbound_id} not found.")
 
+    @staticmethod
+    def _updated_settings(original_inbound, new_total_gb: int, new_expiry_time_ms: int):
         settings = json.loads(original_inbound.get("settings", "{}"))
 
         if "clients" not in settings or not settings["clients"]:
@@ -172,41 +442,188 @@ class XUIClient:
 
         settings["clients"][0]["totalGB"] = new_total_gb
         settings["clients"][0]["expiryTime"] = new_expiry_time_ms
+        return settings
+
+    @staticmethod
+    def _inbound_update_payload(inbound_data, enable: bool, **overrides):
+        payload = {
+            "id": inbound_data.get("id"),
+            "enable": enable,
+            "remark": inbound_data.get("remark", ""),
+            "expiryTime": inbound_data.get("expiryTime", 0),
+            "total": inbound_data.get("total", 0),
+            "settings": inbound_data.get("settings", "{}"),
+            "streamSettings": inbound_data.get("streamSettings", {}),
+            "port": inbound_data.get("port"),
+            "protocol": inbound_data.get("protocol"),
+            "sniffing": inbound_data.get("sniffing", {}),
+            "listen": inbound_data.get("listen", ""),
+        }
+        payload.update(overrides)
+        return payload
+
+    @staticmethod
+    def _check_result(response: httpx.Response, error_message: str):
+        response.raise_for_status()
+        result = response.json()
+        if not result.get("success"):
+            raise Exception(f"{error_message}: {result.get('msg')}")
+        return result
+
+    @staticmethod
+    def _traffic_totals(all_inbounds) -> dict:
+        total_up = 0
+        total_down = 0
+        for inbound in all_inbounds:
+            total_up += inbound.get("up", 0)
+            total_down += inbound.get("down", 0)
+        return {"up": total_up, "down": total_down}
+
+    @staticmethod
+    def _traffic_result(response: httpx.Response, error_message: str) -> Optional[Dict[str, Any]]:
+        """خروجی endpoint های ترافیک: {"up", "down", "enable"} یا None اگر کلاینت/inbound وجود نداشته باشد"""
+        response.raise_for_status()
+        data = response.json()
+        if not data.get("success"):
+            raise Exception(f"{error_message}: {data.get('msg')}")
+        obj = data.get("obj")
+        if not obj:
+            return None
+        return {"up": obj.get("up", 0) or 0, "down": obj.get("down", 0) or 0, "enable": obj.get("enable", True)}
+
+    @staticmethod
+    def _online_count(response: httpx.Response) -> int:
+        response.raise_for_status()
+        data = response.json()
+        if data and data.get("success"):
+            online_clients = data.get("obj")
+            return len(online_clients or [])
+        return 0
+
+class XUIClient(_XUIClientBase):
+    def __init__(self, base_url, username, password, session_cookie: Optional[str] = None, on_login: Optional[Callable[[str], None]] = None, breaker: Optional[PanelCircuitBreaker] = None):
+        super().__init__(base_url, username, password, session_cookie, on_login, breaker)
+        self.http = get_http_client(self.base_url)
+        self._login_lock = threading.Lock()
+
+    def _login(self):
+        login_url = f"{self.base_url}/login"
+        try:
+            response = self.http.post(login_url, data={"username": self.username, "password": self.password})
+            return self._login_result(response)
+        except httpx.TransportError:
+            raise
+        except Exception as e:
+            raise Exception(f"Login failed for panel {self.base_url}: {e}")
+
+    def _relogin(self, stale_cookie: Optional[Dict[str, str]]):
+        """لاگین مجدد به صورت single-flight: درخواست‌های همزمان منتظر یک لاگین مشترک می‌مانند"""
+        with self._login_lock:
+            if self.session_cookie is not None and self.session_cookie is not stale_cookie:
+                # Another thread already logged in while we were waiting
+                return
+            self.session_cookie = self._login()
+        self._notify_login()
+
+    def _request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        """ارسال درخواست به پنل از طریق pool مشترک؛ در صورت منقضی شدن نشست یکبار لاگین مجدد می‌کند"""
+        self._breaker_check()
+        try:
+            response = self._send(method, path, **kwargs)
+        except httpx.TransportError:
+            self._breaker_failure()
+            raise
+        self._breaker_result(response)
+        return response
+
+    def _send(self, method: str, path: str, **kwargs) -> httpx.Response:
+        cookie = self.session_cookie
+        if cookie is None:
+            self._relogin(None)
+            cookie = self.session_cookie
+        headers = kwargs.pop("headers", None)
+        url = f"{self.base_url}{path}"
+        response = self.http.request(method, url, headers=self._cookie_headers(cookie, headers), **kwargs)
+        if self._is_auth_failure(response):
+            self._relogin(cookie)
+            response = self.http.request(method, url, headers=self._cookie_headers(self.session_cookie, headers), **kwargs)
+        return response
+
+    def _post(self, path: str, **kwargs) -> httpx.Response:
+        return self._request("POST", path, **kwargs)
+
+    def _load_snapshot(self, force: bool = False) -> InboundSnapshot:
+        snapshot = None if force else self._cached_snapshot()
+        if snapshot is None:
+            snapshot = self._store_snapshot(self._inbounds_from_response(self._post("/panel/inbound/list")))
+        return snapshot
+
+    def _lookup(self, finder: Callable[[InboundSnapshot], Any]):
+        """جستجو در snapshot؛ اگر پیدا نشد و snapshot قبلاً کش شده بود، یکبار لیست تازه دریافت می‌شود"""
+        snapshot = self._cached_snapshot()
+        if snapshot is not None:
+            found = finder(snapshot)
+            if found is not None:
+                return found
+        return finder(self._load_snapshot(force=True))
+
+    def _get_inbounds_list(self, force: bool = False):
+        return self._load_snapshot(force).inbounds()
+
+    def get_inbound(self, inbound_id: int):
+        try:
+            return self._lookup(lambda snapshot: snapshot.get(inbound_id))
+        except Exception as e:
+            logger.error(f"Error getting inbound {inbound_id} from {self.base_url}: {e}")
+            raise
+
+    def _fresh_inbound(self, inbound_id: int):
+        """inbound از لیست تازه پنل؛ payload های کامل update از روی آن ساخته می‌شوند تا تغییرات اخیر پنل برنگردند"""
+        return self._load_snapshot(force=True).get(inbound_id)
+
+    def _create_inbound(self, payload, domain, config_remark: Optional[str] = None):
+        result = self._check_result(self._post("/panel/inbound/add", data=payload), "Failed to create inbound")
+        
+        inbound_id = self._created_inbound_id(payload, result)
+        if inbound_id is None:
+            # Panel did not return the created object; fall back to a single lookup by remark
+            inbound_id = self._get_id_from_remark(payload['remark'])
+            if inbound_id is None:
+                raise Exception(f"Could not find inbound with remark '{payload['remark']}' after creation")
+        
+        # لینک از روی payload ساخته شده توسط خودمان ساخته می‌شود (uuid/password/port را از قبل داریم)
+        config_link = self._construct_config_link(payload, domain, config_remark)
+        return {"link": config_link, "inbound_id": inbound_id}
+
+    def create_vless_inbound(self, remark, domain, port, expiry_days, limit_gb, config_remark: Optional[str] = None, expiry_time_ms: Optional[int] = None, total_gb_bytes: Optional[int] = None):
+        inbound_payload = self._vless_inbound_payload(remark, port, expiry_days, limit_gb, expiry_time_ms, total_gb_bytes)
+        return self._create_inbound(inbound_payload, domain, config_remark)
 
+    def create_shadowsocks_inbound(self, remark, domain, port, expiry_days, limit_gb, config_remark: Optional[str] = None, expiry_time_ms: Optional[int] = None, total_gb_bytes: Optional[int] = None):
+        inbound_payload = self._shadowsocks_inbound_payload(remark, port, expiry_days, limit_gb, expiry_time_ms, total_gb_bytes)
+        return self._create_inbound(inbound_payload, domain, config_remark)
+
+    def update_inbound(self, inbound_id: int, new_total_gb: int, new_expiry_time_ms: int) -> bool:
+        original_inbound = self._fresh_inbound(inbound_id)
+        if not original_inbound:
+            raise Exception(f"Cannot update: Inbound {inbound_id} not found.")
+
+        settings = self._updated_settings(original_inbound, new_total_gb, new_expiry_time_ms)
         new_settings_str = json.dumps(settings)
 
         client_uuid = settings["clients"][0].get("id")
         if client_uuid:
-            update_client_url = f"{self.base_url}/panel/inbound/updateClient/{client_uuid}"
             client_payload = {'id': inbound_id, 'settings': new_settings_str}
-            with httpx.Client(cookies=self.session_cookie) as client:
-                client_response = client.post(update_client_url, data=client_payload)
-                if not (client_response.status_code == 200 and client_response.json().get('success')):
-                     logger.error(f"updateClient call failed for {client_uuid}: {client_response.text}")
-
-        update_inbound_url = f"{self.base_url}/panel/inbound/update/{inbound_id}"
-
-        update_payload = {
-            "id": original_inbound.get("id"),
-            "enable": True,
-            "remark": original_inbound.get("remark"),
-            "expiryTime": new_expiry_time_ms,
-            "total": new_total_gb,
-            "settings": new_settings_str,
-            "streamSettings": original_inbound.get("streamSettings", {}),
-            "port": original_inbound.get("port"),
-            "protocol": original_inbound.get("protocol"),
-            "sniffing": original_inbound.get("sniffing", {}),
-            "listen": original_inbound.get("listen", ""),
-        }
-
-        with httpx.Client(cookies=self.session_cookie) as client:
-            response = client.post(update_inbound_url, json=update_payload)
-            response.raise_for_status()
-            result = response.json()
-            if not result.get("success"):
-                raise Exception(f"Main inbound update failed. Panel response: {result.get('msg')}")
+            client_response = self._post(f"/panel/inbound/updateClient/{client_uuid}", data=client_payload)
+            if not (client_response.status_code == 200 and client_response.json().get('success')):
+                 logger.error(f"updateClient call failed for {client_uuid}: {client_response.text}")
 
+        update_payload = self._inbound_update_payload(
+            original_inbound, True,
+            expiryTime=new_expiry_time_ms, total=new_total_gb, settings=new_settings_str,
+        )
+        self._check_result(self._post(f"/panel/inbound/update/{inbound_id}", json=update_payload), "Main inbound update failed. Panel response")
+        self._snapshot_upsert(original_inbound, **update_payload)
         return True
 
     def update_inbound_simple(self, inbound_id: int, expiry_days: int, limit_gb: int) -> bool:
@@ -226,7 +643,7 @@ class XUIClient:
     def get_all_inbounds_data(self) -> List[Dict[str, Any]]:
         """تمام دیتای inbound ها را یکبار دریافت می‌کند برای کش کردن"""
         try:
-            all_inbounds = self._get_inbounds_list()
+            all_inbounds = self._get_inbounds_list(force=True)
             return all_inbounds
         except Exception as e:
             logger.error(f"Error getting all inbounds data from {self.base_url}: {e}")
@@ -244,82 +661,440 @@ class XUIClient:
 
     def get_all_inbounds_traffic(self) -> dict:
         """مجموع ترافیک آپلود و دانلود را برای همه ورودی‌ها دریافت می‌کند."""
-        all_inbounds = self._get_inbounds_list()
-        total_up = 0
-        total_down = 0
-        for inbound in all_inbounds:
-            total_up += inbound.get("up", 0)
-            total_down += inbound.get("down", 0)
-        return {"up": total_up, "down": total_down}
+        return self._traffic_totals(self._get_inbounds_list())
+
+    def get_client_traffic(self, email: str) -> Optional[Dict[str, Any]]:
+        """ترافیک یک کلاینت بدون دریافت لیست کامل inbound ها"""
+        return self._traffic_result(self._request("GET", f"/panel/api/inbounds/getClientTraffics/{urllib.parse.quote(email)}"), f"Failed to get traffic of client {email}")
+
+    def get_single_inbound_traffic(self, inbound_id: int) -> Optional[Dict[str, Any]]:
+        """ترافیک یک inbound بدون دریافت لیست کامل inbound ها"""
+        return self._traffic_result(self._request("GET", f"/panel/api/inbounds/get/{inbound_id}"), f"Failed to get inbound {inbound_id}")
 
     def get_online_clients_count(self) -> int:
         """تعداد کاربران آنلاین را دریافت می‌کند."""
-        onlines_url = f"{self.base_url}/panel/inbound/onlines"
         try:
-            with httpx.Client(cookies=self.session_cookie) as client:
-                response = client.post(onlines_url)
-                response.raise_for_status()
-                data = response.json()
-                if data and data.get("success"):
-                    online_clients = data.get("obj")
-                    return len(online_clients or [])
-                return 0
+            return self._online_count(self._post("/panel/inbound/onlines"))
         except Exception as e:
             logger.error(f"Could not get online clients from {self.base_url}: {e}")
             return 0
 
-    def get_used_ports(self):
-        all_inbounds = self._get_inbounds_list()
-        return [inbound.get("port") for inbound in all_inbounds]
+    def get_used_ports(self) -> set:
+        return self._load_snapshot().used_ports()
+
+    def inbound_snapshot(self, force: bool = False) -> InboundSnapshot:
+        """snapshot لیست inbound ها؛ در صورت نبود یا منقضی شدن کش، از پنل دریافت می‌شود"""
+        return self._load_snapshot(force)
+
+    def inbound_port(self, inbound_id: int) -> Optional[int]:
+        """پورت یک inbound (در صورت نیاز snapshot بارگذاری می‌شود)"""
+        inbound = self.get_inbound(inbound_id)
+        return inbound.get("port") if inbound else None
 
     def _get_id_from_remark(self, remark):
-        all_inbounds = self._get_inbounds_list()
-        for inbound in all_inbounds:
-            if inbound.get("remark") == remark: 
-                return inbound.get("id")
-        logger.error(f"Could not find inbound with remark '{remark}' after creation.")
+        inbound_id = self._lookup(lambda snapshot: snapshot.id_for_remark(remark))
+        if inbound_id is None:
+            logger.error(f"Could not find inbound with remark '{remark}' after creation.")
         # Instead of raising exception, return None and let caller handle it
-        return None
+        return inbound_id
 
     def delete_inbound(self, inbound_id: int):
-        del_url = f"{self.base_url}/panel/inbound/del/{inbound_id}"
-        with httpx.Client(cookies=self.session_cookie) as client:
-            response = client.post(del_url)
-            response.raise_for_status()
-            result = response.json()
-            if not result.get("success"): raise Exception(f"Failed to delete inbound {inbound_id}: {result.get('msg')}")
+        self._check_result(self._post(f"/panel/inbound/del/{inbound_id}"), f"Failed to delete inbound {inbound_id}")
+        self._snapshot_remove(inbound_id)
         return True
 
     def disable_inbound(self, inbound_id: int):
         """غیرفعال کردن inbound بدون حذف آن"""
         try:
-            inbound_data = self.get_inbound(inbound_id)
+            inbound_data = self._fresh_inbound(inbound_id)
             if not inbound_data:
                 raise Exception(f"Inbound {inbound_id} not found")
             
-            update_url = f"{self.base_url}/panel/inbound/update/{inbound_id}"
-            update_payload = {
-                "id": inbound_id,
-                "enable": False,
-                "remark": inbound_data.get("remark", ""),
-                "expiryTime": inbound_data.get("expiryTime", 0),
-                "total": inbound_data.get("total", 0),
-                "settings": inbound_data.get("settings", "{}"),
-                "streamSettings": inbound_data.get("streamSettings", {}),
-                "port": inbound_data.get("port"),
-                "protocol": inbound_data.get("protocol"),
-                "sniffing": inbound_data.get("sniffing", {}),
-                "listen": inbound_data.get("listen", ""),
-            }
-            
-            with httpx.Client(cookies=self.session_cookie) as client:
-                response = client.post(update_url, json=update_payload)
-                response.raise_for_status()
-                result = response.json()
-                if not result.get("success"):
-                    raise Exception(f"Failed to disable inbound {inbound_id}: {result.get('msg')}")
-            
+            update_payload = self._inbound_update_payload(inbound_data, False, id=inbound_id)
+            self._check_result(self._post(f"/panel/inbound/update/{inbound_id}", json=update_payload), f"Failed to disable inbound {inbound_id}")
+            self._snapshot_upsert(inbound_data, enable=False)
+            return True
+        except Exception as e:
+            logger.error(f"Error disabling inbound {inbound_id}: {e}")
+            raise
+
+    def add_client(self, inbound_id: int, client: Dict[str, Any]) -> bool:
+        """افزودن کلاینت به یک inbound اشتراکی"""
+        self._check_result(self._post("/panel/inbound/addClient", data=self._clients_payload(inbound_id, client)), f"Failed to add client to inbound {inbound_id}")
+        self._snapshot_update_clients(inbound_id, lambda clients: clients + [client])
+        return True
+
+    def update_client(self, inbound_id: int, client_key: str, client: Dict[str, Any]) -> bool:
+        self._check_result(self._post(f"/panel/inbound/updateClient/{client_key}", data=self._clients_payload(inbound_id, client)), f"Failed to update client {client_key}")
+        self._snapshot_update_clients(inbound_id, lambda clients: [client if c.get("email") == client.get("email") else c for c in clients])
+        return True
+
+    def delete_client(self, inbound_id: int, client_key: str, email: Optional[str] = None) -> bool:
+        self._check_result(self._post(f"/panel/inbound/{inbound_id}/delClient/{client_key}"), f"Failed to delete client {client_key}")
+        if email is not None:
+            self._snapshot_update_clients(inbound_id, lambda clients: [c for c in clients if c.get("email") != email])
+        return True
+
+    def get_client(self, inbound_id: int, email: str, fresh: bool = False) -> Optional[Dict[str, Any]]:
+        inbound_data = self._fresh_inbound(inbound_id) if fresh else self.get_inbound(inbound_id)
+        return self._find_client(inbound_data, email) if inbound_data else None
+
+    def update_client_limits(self, inbound_id: int, client_key: str, email: str, new_total_gb: int, new_expiry_time_ms: int) -> bool:
+        client = self.get_client(inbound_id, email, fresh=True)
+        if not client:
+            raise Exception(f"Cannot update: client {email} not found in inbound {inbound_id}.")
+        return self.update_client(inbound_id, client_key, {**client, "totalGB": new_total_gb, "expiryTime": new_expiry_time_ms, "enable": True})
+
+    def set_client_enable(self, inbound_id: int, client_key: str, email: str, enable: bool) -> bool:
+        client = self.get_client(inbound_id, email, fresh=True)
+        if not client:
+            raise Exception(f"Client {email} not found in inbound {inbound_id}")
+        return self.update_client(inbound_id, client_key, {**client, "enable": enable})
+
+    def disable_inbounds(self, inbound_ids: List[int]) -> List[int]:
+        """
+        غیرفعال کردن گروهی inbound ها با یک لیست تازه مشترک؛ inbound هایی که از قبل غیرفعال هستند رد می‌شوند.
+        خروجی: شناسه inbound هایی که غیرفعال شدند.
+        """
+        snapshot = self._load_snapshot(force=True)
+        disabled = []
+        for inbound_id in inbound_ids:
+            inbound_data = snapshot.get(inbound_id)
+            if not inbound_data:
+                logger.error(f"Error disabling inbound {inbound_id}: not found")
+                continue
+            if not inbound_data.get("enable", True):
+                continue
+            try:
+                update_payload = self._inbound_update_payload(inbound_data, False, id=inbound_id)
+                self._check_result(self._post(f"/panel/inbound/update/{inbound_id}", json=update_payload), f"Failed to disable inbound {inbound_id}")
+                self._snapshot_upsert(inbound_data, enable=False)
+                disabled.append(inbound_id)
+            except Exception as e:
+                logger.error(f"Error disabling inbound {inbound_id}: {e}")
+        return disabled
+
+    def disable_clients(self, inbound_id: int, clients: Dict[str, str]) -> int:
+        """
+        غیرفعال کردن چند کلاینت یک inbound اشتراکی ({email: client_key}) هر کدام با updateClient خودش،
+        تا کلاینت‌هایی که در این فاصله به inbound اضافه شده‌اند دست نخورند. خروجی: تعداد کلاینت‌های غیرفعال شده.
+        """
+        inbound_data = self._fresh_inbound(inbound_id)
+        if not inbound_data:
+            raise Exception(f"Inbound {inbound_id} not found")
+        disabled = 0
+        for client_key, client in self._clients_to_disable(inbound_data, clients):
+            try:
+                self.update_client(inbound_id, client_key, client)
+                disabled += 1
+            except Exception as e:
+                logger.error(f"Error disabling client {client.get('email')} of inbound {inbound_id}: {e}")
+        return disabled
+
+    def create_shared_client(self, protocol, remark_prefix, domain, email, expiry_time_ms: int, total_gb_bytes: int, config_remark: Optional[str] = None, allocate_port: Optional[Callable[[], int]] = None):
+        """سرویس را به صورت یک کلاینت در inbound اشتراکی پروتکل می‌سازد (در صورت نیاز inbound اشتراکی جدید ساخته می‌شود)"""
+        client = self._new_client(protocol, email, expiry_time_ms, total_gb_bytes)
+        inbound_data, new_remark = self._pick_shared_inbound(self._load_snapshot(), protocol, remark_prefix)
+        if inbound_data is not None:
+            self.add_client(inbound_data["id"], client)
+            inbound_id = inbound_data["id"]
+        else:
+            port = allocate_port() if allocate_port else self._first_free_port(self.get_used_ports())
+            inbound_data = self._shared_inbound_payload(protocol, new_remark, port, client)
+            inbound_id = self._create_inbound(inbound_data, domain)["inbound_id"]
+        return {
+            "link": self._construct_config_link(inbound_data, domain, config_remark or email, client=client),
+            "inbound_id": inbound_id,
+            "client_id": self._client_key(protocol, client),
+            "client_email": email,
+        }
+
+    def get_db_backup(self) -> bytes:
+        """دریافت فایل دیتابیس پنل برای بکاپ"""
+        response = self._request("GET", "/server/getDb")
+        response.raise_for_status()
+        return response.content
+
+class AsyncXUIClient(_XUIClientBase):
+    """نسخه asyncio از XUIClient با همان API، برای اجرای همزمان روی همه پنل‌ها"""
+
+    def __init__(self, base_url, username, password, session_cookie: Optional[str] = None, on_login: Optional[Callable[[str], None]] = None, breaker: Optional[PanelCircuitBreaker] = None):
+        super().__init__(base_url, username, password, session_cookie, on_login, breaker)
+        self.http = get_async_http_client(self.base_url)
+        self._login_lock = asyncio.Lock()
+
+    async def _login(self):
+        login_url = f"{self.base_url}/login"
+        try:
+            response = await self.http.post(login_url, data={"username": self.username, "password": self.password})
+            return self._login_result(response)
+        except httpx.TransportError:
+            raise
+        except Exception as e:
+            raise Exception(f"Login failed for panel {self.base_url}: {e}")
+
+    async def _relogin(self, stale_cookie: Optional[Dict[str, str]]):
+        async with self._login_lock:
+            if self.session_cookie is not None and self.session_cookie is not stale_cookie:
+                return
+            self.session_cookie = await self._login()
+        # on_login stores the cookie in the database
+        await asyncio.to_thread(self._notify_login)
+
+    async def _request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        # The breaker talks to Redis (and to the database on a state change), so it runs in a thread
+        # unless the circuit was seen healthy moments ago
+        if self.breaker is not None and not self.breaker.is_trusted():
+            await asyncio.to_thread(self._breaker_check)
+        try:
+            response = await self._send(method, path, **kwargs)
+        except httpx.TransportError:
+            await asyncio.to_thread(self._breaker_failure)
+            raise
+        if self.breaker is not None and (is_panel_failure(response) or not self.breaker.is_trusted()):
+            await asyncio.to_thread(self._breaker_result, response)
+        return response
+
+    async def _send(self, method: str, path: str, **kwargs) -> httpx.Response:
+        cookie = self.session_cookie
+        if cookie is None:
+            await self._relogin(None)
+            cookie = self.session_cookie
+        headers = kwargs.pop("headers", None)
+        url = f"{self.base_url}{path}"
+        response = await self.http.request(method, url, headers=self._cookie_headers(cookie, headers), **kwargs)
+        if self._is_auth_failure(response):
+            await self._relogin(cookie)
+            response = await self.http.request(method, url, headers=self._cookie_headers(self.session_cookie, headers), **kwargs)
+        return response
+
+    async def _post(self, path: str, **kwargs) -> httpx.Response:
+        return await self._request("POST", path, **kwargs)
+
+    async def _load_snapshot(self, force: bool = False) -> InboundSnapshot:
+        snapshot = None if force else self._cached_snapshot()
+        if snapshot is None:
+            snapshot = self._store_snapshot(self._inbounds_from_response(await self._post("/panel/inbound/list")))
+        return snapshot
+
+    async def _lookup(self, finder: Callable[[InboundSnapshot], Any]):
+        snapshot = self._cached_snapshot()
+        if snapshot is not None:
+            found = finder(snapshot)
+            if found is not None:
+                return found
+        return finder(await self._load_snapshot(force=True))
+
+    async def _get_inbounds_list(self, force: bool = False):
+        return (await self._load_snapshot(force)).inbounds()
+
+    async def get_inbound(self, inbound_id: int):
+        try:
+            return await self._lookup(lambda snapshot: snapshot.get(inbound_id))
+        except Exception as e:
+            logger.error(f"Error getting inbound {inbound_id} from {self.base_url}: {e}")
+            raise
+
+    async def _fresh_inbound(self, inbound_id: int):
+        return (await self._load_snapshot(force=True)).get(inbound_id)
+
+    async def _create_inbound(self, payload, domain, config_remark: Optional[str] = None):
+        result = self._check_result(await self._post("/panel/inbound/add", data=payload), "Failed to create inbound")
+
+        inbound_id = self._created_inbound_id(payload, result)
+        if inbound_id is None:
+            inbound_id = await self._get_id_from_remark(payload['remark'])
+            if inbound_id is None:
+                raise Exception(f"Could not find inbound with remark '{payload['remark']}' after creation")
+
+        config_link = self._construct_config_link(payload, domain, config_remark)
+        return {"link": config_link, "inbound_id": inbound_id}
+
+    async def create_vless_inbound(self, remark, domain, port, expiry_days, limit_gb, config_remark: Optional[str] = None, expiry_time_ms: Optional[int] = None, total_gb_bytes: Optional[int] = None):
+        inbound_payload = self._vless_inbound_payload(remark, port, expiry_days, limit_gb, expiry_time_ms, total_gb_bytes)
+        return await self._create_inbound(inbound_payload, domain, config_remark)
+
+    async def create_shadowsocks_inbound(self, remark, domain, port, expiry_days, limit_gb, config_remark: Optional[str] = None, expiry_time_ms: Optional[int] = None, total_gb_bytes: Optional[int] = None):
+        inbound_payload = self._shadowsocks_inbound_payload(remark, port, expiry_days, limit_gb, expiry_time_ms, total_gb_bytes)
+        return await self._create_inbound(inbound_payload, domain, config_remark)
+
+    async def update_inbound(self, inbound_id: int, new_total_gb: int, new_expiry_time_ms: int) -> bool:
+        original_inbound = await self._fresh_inbound(inbound_id)
+        if not original_inbound:
+            raise Exception(f"Cannot update: Inbound {inbound_id} not found.")
+
+        settings = self._updated_settings(original_inbound, new_total_gb, new_expiry_time_ms)
+        new_settings_str = json.dumps(settings)
+
+        client_uuid = settings["clients"][0].get("id")
+        if client_uuid:
+            client_payload = {'id': inbound_id, 'settings': new_settings_str}
+            client_response = await self._post(f"/panel/inbound/updateClient/{client_uuid}", data=client_payload)
+            if not (client_response.status_code == 200 and client_response.json().get('success')):
+                 logger.error(f"updateClient call failed for {client_uuid}: {client_response.text}")
+
+        update_payload = self._inbound_update_payload(
+            original_inbound, True,
+            expiryTime=new_expiry_time_ms, total=new_total_gb, settings=new_settings_str,
+        )
+        self._check_result(await self._post(f"/panel/inbound/update/{inbound_id}", json=update_payload), "Main inbound update failed. Panel response")
+        self._snapshot_upsert(original_inbound, **update_payload)
+        return True
+
+    async def update_inbound_simple(self, inbound_id: int, expiry_days: int, limit_gb: int) -> bool:
+        try:
+            expiry_time_ms = int((datetime.now() + timedelta(days=expiry_days)).timestamp() * 1000)
+            total_gb_bytes = limit_gb * 1024 * 1024 * 1024
+            return await self.update_inbound(inbound_id, total_gb_bytes, expiry_time_ms)
+        except Exception as e:
+            logger.error(f"Error updating inbound {inbound_id}: {e}")
+            raise
+
+    async def get_all_inbounds_data(self) -> List[Dict[str, Any]]:
+        try:
+            return await self._get_inbounds_list(force=True)
+        except Exception as e:
+            logger.error(f"Error getting all inbounds data from {self.base_url}: {e}")
+            return []
+
+    async def get_inbound_traffic_gb(self, inbound_id: int) -> float:
+        inbound_data = await self.get_inbound(inbound_id)
+        if not inbound_data: return 0.0
+        return (inbound_data.get("up", 0) + inbound_data.get("down", 0)) / (1024 * 1024 * 1024)
+
+    async def get_all_inbounds_traffic(self) -> dict:
+        return self._traffic_totals(await self._get_inbounds_list())
+
+    async def get_client_traffic(self, email: str) -> Optional[Dict[str, Any]]:
+        return self._traffic_result(await self._request("GET", f"/panel/api/inbounds/getClientTraffics/{urllib.parse.quote(email)}"), f"Failed to get traffic of client {email}")
+
+    async def get_single_inbound_traffic(self, inbound_id: int) -> Optional[Dict[str, Any]]:
+        return self._traffic_result(await self._request("GET", f"/panel/api/inbounds/get/{inbound_id}"), f"Failed to get inbound {inbound_id}")
+
+    async def get_online_clients_count(self) -> int:
+        try:
+            return self._online_count(await self._post("/panel/inbound/onlines"))
+        except Exception as e:
+            logger.error(f"Could not get online clients from {self.base_url}: {e}")
+            return 0
+
+    async def get_used_ports(self) -> set:
+        return (await self._load_snapshot()).used_ports()
+
+    async def inbound_snapshot(self, force: bool = False) -> InboundSnapshot:
+        return await self._load_snapshot(force)
+
+    async def inbound_port(self, inbound_id: int) -> Optional[int]:
+        inbound = await self.get_inbound(inbound_id)
+        return inbound.get("port") if inbound else None
+
+    async def _get_id_from_remark(self, remark):
+        inbound_id = await self._lookup(lambda snapshot: snapshot.id_for_remark(remark))
+        if inbound_id is None:
+            logger.error(f"Could not find inbound with remark '{remark}' after creation.")
+        return inbound_id
+
+    async def delete_inbound(self, inbound_id: int):
+        self._check_result(await self._post(f"/panel/inbound/del/{inbound_id}"), f"Failed to delete inbound {inbound_id}")
+        self._snapshot_remove(inbound_id)
+        return True
+
+    async def disable_inbound(self, inbound_id: int):
+        try:
+            inbound_data = await self._fresh_inbound(inbound_id)
+            if not inbound_data:
+                raise Exception(f"Inbound {inbound_id} not found")
+
+            update_payload = self._inbound_update_payload(inbound_data, False, id=inbound_id)
+            self._check_result(await self._post(f"/panel/inbound/update/{inbound_id}", json=update_payload), f"Failed to disable inbound {inbound_id}")
+            self._snapshot_upsert(inbound_data, enable=False)
             return True
         except Exception as e:
             logger.error(f"Error disabling inbound {inbound_id}: {e}")
-            raise
\ No newline at end of file
+            raise
+
+    async def add_client(self, inbound_id: int, client: Dict[str, Any]) -> bool:
+        self._check_result(await self._post("/panel/inbound/addClient", data=self._clients_payload(inbound_id, client)), f"Failed to add client to inbound {inbound_id}")
+        self._snapshot_update_clients(inbound_id, lambda clients: clients + [client])
+        return True
+
+    async def update_client(self, inbound_id: int, client_key: str, client: Dict[str, Any]) -> bool:
+        self._check_result(await self._post(f"/panel/inbound/updateClient/{client_key}", data=self._clients_payload(inbound_id, client)), f"Failed to update client {client_key}")
+        self._snapshot_update_clients(inbound_id, lambda clients: [client if c.get("email") == client.get("email") else c for c in clients])
+        return True
+
+    async def delete_client(self, inbound_id: int, client_key: str, email: Optional[str] = None) -> bool:
+        self._check_result(await self._post(f"/panel/inbound/{inbound_id}/delClient/{client_key}"), f"Failed to delete client {client_key}")
+        if email is not None:
+            self._snapshot_update_clients(inbound_id, lambda clients: [c for c in clients if c.get("email") != email])
+        return True
+
+    async def get_client(self, inbound_id: int, email: str, fresh: bool = False) -> Optional[Dict[str, Any]]:
+        inbound_data = await (self._fresh_inbound(inbound_id) if fresh else self.get_inbound(inbound_id))
+        return self._find_client(inbound_data, email) if inbound_data else None
+
+    async def update_client_limits(self, inbound_id: int, client_key: str, email: str, new_total_gb: int, new_expiry_time_ms: int) -> bool:
+        client = await self.get_client(inbound_id, email, fresh=True)
+        if not client:
+            raise Exception(f"Cannot update: client {email} not found in inbound {inbound_id}.")
+        return await self.update_client(inbound_id, client_key, {**client, "totalGB": new_total_gb, "expiryTime": new_expiry_time_ms, "enable": True})
+
+    async def set_client_enable(self, inbound_id: int, client_key: str, email: str, enable: bool) -> bool:
+        client = await self.get_client(inbound_id, email, fresh=True)
+        if not client:
+            raise Exception(f"Client {email} not found in inbound {inbound_id}")
+        return await self.update_client(inbound_id, client_key, {**client, "enable": enable})
+
+    async def disable_inbounds(self, inbound_ids: List[int]) -> List[int]:
+        snapshot = await self._load_snapshot(force=True)
+        disabled = []
+        for inbound_id in inbound_ids:
+            inbound_data = snapshot.get(inbound_id)
+            if not inbound_data:
+                logger.error(f"Error disabling inbound {inbound_id}: not found")
+                continue
+            if not inbound_data.get("enable", True):
+                continue
+            try:
+                update_payload = self._inbound_update_payload(inbound_data, False, id=inbound_id)
+                self._check_result(await self._post(f"/panel/inbound/update/{inbound_id}", json=update_payload), f"Failed to disable inbound {inbound_id}")
+                self._snapshot_upsert(inbound_data, enable=False)
+                disabled.append(inbound_id)
+            except Exception as e:
+                logger.error(f"Error disabling inbound {inbound_id}: {e}")
+        return disabled
+
+    async def disable_clients(self, inbound_id: int, clients: Dict[str, str]) -> int:
+        inbound_data = await self._fresh_inbound(inbound_id)
+        if not inbound_data:
+            raise Exception(f"Inbound {inbound_id} not found")
+        disabled = 0
+        for client_key, client in self._clients_to_disable(inbound_data, clients):
+            try:
+                await self.update_client(inbound_id, client_key, client)
+                disabled += 1
+            except Exception as e:
+                logger.error(f"Error disabling client {client.get('email')} of inbound {inbound_id}: {e}")
+        return disabled
+
+    async def create_shared_client(self, protocol, remark_prefix, domain, email, expiry_time_ms: int, total_gb_bytes: int, config_remark: Optional[str] = None, allocate_port: Optional[Callable[[], int]] = None):
+        client = self._new_client(protocol, email, expiry_time_ms, total_gb_bytes)
+        inbound_data, new_remark = self._pick_shared_inbound(await self._load_snapshot(), protocol, remark_prefix)
+        if inbound_data is not None:
+            await self.add_client(inbound_data["id"], client)
+            inbound_id = inbound_data["id"]
+        else:
+            port = await asyncio.to_thread(allocate_port) if allocate_port else self._first_free_port(await self.get_used_ports())
+            inbound_data = self._shared_inbound_payload(protocol, new_remark, port, client)
+            inbound_id = (await self._create_inbound(inbound_data, domain))["inbound_id"]
+        return {
+            "link": self._construct_config_link(inbound_data, domain, config_remark or email, client=client),
+            "inbound_id": inbound_id,
+            "client_id": self._client_key(protocol, client),
+            "client_email": email,
+        }
+
+    async def get_db_backup(self) -> bytes:
+        response = await self._request("GET", "/server/getDb")
+        response.raise_for_status()
+        return response.content
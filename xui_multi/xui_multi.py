@@ -17,7 +17,8 @@ from xui_multi.admin_page import admin_page
 from xui_multi.auth_state import AuthState, create_initial_admin_user
 from .template import template
 from .models import Panel, ManagedService, PanelConfig, Backup, User
-from .xui_client import XUIClient
+from .panel_clients import fan_out, run_fan_out
+from .inbound_cache import cached_traffic_totals
 
 # from .redis_worker import start_redis_workers  # Removed - workers run separately now
 
@@ -33,20 +34,14 @@ def run_all_backups():
     print(f"[{datetime.now()}] شروع فرآیند پشتیبان‌گیری خودکار...")
     with rx.session() as session:
         panels = session.exec(select(Panel)).all()
+        # دانلود بکاپ همه پنل‌ها به صورت همزمان
+        downloaded = run_fan_out(panels, lambda client, panel: client.get_db_backup())
         for panel in panels:
+            if panel.id in downloaded["errors"]:
+                print(f"خطا در ارتباط با پنل {panel.remark_prefix}: {downloaded['errors'][panel.id]}")
+                continue
             try:
-                print(f"درحال گرفتن بکاپ از پنل: {panel.remark_prefix}")
-                session_req = requests.Session()
-                login_data = {'username': panel.username, 'password': panel.password}
-                login_url = f"{panel.url.rstrip('/')}/login"
-
-                res = session_req.post(login_url, data=login_data, timeout=10)
-                res.raise_for_status()
-
-                db_url = f"{panel.url.rstrip('/')}/server/getDb"
-                res_db = session_req.get(db_url, timeout=20)
-                res_db.raise_for_status()
-
+                print(f"درحال ذخیره بکاپ پنل: {panel.remark_prefix}")
                 panel_backup_dir = os.path.join(BACKUP_DIR, str(panel.id))
                 os.makedirs(panel_backup_dir, exist_ok=True)
 
@@ -55,7 +50,7 @@ def run_all_backups():
                 local_file_path = os.path.join(panel_backup_dir, file_name)
 
                 with open(local_file_path, "wb") as f:
-                    f.write(res_db.content)
+                    f.write(downloaded["results"][panel.id])
 
                 download_path = f"/static/backups/{panel.id}/{file_name}"
                 new_backup = Backup(
@@ -67,8 +62,6 @@ def run_all_backups():
                 session.commit()
                 print(f"بکاپ پنل {panel.remark_prefix} با موفقیت در {local_file_path} ذخیره شد.")
 
-            except requests.exceptions.RequestException as e:
-                print(f"خطا در ارتباط با پنل {panel.remark_prefix}: {e}")
             except Exception as e:
                 print(f"خطای نامشخص هنگام بکاپ‌گیری از پنل {panel.remark_prefix}: {e}")
     print("پایان فرآیند پشتیبان‌گیری.")
@@ -164,7 +157,7 @@ class IndexState(AuthState):
     update_message: str = ""
     update_status: str = ""
 
-    def load_stats(self):
+    async def load_stats(self):
         """بارگذاری آمار با استفاده از کش"""
         self.check_auth()
         
@@ -209,15 +202,25 @@ class IndexState(AuthState):
             total_down_bytes = 0
 
             all_panels = session.query(Panel).all()
+            # ترافیک از PanelInboundCache (که worker همگام‌سازی پر می‌کند) خوانده می‌شود؛ فقط پنل‌های بدون کش از خود پنل
+            cached_traffic = cached_traffic_totals(session)
+
+            async def panel_stats(client, panel):
+                traffic = cached_traffic.get(panel.id)
+                if traffic is None:
+                    traffic = await client.get_all_inbounds_traffic()
+                return await client.get_online_clients_count(), traffic
+
+            # آمار همه پنل‌ها به صورت همزمان گرفته می‌شود
+            stats = await fan_out(all_panels, panel_stats)
             for panel in all_panels:
-                try:
-                    client = XUIClient(panel.url, panel.username, panel.password)
-                    self.online_configs_count += client.get_online_clients_count()
-                    traffic_data = client.get_all_inbounds_traffic()
-                    total_up_bytes += traffic_data.get("up", 0)
-                    total_down_bytes += traffic_data.get("down", 0)
-                except Exception as e:
-                    print(f"Could not get stats from panel {panel.url}: {e}")
+                if panel.id in stats["errors"]:
+                    print(f"Could not get stats from panel {panel.url}: {stats['errors'][panel.id]}")
+                    continue
+                online_count, traffic_data = stats["results"][panel.id]
+                self.online_configs_count += online_count
+                total_up_bytes += traffic_data.get("up", 0)
+                total_down_bytes += traffic_data.get("down", 0)
 
             self.total_upload_gb = total_up_bytes / (1024**3)
             self.total_download_gb = total_down_bytes / (1024**3)